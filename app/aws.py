@@ -0,0 +1,50 @@
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from contextlib import AsyncExitStack
+import asyncio
+
+from app import metrics
+from app.constants import *
+from app.lazy_modules import lazy_module
+
+# imported on first use, app.query_scheduler and app.status_tracker import this module
+query_scheduler = lazy_module('app.query_scheduler')
+status_tracker = lazy_module('app.status_tracker')
+
+# one aiobotocore client per AWS service for the whole worker process, opened on startup and shared by every endpoint
+# so that requests reuse the pooled connections instead of blocking the event loop on boto3 calls
+athena_client = None
+glue_client = None
+s3_client = None
+_exit_stack = AsyncExitStack()
+
+async def open_clients() -> None:
+    global athena_client, glue_client, s3_client
+    session = get_session()
+    config = AioConfig(max_pool_connections=AWS_MAX_POOL_CONNECTIONS)
+    athena_client = await _exit_stack.enter_async_context(session.create_client('athena', config=config))
+    glue_client = await _exit_stack.enter_async_context(session.create_client('glue', config=config))
+    s3_client = await _exit_stack.enter_async_context(session.create_client('s3', config=config))
+    # per operation call latency and throttling, see app/metrics.py
+    for client in (athena_client, glue_client, s3_client):
+        client.meta.events.register('before-call', metrics.aws_before_call)
+        client.meta.events.register('after-call', metrics.aws_after_call)
+
+async def close_clients() -> None:
+    await _exit_stack.aclose()
+
+# run a query to completion and return its rows (excluding the header row) as lists of string values
+async def run_query(query: str) -> list:
+    # admitted like any other bulk submission: it holds a slot of ATHENA_MAX_CONCURRENT_QUERIES until the status tracker
+    # sees it end, a ticket waits for a free slot then stands for the Athena query (see status_tracker.resolve)
+    query_id = await query_scheduler.submit({'query': query}, QUERY_PRIORITY_BULK)
+    while True:
+        query_id, state = await status_tracker.resolve(query_id)
+        if state == 'SUCCEEDED': break
+        if state in TERMINAL_QUERY_STATES: raise Exception(f"query {state.lower()} query_id={query_id}")
+        await asyncio.sleep(ATHENA_POLL_INTERVAL)
+
+    rows = []
+    async for page in athena_client.get_paginator('get_query_results').paginate(QueryExecutionId=query_id):
+        rows.extend([column.get('VarCharValue') for column in row['Data']] for row in page['ResultSet']['Rows'])
+    return rows[1:]
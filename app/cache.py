@@ -0,0 +1,170 @@
+from contextlib import suppress
+from redis.asyncio import ConnectionPool, Redis
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Optional, Tuple
+from uuid import uuid4
+import asyncio, json, logging
+
+from app.constants import *
+from app.local_cache import LocalCache
+from app.redis_setup import redis_db, redis_host, redis_port
+
+logger = logging.getLogger(__name__)
+_worker_id = str(uuid4())
+
+# delete a key only if it still holds the given value
+COMPARE_AND_DELETE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+COMPARE_AND_EXPIRE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end
+return 0
+"""
+
+# async Redis client backed by a connection pool, created on startup of the API worker and shared by all endpoints.
+# every lookup is a single GET / MGET round trip and every write sets its TTL atomically with SET EX
+client = None
+# L1 in front of Redis for the almost static catalog responses, see listen_for_invalidations
+l1 = LocalCache()
+_invalidation_listener = None
+# background revalidations in flight, referenced so that they are not garbage collected before completion
+_revalidations = set()
+
+async def open_pool() -> None:
+    global client, _invalidation_listener
+    client = Redis(connection_pool=ConnectionPool(host=redis_host, port=redis_port, db=redis_db, max_connections=REDIS_MAX_CONNECTIONS))
+    _invalidation_listener = asyncio.create_task(listen_for_invalidations())
+
+async def close_pool() -> None:
+    _invalidation_listener.cancel()
+    with suppress(asyncio.CancelledError):
+        await _invalidation_listener
+    await client.connection_pool.disconnect()
+
+# clear the L1 cache of this worker whenever any worker / container publishes a catalog change
+async def listen_for_invalidations() -> None:
+    while True:
+        try:
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(CATALOG_INVALIDATION_CHANNEL)
+                # changes published while (re)connecting would be missed otherwise
+                l1.clear()
+                async for message in pubsub.listen():
+                    if message['type'] == 'message': l1.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(f"catalog invalidation listener err=\"{err}\"")
+            await asyncio.sleep(1)
+
+async def invalidate_catalog() -> None:
+    await client.publish(CATALOG_INVALIDATION_CHANNEL, 1)
+
+async def get(key) -> Optional[str]:
+    value = await client.get(key)
+    return value.decode('ascii') if value is not None else None
+
+async def get_json(key):
+    value = await client.get(key)
+    return json.loads(value) if value is not None else None
+
+# fetch several JSON keys in one round trip, missing keys are returned as None
+async def get_many_json(*keys) -> list:
+    return [json.loads(value) if value is not None else None for value in await client.mget(keys)]
+
+async def put(key, value, ttl: Optional[int] = None) -> None:
+    await client.set(key, value, ex=ttl)
+
+async def put_json(key, value, ttl: Optional[int] = None) -> None:
+    await client.set(key, json.dumps(value), ex=ttl)
+
+async def put_many(mapping: dict) -> None:
+    await client.mset(mapping)
+
+# extend the placeholder of a running create as long as it runs, it only expires if its worker died
+async def keep_placeholder(key, placeholder: str) -> None:
+    while True:
+        await asyncio.sleep(SINGLE_FLIGHT_LOCK_TTL / 3)
+        try:
+            await client.eval(COMPARE_AND_EXPIRE_SCRIPT, 1, key, placeholder, SINGLE_FLIGHT_LOCK_TTL)
+        except Exception as err:
+            logger.warning(f"single flight placeholder not extended key={key} err=\"{err}\"")
+
+# distributed single-flight get-or-create: the first caller across all workers / containers stores a short lived
+# placeholder under the key (kept alive while create runs) and runs create, concurrent callers wait for the value it
+# stores instead of running create again. Returns (value, created), raises TimeoutError if no value shows up within
+# wait_time (the caller can retry, the running create is not repeated)
+async def single_flight(key, create: Callable[[], Awaitable[str]], ttl: Optional[int] = None, wait_time: float = SINGLE_FLIGHT_WAIT_TIME) -> Tuple[str, bool]:
+    deadline = monotonic() + wait_time
+    while True:
+        value = await get(key)
+        if value is None:
+            placeholder = SINGLE_FLIGHT_PLACEHOLDER_PREFIX + str(uuid4())
+            if await client.set(key, placeholder, ex=SINGLE_FLIGHT_LOCK_TTL, nx=True):
+                keep_alive = asyncio.create_task(keep_placeholder(key, placeholder))
+                try:
+                    value = await create()
+                except BaseException:
+                    # let the next caller retry right away instead of waiting for the placeholder to expire
+                    await client.eval(COMPARE_AND_DELETE_SCRIPT, 1, key, placeholder)
+                    raise
+                finally:
+                    keep_alive.cancel()
+                await put(key, value, ttl)
+                return value, True
+        elif not value.startswith(SINGLE_FLIGHT_PLACEHOLDER_PREFIX):
+            return value, False
+        if monotonic() > deadline: raise TimeoutError(f"single flight wait timed out for key={key}")
+        await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+
+def versioned(value) -> str:
+    return json.dumps({'version': CATALOG_CACHE_VERSION, 'fetched_at': time(), 'value': value})
+
+# a stored versioned entry, None for a missing entry or an entry written with another CATALOG_CACHE_VERSION
+def read_versioned(raw) -> Optional[dict]:
+    if raw is None: return None
+    entry = json.loads(raw)
+    if not isinstance(entry, dict) or entry.get('version') != CATALOG_CACHE_VERSION: return None
+    return entry
+
+async def get_many_versioned(*keys) -> list:
+    return [read_versioned(raw) for raw in await client.mget(keys)]
+
+async def put_many_versioned(mapping: dict, ttl: int = CATALOG_HARD_TTL) -> None:
+    async with client.pipeline(transaction=False) as pipe:
+        for key, value in mapping.items(): pipe.set(key, versioned(value), ex=ttl)
+        await pipe.execute()
+
+# stale-while-revalidate read of a versioned entry: a fresh entry is returned as is, an entry older than soft_ttl is
+# returned as well while one worker refreshes it in the background, a missing entry is fetched once across all workers
+# (single_flight, waited on for up to CATALOG_BUILD_WAIT_TIME: a build can need an Athena scan). fetch receives the
+# previous value (None on a miss). Returns (value, fetched)
+async def get_stale_while_revalidate(key, fetch: Callable[[Any], Awaitable[Any]], soft_ttl: int = CATALOG_SOFT_TTL, hard_ttl: int = CATALOG_HARD_TTL) -> Tuple[Any, bool]:
+    raw = await client.get(key)
+    if raw is not None and not raw.startswith(SINGLE_FLIGHT_PLACEHOLDER_PREFIX.encode('ascii')):
+        entry = read_versioned(raw)
+        if entry is not None:
+            if time() - entry['fetched_at'] >= soft_ttl and await client.set(f'revalidate_lock:{key}', _worker_id, nx=True, ex=REVALIDATE_LOCK_TTL):
+                task = asyncio.create_task(revalidate(key, fetch, entry['value'], hard_ttl))
+                _revalidations.add(task)
+                task.add_done_callback(_revalidations.discard)
+            return entry['value'], False
+        # written by an older version of the app
+        await client.eval(COMPARE_AND_DELETE_SCRIPT, 1, key, raw)
+
+    async def create() -> str:
+        return versioned(await fetch(None))
+
+    raw, fetched = await single_flight(key, create, hard_ttl, CATALOG_BUILD_WAIT_TIME)
+    return json.loads(raw)['value'], fetched
+
+async def revalidate(key, fetch: Callable[[Any], Awaitable[Any]], previous, hard_ttl: int) -> None:
+    try:
+        value = await fetch(previous)
+        await client.set(key, versioned(value), ex=hard_ttl)
+        if value != previous: await invalidate_catalog()
+        logger.debug(f"revalidated key={key} changed={value != previous}")
+    except Exception as err:
+        # the stale value keeps being served until the hard TTL, the next request after REVALIDATE_LOCK_TTL retries
+        logger.error(f"revalidation key={key} err=\"{err}\"")
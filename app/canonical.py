@@ -0,0 +1,172 @@
+import json, re
+
+# canonical form of a query (data_type, species, fields, condition) used as the query cache key, equivalent queries
+# (different whitespace / keyword case / order of AND-OR operands / order of fields) produce the same canonical string
+
+TOKEN_REGEX = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*')
+    |(?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<identifier>"(?:[^"]|"")+"|[A-Za-z_][A-Za-z0-9_.]*)
+    |(?P<operator><>|!=|<=|>=|=|<|>)
+    |(?P<punctuation>[(),+-])
+    )""", re.VERBOSE)
+KEYWORDS = {'AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'BETWEEN', 'LIKE', 'TRUE', 'FALSE'}
+# operator to use once the operands of a comparison are swapped, ex.: 5 < a -> a > 5
+MIRRORED_OPERATORS = {'=': '=', '<>': '<>', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+class ConditionParseError(Exception):
+    pass
+
+def tokenize(condition: str) -> list:
+    tokens, position = [], 0
+    condition = condition.rstrip()
+    while position < len(condition):
+        match = TOKEN_REGEX.match(condition, position)
+        if not match or match.end() == position: raise ConditionParseError(f"Unexpected character at {position}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'identifier':
+            if value.upper() in KEYWORDS: kind, value = 'keyword', value.upper()
+            # Athena identifiers are case insensitive, quoted or not
+            else: value = value.strip('"').replace('""', '"').lower()
+        elif kind == 'operator' and value == '!=': value = '<>'
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+# recursive descent parser, precedence: OR < AND < NOT < predicate
+class ConditionParser:
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self, kind: str = None, value: str = None) -> bool:
+        if self.position >= len(self.tokens): return False
+        token_kind, token_value = self.tokens[self.position]
+        return (kind is None or token_kind == kind) and (value is None or token_value == value)
+
+    def take(self, kind: str = None, value: str = None) -> str:
+        if not self.peek(kind, value): raise ConditionParseError(f"Expected {value or kind} at token {self.position}")
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse(self) -> tuple:
+        node = self.parse_or()
+        if self.position != len(self.tokens): raise ConditionParseError(f"Unexpected token {self.tokens[self.position][1]}")
+        return node
+
+    def parse_or(self) -> tuple:
+        operands = [self.parse_and()]
+        while self.peek('keyword', 'OR'):
+            self.take()
+            operands.append(self.parse_and())
+        return ('OR', operands) if len(operands) > 1 else operands[0]
+
+    def parse_and(self) -> tuple:
+        operands = [self.parse_not()]
+        while self.peek('keyword', 'AND'):
+            self.take()
+            operands.append(self.parse_not())
+        return ('AND', operands) if len(operands) > 1 else operands[0]
+
+    def parse_not(self) -> tuple:
+        if self.peek('keyword', 'NOT'):
+            self.take()
+            return ('NOT', self.parse_not())
+        if self.peek('punctuation', '('):
+            # a parenthesised condition, operands in parentheses (ex.: (a) = 1) are not supported
+            self.take()
+            node = self.parse_or()
+            self.take('punctuation', ')')
+            return node
+        return self.parse_predicate()
+
+    def parse_predicate(self) -> tuple:
+        left = self.parse_operand()
+        if self.peek('operator'):
+            operator = self.take()
+            right = self.parse_operand()
+            if left[0] != 'column' and right[0] == 'column': left, right, operator = right, left, MIRRORED_OPERATORS[operator]
+            return ('COMPARE', operator, left, right)
+        if self.peek('keyword', 'IS'):
+            self.take()
+            negated = bool(self.peek('keyword', 'NOT') and self.take())
+            self.take('keyword', 'NULL')
+            return ('IS NOT NULL' if negated else 'IS NULL', left)
+        negated = bool(self.peek('keyword', 'NOT') and self.take())
+        if self.peek('keyword', 'IN'):
+            self.take()
+            self.take('punctuation', '(')
+            values = [self.parse_operand()]
+            while self.peek('punctuation', ','):
+                self.take()
+                values.append(self.parse_operand())
+            self.take('punctuation', ')')
+            return ('NOT IN' if negated else 'IN', left, values)
+        if self.peek('keyword', 'BETWEEN'):
+            self.take()
+            low = self.parse_operand()
+            self.take('keyword', 'AND')
+            return ('NOT BETWEEN' if negated else 'BETWEEN', left, low, self.parse_operand())
+        if self.peek('keyword', 'LIKE'):
+            self.take()
+            return ('NOT LIKE' if negated else 'LIKE', left, self.parse_operand())
+        raise ConditionParseError(f"Expected a predicate at token {self.position}")
+
+    # operands are (kind, canonical text) pairs
+    def parse_operand(self) -> tuple:
+        if self.peek('string'): return ('literal', self.take())
+        if self.peek('number'): return ('literal', self.take())
+        if self.peek('punctuation', '-') or self.peek('punctuation', '+'):
+            sign = self.take()
+            return ('literal', ('-' if sign == '-' else '') + self.take('number'))
+        if self.peek('keyword', 'NULL') or self.peek('keyword', 'TRUE') or self.peek('keyword', 'FALSE'): return ('literal', self.take())
+        name = self.take('identifier')
+        if self.peek('punctuation', '('):
+            self.take()
+            arguments = []
+            if not self.peek('punctuation', ')'):
+                arguments.append(self.parse_operand()[1])
+                while self.peek('punctuation', ','):
+                    self.take()
+                    arguments.append(self.parse_operand()[1])
+            self.take('punctuation', ')')
+            return ('function', f"{name}({','.join(arguments)})")
+        return ('column', name)
+
+# (a AND b) AND c == a AND b AND c
+def flatten(node: tuple, kind: str) -> list:
+    if node[0] != kind: return [node]
+    return [operand for child in node[1] for operand in flatten(child, kind)]
+
+# render a condition AST, AND / OR operands are flattened, deduplicated and sorted as both are commutative
+def render(node: tuple) -> str:
+    kind = node[0]
+    if kind in ('AND', 'OR'):
+        rendered = sorted({render(operand) for operand in flatten(node, kind)})
+        return rendered[0] if len(rendered) == 1 else '(' + f' {kind} '.join(rendered) + ')'
+    if kind == 'NOT': return f'NOT {render(node[1])}'
+    if kind == 'COMPARE': return f'{node[2][1]} {node[1]} {node[3][1]}'
+    if kind in ('IS NULL', 'IS NOT NULL'): return f'{node[1][1]} {kind}'
+    if kind in ('IN', 'NOT IN'): return f"{node[1][1]} {kind} ({','.join(sorted({value[1] for value in node[2]}))})"
+    if kind in ('BETWEEN', 'NOT BETWEEN'): return f'{node[1][1]} {kind} {node[2][1]} AND {node[3][1]}'
+    return f'{node[1][1]} {kind} {node[2][1]}'
+
+def canonical_condition(condition: str) -> str:
+    if not condition or not condition.strip(): return ''
+    try:
+        tokens = tokenize(condition)
+    except ConditionParseError:
+        return ' '.join(condition.split())
+    try:
+        return render(ConditionParser(tokens).parse())
+    except ConditionParseError:
+        # not understood by the parser, still normalize whitespace and case but keep the token order
+        return ' '.join(value for _, value in tokens)
+
+def canonical_fields(fields: str) -> str:
+    fields = {field.strip().strip('"').lower() for field in (fields or '*').split(',') if field.strip()}
+    return ','.join(sorted(fields)) or '*'
+
+def canonical_query(data_type: str, species: str, fields: str = "", condition: str = "") -> str:
+    return json.dumps([data_type, species, canonical_fields(fields), canonical_condition(condition)])
@@ -0,0 +1,124 @@
+from time import time
+from typing import Optional, Tuple
+from uuid import uuid4
+import asyncio, hashlib, json, logging
+
+from app import aws, cache
+from app.constants import *
+
+logger = logging.getLogger(__name__)
+
+# per data type index of the species and columns served by /filters/{data_type}, one versioned JSON document per data
+# type under catalog_index:{data_type} so that a lookup is a single GET. Built from the table metadata and, for the tables
+# partitioned by species, from the Glue partition values (a metadata read), only the other tables need a one-off
+# SELECT DISTINCT scan. A background refresh (by whichever API worker holds the index lock) keeps it current
+_worker_id = str(uuid4())
+_tasks = []
+
+def index_cache_key(data_type: str) -> str:
+    return f'catalog_index:{data_type}'
+
+async def start() -> None:
+    _tasks.append(asyncio.create_task(refresh_loop()))
+
+async def stop() -> None:
+    for task in _tasks: task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+# changes with the columns, the partitioning or the DDL time of the table
+def table_fingerprint(table_metadata: dict) -> str:
+    parameters = table_metadata.get('Parameters', {})
+    return hashlib.sha1(json.dumps([table_metadata.get('Columns', []), table_metadata.get('PartitionKeys', []), parameters.get('transient_lastDdlTime')], sort_keys=True).encode('utf-8')).hexdigest()
+
+async def species_from_partitions(data_type: str, partition_index: int) -> list:
+    species = set()
+    async for page in aws.glue_client.get_paginator('get_partitions').paginate(DatabaseName=AWS_SCHEMA_DATABASE_NAME, TableName=data_type):
+        species.update(partition['Values'][partition_index] for partition in page['Partitions'])
+    return sorted(species)
+
+async def species_from_scan(data_type: str) -> list:
+    return [row[0] for row in await aws.run_query(f"SELECT DISTINCT species from {data_type}")]
+
+async def build_entry(table_metadata: dict, previous: Optional[dict] = None) -> dict:
+    data_type = table_metadata['Name']
+    fingerprint = table_fingerprint(table_metadata)
+    partition_keys = [partition_key['Name'] for partition_key in table_metadata.get('PartitionKeys', [])]
+    species = None
+    if 'species' in partition_keys:
+        species = await species_from_partitions(data_type, partition_keys.index('species'))
+    elif previous and previous['fingerprint'] == fingerprint and time() - previous['built_at'] < CATALOG_INDEX_RESCAN_INTERVAL:
+        return previous
+    # a partition projection table has no partitions in the Glue catalog
+    if not species: species = await species_from_scan(data_type)
+    # partition keys are queryable columns too
+    columns = table_metadata.get('Columns', []) + table_metadata.get('PartitionKeys', [])
+    return {'columns': columns, 'species': species, 'species_partitioned': 'species' in partition_keys, 'fingerprint': fingerprint, 'built_at': time()}
+
+async def list_tables() -> list:
+    tables = []
+    async for page in aws.athena_client.get_paginator('list_table_metadata').paginate(CatalogName=AWS_DATA_CATALOG, DatabaseName=AWS_SCHEMA_DATABASE_NAME):
+        tables.extend(page['TableMetadataList'])
+    return tables
+
+async def build(data_type: str, previous: Optional[dict] = None) -> dict:
+    table_metadata = (await aws.athena_client.get_table_metadata(CatalogName=AWS_DATA_CATALOG, DatabaseName=AWS_SCHEMA_DATABASE_NAME, TableName=data_type))["TableMetadata"]
+    return await build_entry(table_metadata, previous)
+
+# index entry of a data type and whether it had to be built, stale entries are served while being rebuilt
+async def get_entry(data_type: str) -> Tuple[dict, bool]:
+    return await cache.get_stale_while_revalidate(index_cache_key(data_type), lambda previous: build(data_type, previous))
+
+async def get_data_types() -> Tuple[list, bool]:
+    async def fetch(previous) -> list:
+        return [table['Name'] for table in await list_tables()]
+    return await cache.get_stale_while_revalidate('data_types', fetch)
+
+async def refresh_loop() -> None:
+    while True:
+        try:
+            await refresh_locked()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(f"catalog index refresh err=\"{err}\"")
+        await asyncio.sleep(CATALOG_INDEX_REFRESH_INTERVAL)
+
+# the first run on startup doubles as the cache warm-up, only one worker across all containers refreshes per interval
+async def refresh_locked() -> None:
+    if await cache.client.set(CATALOG_INDEX_LOCK_KEY, _worker_id, nx=True, px=CATALOG_INDEX_REFRESH_INTERVAL * 1000):
+        await refresh()
+
+# rewrite the index entry of every data type (and data_types), which also renews their soft / hard TTL
+async def refresh() -> None:
+    tables = await list_tables()
+    data_types = [table['Name'] for table in tables]
+    previous_data_types, *previous_entries = await cache.get_many_versioned('data_types', *[index_cache_key(data_type) for data_type in data_types])
+    previous_data_types = previous_data_types and previous_data_types['value']
+    entries, changed = {'data_types': data_types}, []
+    for table_metadata, previous in zip(tables, previous_entries):
+        previous = previous and previous['value']
+        try:
+            entry = await build_entry(table_metadata, previous)
+        except Exception as err:
+            logger.error(f"catalog index refresh data_type={table_metadata['Name']} err=\"{err}\"")
+            continue
+        entries[index_cache_key(table_metadata['Name'])] = entry
+        if previous is None or entry['columns'] != previous['columns'] or entry['species'] != previous['species']: changed.append(table_metadata['Name'])
+    if previous_data_types != data_types: changed.append('data_types')
+    await cache.put_many_versioned(entries)
+    dropped = [index_cache_key(data_type) for data_type in previous_data_types or [] if data_type not in data_types]
+    if dropped: await cache.client.delete(*dropped)
+    if changed or dropped:
+        logger.info(f"catalog index refreshed changed={changed} dropped={dropped}")
+        await cache.invalidate_catalog()
+
+# standalone warm-up for the processes without the API lifecycle (Celery workers)
+async def warm_up() -> None:
+    await aws.open_clients()
+    await cache.open_pool()
+    try:
+        await refresh_locked()
+    finally:
+        await cache.close_pool()
+        await aws.close_clients()
@@ -1,4 +1,5 @@
 from enum import Enum
+import os
 
 class SupportedFileFormats(str, Enum):
     csv = "csv"
@@ -8,9 +9,200 @@ class SupportedFileFormats(str, Enum):
     xml = "xml"
     feather = "feather"
     parquet = "parquet"
+    # compressed variants of the text formats
+    csv_gz = "csv.gz"
+    csv_zst = "csv.zst"
+    tsv_gz = "tsv.gz"
+    tsv_zst = "tsv.zst"
+    json_gz = "json.gz"
+    json_zst = "json.zst"
+    xml_gz = "xml.gz"
+    xml_zst = "xml.zst"
+    # parquet is snappy compressed, other codecs
+    parquet_zstd = "zstd.parquet"
+    parquet_gzip = "gzip.parquet"
+
+FILE_FORMAT_MEDIA_TYPES = {
+    SupportedFileFormats.csv: "text/csv",
+    SupportedFileFormats.tsv: "text/tab-separated-values",
+    SupportedFileFormats.xlsx: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    SupportedFileFormats.json: "application/json",
+    SupportedFileFormats.xml: "application/xml",
+    SupportedFileFormats.feather: "application/vnd.apache.arrow.file",
+    SupportedFileFormats.parquet: "application/vnd.apache.parquet",
+    SupportedFileFormats.csv_gz: "application/gzip",
+    SupportedFileFormats.csv_zst: "application/zstd",
+    SupportedFileFormats.tsv_gz: "application/gzip",
+    SupportedFileFormats.tsv_zst: "application/zstd",
+    SupportedFileFormats.json_gz: "application/gzip",
+    SupportedFileFormats.json_zst: "application/zstd",
+    SupportedFileFormats.xml_gz: "application/gzip",
+    SupportedFileFormats.xml_zst: "application/zstd",
+    SupportedFileFormats.parquet_zstd: "application/vnd.apache.parquet",
+    SupportedFileFormats.parquet_gzip: "application/vnd.apache.parquet",
+}
+# text formats, gzip encoded on the fly for the clients accepting it (the other formats are compressed already)
+COMPRESSIBLE_FILE_FORMATS = {SupportedFileFormats.csv, SupportedFileFormats.tsv, SupportedFileFormats.json, SupportedFileFormats.xml}
 
 AWS_DATA_CATALOG = "AwsDataCatalog"
 AWS_SCHEMA_DATABASE_NAME = "ensembl-parquet-meta-schema"
-AWS_S3_OUTPUT_DIR = "s3://ensembl-athena-results/"
+# Athena query results / exports location, can point to a local directory (file:///...) for the offline benchmarks
+AWS_S3_OUTPUT_DIR = os.getenv("AWS_S3_OUTPUT_DIR", "s3://ensembl-athena-results/")
 SUPPORTED_FILE_FORMATS = [elem.value for elem in SupportedFileFormats]
-PRESIGNED_URL_EXPIRATION_TIME = 3600
\ No newline at end of file
+PRESIGNED_URL_EXPIRATION_TIME = 3600
+
+# bytes of CSV decoded per record batch by the streaming export converter, bounds the worker memory per export
+EXPORT_READ_BLOCK_SIZE = 16 * 1024 * 1024
+# rows per xlsx worksheet (header row included), larger results continue on Sheet2, Sheet3, ...
+XLSX_MAX_SHEET_ROWS = 1048576
+# deflate level of the xlsx worksheets, the sheet XML is repetitive and compresses well already at a low level
+XLSX_COMPRESSION_LEVEL = 1
+# rows of a record batch rendered to xml / xlsx markup at a time
+XML_RENDER_ROWS = 16384
+
+# size of the pooled HTTP connections kept by each shared aiobotocore client of an API worker
+AWS_MAX_POOL_CONNECTIONS = 50
+ATHENA_POLL_INTERVAL = 0.5
+
+REDIS_MAX_CONNECTIONS = 100
+# automatically expire/delete redis cache keys after 44 days as the query ID in Athena history is retained for 45 days
+QUERY_ID_CACHE_TTL = 3801600
+
+# per process L1 cache of the pre-serialized catalog endpoint responses, invalidated across workers via Redis pub/sub
+L1_CACHE_MAX_SIZE = 1024
+L1_CACHE_TTL = 300
+CATALOG_INVALIDATION_CHANNEL = "catalog_invalidation"
+
+# species / columns index per data type (app/catalog_index.py), rebuilt from the table and partition metadata
+CATALOG_INDEX_LOCK_KEY = "catalog_index_lock"
+CATALOG_INDEX_REFRESH_INTERVAL = 600
+# species of a table not partitioned by species come from a SELECT DISTINCT scan, which is only repeated after a schema
+# change of the table or once this interval elapsed (appended data does not change the table metadata)
+CATALOG_INDEX_RESCAN_INTERVAL = 86400
+# catalog entries are stored as {"version", "fetched_at", "value"}, an entry older than the soft TTL is still served
+# while it is refreshed in the background, Redis drops it after the hard TTL. Bump the version on a format change
+CATALOG_CACHE_VERSION = 2
+CATALOG_SOFT_TTL = 3600
+CATALOG_HARD_TTL = 7 * 86400
+# wait of a request for a catalog entry built by another request (the first build of a table not partitioned by species
+# runs a SELECT DISTINCT scan), 503 after that
+CATALOG_BUILD_WAIT_TIME = 120
+REVALIDATE_LOCK_TTL = 60
+# warm the catalog cache when a Celery worker starts as well, set to 0 for workers without access to the AWS catalog
+CELERY_CATALOG_WARM_UP = os.getenv("CELERY_CATALOG_WARM_UP", "1") == "1"
+
+TERMINAL_QUERY_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+# background status tracker of the in-flight Athena queries
+TRACKED_QUERIES_KEY = "tracked_queries"
+STATUS_TRACKER_LOCK_KEY = "status_tracker_lock"
+QUERY_STATUS_CHANNEL = "query_status"
+STATUS_REFRESH_INTERVAL = 1
+# non terminal states are only trusted for a short while in case the tracker stops refreshing them
+QUERY_STATUS_CACHE_TTL = 30
+# maximum number of query IDs accepted by athena batch_get_query_execution
+ATHENA_BATCH_SIZE = 50
+MAX_STATUS_WAIT_TIME = 30
+
+# admission control of the Athena query submissions (app/query_scheduler.py), queries beyond the account's concurrent
+# query limit wait in a priority queue as QUEUED tickets
+ATHENA_MAX_CONCURRENT_QUERIES = int(os.getenv("ATHENA_MAX_CONCURRENT_QUERIES", 20))
+ATHENA_SUBMISSION_QUEUE_KEY = "athena_submission_queue"
+ATHENA_SUBMISSION_SCORES_KEY = "athena_submission_scores"
+ATHENA_SUBMISSION_LEASES_KEY = "athena_submission_leases"
+# a submission in progress counts as in flight for at most this many seconds (a dispatcher which died meanwhile)
+ATHENA_SUBMISSION_LEASE_TTL = 30
+# status of a ticket once submitted: "SUBMITTED:{query_id}"
+TICKET_SUBMITTED_PREFIX = "SUBMITTED:"
+# priority classes, every waiting interactive query (filtered, single species) is submitted before the bulk ones
+QUERY_PRIORITY_INTERACTIVE = 0
+QUERY_PRIORITY_BULK = 1
+# score span of a priority class in the queue, above any submission time
+ATHENA_PRIORITY_CLASS_SPAN = 10 ** 10
+# retries of a throttled start_query_execution, exponential backoff from ATHENA_SUBMIT_BACKOFF seconds
+ATHENA_SUBMIT_RETRIES = 3
+ATHENA_SUBMIT_BACKOFF = 0.2
+ATHENA_SUBMIT_BACKOFF_MAX = 5
+QUERY_SCHEDULER_INTERVAL = 0.5
+
+# local columnar (Arrow IPC) copies of the SUCCEEDED query results used to serve the paginated previews
+PREVIEW_SIDECAR_DIR = os.getenv("PREVIEW_SIDECAR_DIR", "/tmp/ensembl_lakehouse_previews")
+PREVIEW_SIDECAR_MAX_BYTES = int(os.getenv("PREVIEW_SIDECAR_MAX_BYTES", 20 * 1024 * 1024 * 1024))
+PREVIEW_SORT_CACHE_MAX_SIZE = 8
+# a sidecar build lock older than this is left behind by a dead worker, the other workers poll the lock meanwhile
+PREVIEW_SIDECAR_LOCK_TTL = 600
+PREVIEW_SIDECAR_LOCK_POLL_INTERVAL = 0.2
+# rows (header included) of a preview served by Athena get_query_results while the sidecar is built
+PREVIEW_ATHENA_MAX_ROWS = 1000
+
+# single-flight submission of identical queries, see cache.single_flight
+SINGLE_FLIGHT_PLACEHOLDER_PREFIX = "PENDING:"
+SINGLE_FLIGHT_LOCK_TTL = 30
+SINGLE_FLIGHT_WAIT_TIME = 10
+SINGLE_FLIGHT_POLL_INTERVAL = 0.1
+
+# local refinement (app/refinement.py): a query narrowing a SUCCEEDED query of the same data type and species is answered
+# by filtering the cached result of that query instead of an Athena scan, for cached results up to REFINEMENT_MAX_BYTES
+QUERY_REFINEMENT = os.getenv("QUERY_REFINEMENT", "1") == "1"
+REFINEMENT_MAX_BYTES = int(os.getenv("REFINEMENT_MAX_BYTES", 64 * 1024 * 1024))
+# most recent queries per data type and species considered as the source of a refinement
+REFINEMENT_CANDIDATES = 50
+
+# batch query submission
+BATCH_MAX_QUERIES = 100
+BATCH_MAX_SPECIES = 100
+BATCH_SUBMIT_CONCURRENCY = 5
+# up to this many species, a filtered batch spec on a table partitioned by species is submitted as one query per
+# species, above it the species share one species IN (...) query (see merge_species in app/main.py)
+BATCH_FANOUT_MAX_SPECIES = 5
+
+# size aware export scheduling: exports are routed by estimated cost = result CSV size (bytes) x format cost factor
+EXPORT_FAST_QUEUE = "exports_fast"
+EXPORT_BULK_QUEUE = "exports_bulk"
+EXPORT_FAST_LANE_MAX_COST = 256 * 1024 * 1024
+EXPORT_FORMAT_COST_FACTORS = {
+    SupportedFileFormats.csv: 0,
+    SupportedFileFormats.tsv: 1,
+    SupportedFileFormats.xlsx: 8,
+    SupportedFileFormats.json: 1.5,
+    SupportedFileFormats.xml: 3,
+    SupportedFileFormats.feather: 0.5,
+    SupportedFileFormats.parquet: 0.8,
+    SupportedFileFormats.csv_gz: 1.5,
+    SupportedFileFormats.csv_zst: 1.2,
+    SupportedFileFormats.tsv_gz: 1.5,
+    SupportedFileFormats.tsv_zst: 1.2,
+    SupportedFileFormats.json_gz: 2,
+    SupportedFileFormats.json_zst: 1.7,
+    SupportedFileFormats.xml_gz: 3.5,
+    SupportedFileFormats.xml_zst: 3.2,
+    SupportedFileFormats.parquet_zstd: 0.9,
+    SupportedFileFormats.parquet_gzip: 1.2,
+}
+# worker pool concurrency per queue (celery worker -Q <queue> --concurrency <n>), used for the ETA
+EXPORT_QUEUE_CONCURRENCY = {EXPORT_FAST_QUEUE: 4, EXPORT_BULK_QUEUE: 1}
+# cost units (bytes) per second per worker slot, until a measured throughput is available
+EXPORT_DEFAULT_THROUGHPUT = 20 * 1024 * 1024
+# a FAILED export status expires after this many seconds, then the export can be requested again
+EXPORT_FAILED_RETRY_INTERVAL = 60
+
+# parquet / feather exports are produced from an Athena UNLOAD of the query to Parquet (exact column types, no CSV
+# parsing), the UNLOAD files are written under UNLOAD_PREFIX/{query_id}/ of AWS_S3_OUTPUT_DIR and compacted into one
+# file per format by a Celery worker
+EXPORT_VIA_UNLOAD = os.getenv("EXPORT_VIA_UNLOAD", "1") == "1"
+UNLOAD_FILE_FORMATS = {SupportedFileFormats.parquet, SupportedFileFormats.parquet_zstd, SupportedFileFormats.parquet_gzip, SupportedFileFormats.feather}
+UNLOAD_PREFIX = "unload"
+# cost per byte of the result CSV of compacting the Parquet files, no parsing or type inference involved
+UNLOAD_COMPACTION_COST_FACTORS = {SupportedFileFormats.parquet: 0.2, SupportedFileFormats.parquet_zstd: 0.25, SupportedFileFormats.parquet_gzip: 0.5, SupportedFileFormats.feather: 0.3}
+UNLOAD_LOCK_TTL = 60
+
+# exports are uploaded to S3 in parts of EXPORT_UPLOAD_PART_SIZE (min. 5 MB), up to EXPORT_UPLOAD_CONCURRENCY parts in
+# parallel per export, which also bounds the upload buffers to (EXPORT_UPLOAD_CONCURRENCY + 1) * EXPORT_UPLOAD_PART_SIZE
+EXPORT_UPLOAD_PART_SIZE = int(os.getenv("EXPORT_UPLOAD_PART_SIZE", 16 * 1024 * 1024))
+EXPORT_UPLOAD_CONCURRENCY = int(os.getenv("EXPORT_UPLOAD_CONCURRENCY", 4))
+
+# results up to this size (of the result CSV) are converted straight into the /download response, bigger ones are
+# redirected to the Celery export
+DIRECT_DOWNLOAD_MAX_BYTES = int(os.getenv("DIRECT_DOWNLOAD_MAX_BYTES", 32 * 1024 * 1024))
+DIRECT_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# converted chunks waiting to be sent per direct download
+DIRECT_DOWNLOAD_QUEUE_CHUNKS = 8
@@ -0,0 +1,387 @@
+from __future__ import annotations
+from typing import Optional, Tuple
+from xml.sax.saxutils import escape
+import csv, io, json, zipfile
+
+from app.constants import *
+from app.lazy_modules import lazy_module
+
+pa = lazy_module('pyarrow')
+pa_csv = lazy_module('pyarrow.csv')
+pc = lazy_module('pyarrow.compute')
+ipc = lazy_module('pyarrow.ipc')
+pq = lazy_module('pyarrow.parquet')
+
+# incremental writers, each one receives the Arrow schema up front and then one record batch at a time so that only a
+# single batch of the result is held in memory at any point, regardless of the total result size
+
+class TSVWriter:
+    def __init__(self, sink, schema: pa.Schema):
+        self.sink = io.TextIOWrapper(sink, encoding="utf-8", newline="")
+        self.header = True
+
+    def write(self, batch: pa.RecordBatch):
+        batch.to_pandas().to_csv(self.sink, sep="\t", index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.sink.flush()
+        self.sink.detach()
+
+
+class JSONWriter:
+    # emits the same document as df.to_json(orient="split", index=False): {"columns": [...], "data": [[...], ...]}
+    def __init__(self, sink, schema: pa.Schema):
+        self.sink = io.TextIOWrapper(sink, encoding="utf-8")
+        self.sink.write('{"columns":' + json.dumps(schema.names) + ',"data":[')
+        self.rows = 0
+
+    def write(self, batch: pa.RecordBatch):
+        if not batch.num_rows: return
+        if self.rows: self.sink.write(',')
+        # strip the enclosing brackets of the per batch array so that the rows can be appended to the shared "data" array
+        self.sink.write(batch.to_pandas().to_json(orient="values")[1:-1])
+        self.rows += batch.num_rows
+
+    def close(self):
+        self.sink.write(']}')
+        self.sink.flush()
+        self.sink.detach()
+
+
+class ArrowIPCWriter:
+    # uncompressed Arrow IPC file, can be memory-mapped and sliced without copying
+    compression = None
+
+    def __init__(self, sink, schema: pa.Schema):
+        self.writer = ipc.new_file(sink, schema, options=ipc.IpcWriteOptions(compression=self.compression))
+
+    def write(self, batch: pa.RecordBatch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class FeatherWriter(ArrowIPCWriter):
+    # feather V2 is the Arrow IPC file format, lz4 compressed by default as with df.to_feather
+    compression = "lz4"
+
+
+class CSVWriter:
+    # for the compressed CSV variants, the plain CSV export is the Athena query result itself
+    def __init__(self, sink, schema: pa.Schema):
+        self.writer = pa_csv.CSVWriter(sink, schema)
+
+    def write(self, batch: pa.RecordBatch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter:
+    compression = "snappy"
+
+    def __init__(self, sink, schema: pa.Schema):
+        self.writer = pq.ParquetWriter(sink, schema, compression=self.compression)
+
+    def write(self, batch: pa.RecordBatch):
+        self.writer.write_table(pa.Table.from_batches([batch]))
+
+    def close(self):
+        self.writer.close()
+
+
+class ZstdParquetWriter(ParquetWriter):
+    compression = "zstd"
+
+
+class GzipParquetWriter(ParquetWriter):
+    compression = "gzip"
+
+
+class KeepOpenSink(io.RawIOBase):
+    # closing the compressed stream closes its sink, the export closes the actual sink itself
+    def __init__(self, sink):
+        self.sink = sink
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return self.sink.write(data)
+
+    def close(self):
+        pass
+
+
+def compressed(writer_class, codec: str):
+    # writer_class writing through a gzip / zstd compressed stream
+    class CompressedWriter(writer_class):
+        def __init__(self, sink, schema: pa.Schema):
+            self.compressed_sink = pa.CompressedOutputStream(pa.PythonFile(KeepOpenSink(sink), mode="w"), codec)
+            super().__init__(self.compressed_sink, schema)
+
+        def close(self):
+            super().close()
+            self.compressed_sink.close()
+
+    CompressedWriter.__name__ = f"{writer_class.__name__}_{codec}"
+    return CompressedWriter
+
+
+# characters not allowed in an XML document, dropped from the xml / xlsx strings
+XML_ILLEGAL_CHARACTERS = "[\x00-\x08\x0b\x0c\x0e-\x1f]"
+
+# text of the values of a column escaped for an XML element, null values stay null
+def xml_text(column: pa.Array) -> pa.Array:
+    text = column.cast(pa.string())
+    for char, entity in (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")): text = pc.replace_substring(text, char, entity)
+    return pc.replace_substring_regex(text, XML_ILLEGAL_CHARACTERS, "")
+
+# floats as Python prints them (1.0, 1e-05, inf) like pandas does, NaN as null. The Arrow string cast drops the ".0"
+# and switches to the exponent notation at other magnitudes, so the values are formatted by Python
+def python_float_text(column: pa.Array) -> pa.Array:
+    text = pa.array(list(map(repr, column.to_numpy(zero_copy_only=False).tolist())), pa.string())
+    return pc.if_else(pc.is_nan(column), pa.scalar(None, pa.string()), text)
+
+# the rows of a batch as one string per row: prefix, the element of every column (built by `cell(name, column)`), suffix.
+# Yields the bytes of XML_RENDER_ROWS rows at a time, the rows are contiguous in the data buffer of the string array
+def render_rows(batch: pa.RecordBatch, cell, prefix: str, suffix: str):
+    for offset in range(0, batch.num_rows, XML_RENDER_ROWS):
+        chunk = batch.slice(offset, XML_RENDER_ROWS)
+        rows = pc.binary_join_element_wise(prefix, *(cell(name, column) for name, column in zip(chunk.schema.names, chunk.columns)), suffix, "")
+        offsets = pa.Array.from_buffers(pa.int32(), len(rows) + 1, [None, rows.buffers()[1]], offset=rows.offset)
+        yield memoryview(rows.buffers()[2])[offsets[0].as_py():offsets[-1].as_py()]
+
+
+class XMLWriter:
+    # emits the same document as df.to_xml(index=False) a batch at a time:
+    # <?xml ...?><data><row><column>value</column>...</row>...</data>, null / NaN values and empty strings as empty
+    # <column/> elements
+    def __init__(self, sink, schema: pa.Schema):
+        self.sink = sink
+        self.rows = 0
+        self.sink.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+
+    @staticmethod
+    def element(name: str, column: pa.Array) -> pa.Array:
+        if pa.types.is_boolean(column.type):
+            text = pc.if_else(column, "True", "False")
+        elif pa.types.is_floating(column.type):
+            text = python_float_text(column)
+        else:
+            text = xml_text(column)
+            text = pc.if_else(pc.equal(column.cast(pa.string()), ""), pa.scalar(None, pa.string()), text)
+        return pc.fill_null(pc.binary_join_element_wise(f"    <{name}>", text, f"</{name}>\n", ""), f"    <{name}/>\n")
+
+    def write(self, batch: pa.RecordBatch):
+        if not batch.num_rows: return
+        if not self.rows: self.sink.write(b"<data>\n")
+        for rows in render_rows(batch, self.element, "  <row>\n", "  </row>\n"): self.sink.write(rows)
+        self.rows += batch.num_rows
+
+    def close(self):
+        self.sink.write(b"</data>" if self.rows else b"<data/>")
+
+
+XLSX_CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}</Types>')
+XLSX_SHEET_CONTENT_TYPE = '<Override PartName="/xl/worksheets/sheet{n}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+XLSX_ROOT_RELS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>')
+XLSX_WORKBOOK = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets></workbook>')
+XLSX_WORKBOOK_SHEET = '<sheet name="Sheet{n}" sheetId="{n}" r:id="rId{n}"/>'
+XLSX_WORKBOOK_RELS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{sheets}'
+    '<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>')
+XLSX_WORKBOOK_SHEET_REL = '<Relationship Id="rId{n}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{n}.xml"/>'
+# cell style 1: date and time (number format 22), 2: date (number format 14)
+XLSX_STYLES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles></styleSheet>')
+XLSX_SHEET_HEADER = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+XLSX_SHEET_FOOTER = '</sheetData></worksheet>'
+# days between the Excel epoch (1899-12-30) and the Unix epoch
+XLSX_UNIX_EPOCH = 25569
+# modification time of every xlsx zip entry (the earliest a zip can hold) instead of the current time, so that the same
+# result always converts to the same bytes
+XLSX_ENTRY_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class XLSXWriter:
+    # SpreadsheetML written a batch at a time into a zip stream (one deflated entry per worksheet, inline strings instead
+    # of a shared string table) so that the memory does not depend on the number of rows. A sheet holds at most
+    # XLSX_MAX_SHEET_ROWS rows, the header included, the following rows continue on a new sheet with the header repeated
+    def __init__(self, sink, schema: pa.Schema):
+        self.archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=XLSX_COMPRESSION_LEVEL)
+        self.header = ("<row>" + "".join(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(name)}</t></is></c>' for name in schema.names) + "</row>").encode()
+        self.sheets = 0
+        self.sheet = None
+        self.sheet_rows = XLSX_MAX_SHEET_ROWS
+
+    @staticmethod
+    def cell(name: str, column: pa.Array) -> pa.Array:
+        if pa.types.is_boolean(column.type):
+            text, prefix, suffix = pc.if_else(column, "1", "0"), '<c t="b"><v>', '</v></c>'
+        elif pa.types.is_floating(column.type):
+            # NaN / infinity have no cell value
+            text, prefix, suffix = pc.if_else(pc.is_finite(column), column, pa.scalar(None, column.type)).cast(pa.string()), '<c><v>', '</v></c>'
+        elif pa.types.is_integer(column.type) or pa.types.is_decimal(column.type):
+            text, prefix, suffix = column.cast(pa.string()), '<c><v>', '</v></c>'
+        elif pa.types.is_timestamp(column.type) and column.type.tz is None:
+            days = pc.divide(column.cast(pa.timestamp("us")).cast(pa.int64()).cast(pa.float64()), 86400e6)
+            text, prefix, suffix = pc.add(days, XLSX_UNIX_EPOCH).cast(pa.string()), '<c s="1"><v>', '</v></c>'
+        elif pa.types.is_date(column.type):
+            days = column.cast(pa.date32()).cast(pa.int32())
+            text, prefix, suffix = pc.add(days, XLSX_UNIX_EPOCH).cast(pa.string()), '<c s="2"><v>', '</v></c>'
+        else:
+            text = xml_text(column)
+            prefix, suffix = '<c t="inlineStr"><is><t xml:space="preserve">', '</t></is></c>'
+        return pc.fill_null(pc.binary_join_element_wise(prefix, text, suffix, ""), "<c/>")
+
+    @staticmethod
+    def entry(name: str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, date_time=XLSX_ENTRY_DATE_TIME)
+        info.external_attr = 0o600 << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        # ZipFile.open(info, "w") takes the level from the entry, not from the archive
+        info._compresslevel = XLSX_COMPRESSION_LEVEL
+        return info
+
+    def add_sheet(self):
+        if self.sheet is not None:
+            self.sheet.write(XLSX_SHEET_FOOTER.encode())
+            self.sheet.close()
+        self.sheets += 1
+        self.sheet = self.archive.open(self.entry(f"xl/worksheets/sheet{self.sheets}.xml"), "w", force_zip64=True)
+        self.sheet.write(XLSX_SHEET_HEADER.encode())
+        self.sheet.write(self.header)
+        self.sheet_rows = 1
+
+    def write(self, batch: pa.RecordBatch):
+        offset = 0
+        while offset < batch.num_rows:
+            if self.sheet_rows == XLSX_MAX_SHEET_ROWS: self.add_sheet()
+            count = min(batch.num_rows - offset, XLSX_MAX_SHEET_ROWS - self.sheet_rows)
+            for rows in render_rows(batch.slice(offset, count), self.cell, "<row>", "</row>"): self.sheet.write(rows)
+            self.sheet_rows += count
+            offset += count
+
+    def close(self):
+        if self.sheet is None: self.add_sheet()
+        self.sheet.write(XLSX_SHEET_FOOTER.encode())
+        self.sheet.close()
+        numbers = range(1, self.sheets + 1)
+        self.archive.writestr(self.entry("[Content_Types].xml"), XLSX_CONTENT_TYPES.format(sheets="".join(XLSX_SHEET_CONTENT_TYPE.format(n=n) for n in numbers)))
+        self.archive.writestr(self.entry("_rels/.rels"), XLSX_ROOT_RELS)
+        self.archive.writestr(self.entry("xl/workbook.xml"), XLSX_WORKBOOK.format(sheets="".join(XLSX_WORKBOOK_SHEET.format(n=n) for n in numbers)))
+        self.archive.writestr(self.entry("xl/_rels/workbook.xml.rels"), XLSX_WORKBOOK_RELS.format(sheets="".join(XLSX_WORKBOOK_SHEET_REL.format(n=n) for n in numbers)))
+        self.archive.writestr(self.entry("xl/styles.xml"), XLSX_STYLES)
+        self.archive.close()
+
+
+# csv is not converted, it is the Athena query result itself
+FILE_FORMAT_WRITERS = {
+    SupportedFileFormats.tsv: TSVWriter,
+    SupportedFileFormats.xlsx: XLSXWriter,
+    SupportedFileFormats.json: JSONWriter,
+    SupportedFileFormats.xml: XMLWriter,
+    SupportedFileFormats.feather: FeatherWriter,
+    SupportedFileFormats.parquet: ParquetWriter,
+    SupportedFileFormats.csv_gz: compressed(CSVWriter, "gzip"),
+    SupportedFileFormats.csv_zst: compressed(CSVWriter, "zstd"),
+    SupportedFileFormats.tsv_gz: compressed(TSVWriter, "gzip"),
+    SupportedFileFormats.tsv_zst: compressed(TSVWriter, "zstd"),
+    SupportedFileFormats.json_gz: compressed(JSONWriter, "gzip"),
+    SupportedFileFormats.json_zst: compressed(JSONWriter, "zstd"),
+    SupportedFileFormats.xml_gz: compressed(XMLWriter, "gzip"),
+    SupportedFileFormats.xml_zst: compressed(XMLWriter, "zstd"),
+    SupportedFileFormats.parquet_zstd: ZstdParquetWriter,
+    SupportedFileFormats.parquet_gzip: GzipParquetWriter,
+}
+
+# Arrow type the result CSV columns of an Athena type are parsed to (pyarrow type factory names), the other types
+# (varchar, decimal, timestamp, arrays, ...) are kept as text
+ATHENA_ARROW_TYPES = {
+    'boolean': 'bool_', 'tinyint': 'int64', 'smallint': 'int64', 'integer': 'int64', 'int': 'int64', 'bigint': 'int64',
+    'double': 'float64', 'float': 'float64', 'real': 'float64', 'date': 'date32',
+}
+
+def arrow_type(athena_type: Optional[str]) -> pa.DataType:
+    return getattr(pa, ATHENA_ARROW_TYPES.get((athena_type or '').lower(), 'string'))()
+
+# every column gets an explicit type, the Athena type of the result column (column_types: {name: Athena type}, see
+# app/result_columns.py) or text if it is not known: types inferred from the first block fail the whole conversion
+# on a later block (ex.: chromosome names 1..22 then X). Null is an empty unquoted value, as Athena writes NULL
+def open_csv_stream(source, block_size: int = EXPORT_READ_BLOCK_SIZE, column_types: Optional[dict] = None) -> pa_csv.CSVStreamingReader:
+    names = next(csv.reader([source.readline().decode('utf-8')]), [])
+    convert_options = pa_csv.ConvertOptions(column_types={name: arrow_type((column_types or {}).get(name)) for name in names}, strings_can_be_null=True, quoted_strings_can_be_null=False)
+    return pa_csv.open_csv(source, read_options=pa_csv.ReadOptions(column_names=names, block_size=block_size), convert_options=convert_options)
+
+# feed every record batch to the writer of each requested format, sinks: {file_format: sink}. A failing writer does not
+# stop the others, returns the number of rows and the errors per file format
+def convert_batches(schema: pa.Schema, batches, sinks: dict) -> Tuple[int, dict]:
+    writers, errors = {}, {}
+    for file_format, sink in sinks.items():
+        try:
+            writers[file_format] = FILE_FORMAT_WRITERS[SupportedFileFormats(file_format)](sink, schema)
+        except Exception as err:
+            errors[file_format] = err
+    rows = 0
+    for batch in batches:
+        for file_format, writer in list(writers.items()):
+            try:
+                writer.write(batch)
+            except Exception as err:
+                errors[file_format] = err
+                del writers[file_format]
+        rows += batch.num_rows
+    for file_format, writer in writers.items():
+        try:
+            writer.close()
+        except Exception as err:
+            errors[file_format] = err
+    return rows, errors
+
+# decode the CSV once and convert it to every requested format
+def stream_convert_many(source, sinks: dict, block_size: int = EXPORT_READ_BLOCK_SIZE, column_types: Optional[dict] = None) -> Tuple[int, dict]:
+    reader = open_csv_stream(source, block_size, column_types)
+    return convert_batches(reader.schema, reader, sinks)
+
+# convert a Parquet dataset (the files written by an Athena UNLOAD) without going through CSV, the column types of the
+# dataset are kept as is. Reads one row group at a time
+def parquet_convert_many(sources: list, sinks: dict) -> Tuple[int, dict]:
+    files = [pq.ParquetFile(source) for source in sources]
+    schema = files[0].schema_arrow
+    batches = (batch for file in files for batch in file.iter_batches())
+    return convert_batches(schema, batches, sinks)
+
+def stream_to_writer(source, writer_class, sink, block_size: int = EXPORT_READ_BLOCK_SIZE, column_types: Optional[dict] = None) -> int:
+    reader = open_csv_stream(source, block_size, column_types)
+    writer = writer_class(sink, reader.schema)
+    rows = 0
+    for batch in reader:
+        writer.write(batch)
+        rows += batch.num_rows
+    writer.close()
+    return rows
@@ -0,0 +1,131 @@
+from starlette.concurrency import run_in_threadpool
+from typing import Optional, Tuple
+import asyncio, fsspec, io, re, shutil, zlib
+
+from app.constants import *
+from app.converters import FILE_FORMAT_WRITERS, stream_to_writer
+
+# direct download of the small results: the result CSV is read from S3 and converted by the incremental writers of
+# app/converters.py straight into the HTTP response, without a Celery round trip. The conversion runs in a worker
+# thread and hands the bytes to the event loop in DIRECT_DOWNLOAD_CHUNK_SIZE chunks through a queue of at most
+# DIRECT_DOWNLOAD_QUEUE_CHUNKS chunks: the conversion waits for a slow client instead of buffering its output
+
+RANGE_REGEX = re.compile(r'bytes=(\d*)-(\d*)')
+
+class RangeNotSatisfiable(Exception):
+    def __init__(self, total: int):
+        super().__init__(f"Range not satisfiable, total length: {total}")
+        self.total = total
+
+def result_path(query_id: str) -> str:
+    return AWS_S3_OUTPUT_DIR + f'{query_id}.csv'
+
+class ChunkSink(io.RawIOBase):
+    # non seekable binary sink, coalesces the writes into chunks and queues them on the event loop, blocks the
+    # converting thread while the queue is full
+    def __init__(self, loop: asyncio.AbstractEventLoop, chunks: asyncio.Queue):
+        self.loop = loop
+        self.chunks = chunks
+        self.buffer = bytearray()
+        self.position = 0
+        self.cancelled = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        # the client went away, stops the conversion
+        if self.cancelled: raise BrokenPipeError("download cancelled")
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= DIRECT_DOWNLOAD_CHUNK_SIZE: self.flush()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        if self.buffer and not self.cancelled:
+            asyncio.run_coroutine_threadsafe(self.chunks.put(bytes(self.buffer)), self.loop).result()
+            self.buffer.clear()
+
+    # the writers close their sink, the end of the stream is signalled by convert instead
+    def close(self) -> None:
+        if not self.cancelled: self.flush()
+
+# column_types: the Athena column types of the result, see app/result_columns.py
+def convert(query_id: str, file_format: SupportedFileFormats, sink, column_types: Optional[dict] = None) -> None:
+    with fsspec.open(result_path(query_id), "rb") as source:
+        if file_format == SupportedFileFormats.csv: shutil.copyfileobj(source, sink, DIRECT_DOWNLOAD_CHUNK_SIZE)
+        else: stream_to_writer(source, FILE_FORMAT_WRITERS[file_format], sink, column_types=column_types)
+    sink.flush()
+
+# stream the converted result, gzip encoded if compress
+async def stream(query_id: str, file_format: SupportedFileFormats, compress: bool = False, column_types: Optional[dict] = None):
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(DIRECT_DOWNLOAD_QUEUE_CHUNKS)
+    sink = ChunkSink(loop, chunks)
+
+    async def produce() -> None:
+        try:
+            await run_in_threadpool(convert, query_id, file_format, sink, column_types)
+        except BrokenPipeError:
+            # stopped by the client going away
+            if not sink.cancelled: raise
+        finally:
+            await chunks.put(None)
+
+    task = asyncio.create_task(produce())
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None: break
+            yield compressor.compress(chunk) if compressor else chunk
+        # re-raises a conversion error, the response is then cut short instead of ending as if it were complete
+        await task
+        if compressor: yield compressor.flush()
+    finally:
+        sink.cancelled = True
+        # unblocks a conversion waiting for room in the queue, its next write stops it
+        while not chunks.empty(): chunks.get_nowait()
+
+def convert_to_bytes(query_id: str, file_format: SupportedFileFormats, column_types: Optional[dict] = None) -> bytes:
+    sink = io.BytesIO()
+    with fsspec.open(result_path(query_id), "rb") as source:
+        if file_format == SupportedFileFormats.csv: return source.read()
+        stream_to_writer(source, FILE_FORMAT_WRITERS[file_format], sink, column_types=column_types)
+    return sink.getvalue()
+
+def read_range(query_id: str, start: int, length: int) -> bytes:
+    with fsspec.open(result_path(query_id), "rb") as source:
+        source.seek(start)
+        return source.read(length)
+
+# (start, end) of a single byte range request, end included. None for a header which is not understood or a
+# multi-range request (the whole content is sent then), raises RangeNotSatisfiable
+def parse_range(header: str, total: int) -> Optional[Tuple[int, int]]:
+    match = RANGE_REGEX.fullmatch(header.strip())
+    if not match or not (match.group(1) or match.group(2)): return None
+    if not match.group(1):
+        suffix = int(match.group(2))
+        if not suffix or not total: raise RangeNotSatisfiable(total)
+        return max(total - suffix, 0), total - 1
+    start = int(match.group(1))
+    end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+    if start >= total or end < start: raise RangeNotSatisfiable(total)
+    return start, end
+
+# ((start, end), total length, bytes [start, end]) of the converted result, None if the whole content is to be sent.
+# The CSV is read with a ranged read, the other formats are converted up to the end of the result to know their total
+# length (results are small)
+async def read_content_range(query_id: str, file_format: SupportedFileFormats, header: str, csv_size: int, column_types: Optional[dict] = None) -> Optional[Tuple[Tuple[int, int], int, bytes]]:
+    if file_format == SupportedFileFormats.csv:
+        content_range = parse_range(header, csv_size)
+        if content_range is None: return None
+        start, end = content_range
+        return content_range, csv_size, await run_in_threadpool(read_range, query_id, start, end - start + 1)
+    content = await run_in_threadpool(convert_to_bytes, query_id, file_format, column_types)
+    content_range = parse_range(header, len(content))
+    if content_range is None: return None
+    return content_range, len(content), content[content_range[0]:content_range[1] + 1]
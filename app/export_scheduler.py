@@ -0,0 +1,60 @@
+from starlette.concurrency import run_in_threadpool
+from time import time
+from typing import List, Optional, Tuple, Union
+from uuid import uuid4
+import math
+
+from app import aws, cache
+from app.constants import *
+from app.lazy_modules import lazy_module
+
+# Celery is only needed once an export is enqueued
+tasks = lazy_module('app.tasks')
+
+# exports are routed to the fast lane or the bulk Celery queue by estimated cost, each queue is served by its own
+# worker pool. Waiting jobs are kept per queue in the sorted set export_queue:{queue} (score = enqueue time) with their
+# cost in the hash export_costs:{queue}, the per format export status is "QUEUED {queue} {job_id}" until a worker
+# picks the job up, which gives the queue position and ETA of every queued export
+
+def queue_key(queue: str) -> str:
+    return f'export_queue:{queue}'
+
+def costs_key(queue: str) -> str:
+    return f'export_costs:{queue}'
+
+def throughput_key(queue: str) -> str:
+    return f'export_throughput:{queue}'
+
+# export status cache key of a format, also the S3 key of the exported file. Built from the value of the format: format()
+# of a str Enum gives "SupportedFileFormats.tsv" instead of "tsv" on Python >= 3.11
+def export_cache_key(query_id: str, file_format: Union[SupportedFileFormats, str]) -> str:
+    return f'{query_id}.{SupportedFileFormats(file_format).value}'
+
+async def estimate_cost(query_id: str, file_formats: List[SupportedFileFormats], cost_factors: dict = EXPORT_FORMAT_COST_FACTORS) -> float:
+    result_size = (await aws.s3_client.head_object(Bucket='ensembl-athena-results', Key=f'{query_id}.csv'))['ContentLength']
+    return result_size * sum(cost_factors[SupportedFileFormats(file_format)] for file_format in file_formats)
+
+# df_input: the pre-signed URL of the result CSV, or the Parquet parts of an UNLOAD of the query for unload_compactor,
+# task: the name of the Celery task in app/tasks.py, column_types: the Athena column types of the result CSV
+async def enqueue(query_id: str, df_input: Union[str, List[str]], file_formats: List[SupportedFileFormats], request_id: str, task: str = 'file_format_converter', cost_factors: dict = EXPORT_FORMAT_COST_FACTORS, column_types: Optional[dict] = None) -> Tuple[str, str]:
+    cost = await estimate_cost(query_id, file_formats, cost_factors)
+    queue = EXPORT_FAST_QUEUE if cost <= EXPORT_FAST_LANE_MAX_COST else EXPORT_BULK_QUEUE
+    job_id = str(uuid4())
+    async with cache.client.pipeline(transaction=False) as pipe:
+        pipe.zadd(queue_key(queue), {job_id: time()}).hset(costs_key(queue), job_id, cost)
+        pipe.mset({export_cache_key(query_id, file_format): f"QUEUED {queue} {job_id}" for file_format in file_formats})
+        await pipe.execute()
+    # the broker publish is blocking network I/O (with retries), it runs off the event loop
+    await run_in_threadpool(getattr(tasks, task).apply_async, (query_id, df_input, file_formats, request_id, queue, job_id, cost), {'column_types': column_types} if column_types else {}, queue=queue)
+    return queue, job_id
+
+# 1-based position of the job in its queue and the estimated seconds until it is done, None once it left the queue
+async def position(queue: str, job_id: str) -> dict:
+    async with cache.client.pipeline(transaction=False) as pipe:
+        rank, throughput = await pipe.zrank(queue_key(queue), job_id).get(throughput_key(queue)).execute()
+    if rank is None: return {'queue': queue}
+    jobs = await cache.client.zrange(queue_key(queue), 0, rank)
+    costs = [float(cost or 0) for cost in await cache.client.hmget(costs_key(queue), jobs)] if jobs else []
+    throughput = float(throughput) if throughput else EXPORT_DEFAULT_THROUGHPUT
+    eta = sum(costs) / (throughput * EXPORT_QUEUE_CONCURRENCY[queue])
+    return {'queue': queue, 'position': rank + 1, 'eta_seconds': math.ceil(eta)}
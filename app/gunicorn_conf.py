@@ -0,0 +1,14 @@
+# startup optimized multi-worker API (Dockerfile.api): gunicorn -c app/gunicorn_conf.py app.main:app
+# the app is imported once in the master (preload_app) together with the dependencies it defers to first use (see
+# app/lazy_modules.py), then the uvicorn workers are forked from it and share the imported code copy-on-write. A new
+# worker only runs the startup hook (AWS clients, Redis pool, background tasks of app/main.py) before serving
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+def when_ready(server) -> None:
+    from app import lazy_modules
+    lazy_modules.preload()
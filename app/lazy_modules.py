@@ -0,0 +1,29 @@
+from types import ModuleType
+import gc, importlib
+
+# heavy dependencies (pyarrow, boto3) which are only needed by the previews, downloads, refinements and exports are
+# imported on the first attribute access instead of when the app is imported, so that a new API / Celery worker starts
+# serving without paying for them. preload imports them up front where the workers are forked from a preloaded parent
+# (app/gunicorn_conf.py, the Celery worker_init signal) so that they are shared copy-on-write instead
+
+_modules = []
+
+class LazyModule(ModuleType):
+    def __getattr__(self, attribute: str):
+        return getattr(load(self), attribute)
+
+# import the module behind a lazy module, the next attribute accesses go straight to its attributes
+def load(lazy: LazyModule) -> ModuleType:
+    module = importlib.import_module(lazy.__name__)
+    lazy.__dict__.update(module.__dict__)
+    return module
+
+def lazy_module(name: str) -> LazyModule:
+    lazy = LazyModule(name)
+    _modules.append(lazy)
+    return lazy
+
+def preload() -> None:
+    for lazy in _modules: load(lazy)
+    # the garbage collector of the forked workers leaves the preloaded objects (and their memory pages) alone
+    gc.freeze()
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+from app.constants import *
+
+# per process cache with a TTL, a size bound and LRU eviction
+class LocalCache:
+    def __init__(self, max_size: int = L1_CACHE_MAX_SIZE, ttl: float = L1_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # bumped on every clear, a value fetched before a clear is not stored after it (see put)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None: del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value: bytes, generation: Optional[int] = None) -> None:
+        if generation is not None and generation != self.generation: return
+        self.entries[key] = (monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.generation += 1
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,27 @@
+from logging.handlers import QueueHandler, QueueListener
+import atexit, logging, os, queue, random
+
+log_file = os.getenv("LOG_FILE", "log.txt")
+log_level = os.getenv("LOG_LEVEL", "DEBUG")
+# fraction of the records below WARNING which are kept, warnings and errors are always logged
+log_sample_rate = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+
+class SamplingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or log_sample_rate >= 1 or random.random() < log_sample_rate
+
+# the request path only puts the records on an in-memory queue, a background thread formats them and writes the file
+log_queue = queue.SimpleQueue()
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(module)s %(name)s %(message)s'))
+queue_handler = QueueHandler(log_queue)
+# QueueHandler.prepare formats the message once, the file handler adds the timestamp / level prefix
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+queue_handler.addFilter(SamplingFilter())
+logging.basicConfig(level=log_level, handlers=[queue_handler])
+
+listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+# a forked worker (app/gunicorn_conf.py) does not inherit the listener thread
+os.register_at_fork(after_in_child=listener.start)
@@ -2,25 +2,38 @@ from contextlib import suppress
 from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
-from pyathena import connect
-from time import time
-from typing import Optional
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from time import perf_counter
+from typing import List, Optional, Union
+from urllib.parse import urlencode
 from uuid import uuid4
-import pandas as pd
-import base64, boto3, json, logging, re, uvicorn
+import asyncio, base64, json, logging, uvicorn
 
+from app import aws, cache, catalog_index, download, export_scheduler, logging_setup, metrics, preview, query_scheduler, refinement, result_columns, status_tracker, unload
+from app.canonical import canonical_fields, canonical_query
 from app.constants import *
-from app.redis_setup import *
-from app.tasks import file_format_converter, delete_key_from_cache
 
-logging.basicConfig(filename="log.txt", level=logging.DEBUG, format='%(asctime)s %(levelname)s %(module)s %(name)s %(message)s')
 logger = logging.getLogger(__name__)
 
 app = FastAPI(debug=True)
 
-athena_client = boto3.client('athena')
-s3_client = boto3.client('s3')
+@app.on_event("startup")
+async def startup() -> None:
+    await aws.open_clients()
+    await cache.open_pool()
+    await status_tracker.start()
+    await query_scheduler.start()
+    await catalog_index.start()
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await status_tracker.stop()
+    await query_scheduler.stop()
+    await catalog_index.stop()
+    await aws.close_clients()
+    await cache.close_pool()
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,9 +46,13 @@ app.add_middleware(
 async def log_requests(request: Request, call_next) -> Response:
     request.state.id = str(uuid4())
 
-    start_time = time()
+    start_time = perf_counter()
     response = await call_next(request)
-    end_time = (time() - start_time) * 1000
+    end_time = (perf_counter() - start_time) * 1000
+
+    # label by the matched route (path template), not the raw path, to keep the number of series bounded
+    route = getattr(request.scope.get("endpoint"), "__name__", "unmatched")
+    metrics.request_latency.observe(end_time / 1000, route, request.method, response.status_code)
 
     logger.info(f"{request.state.id} {request.url.path}{f'?{str(request.query_params)}' if request.query_params else ''} Time={'{0:.2f}'.format(end_time)} ms status_code={response.status_code}")
 
@@ -46,8 +63,22 @@ def log_error(err: str, request: Request) -> None:
     logger.error(f"{request.state.id} {request.url.path}{f'?{str(request.query_params)}' if request.query_params else ''} err=\"{err}\"")
 
 def log_cache_hits(bool: bool, request: Request, cache_key: str = None) -> None:
+    if cache_key: metrics.cache_lookups.inc(metrics.cache_key_family(cache_key), 'hit' if bool else 'miss')
     logger.info(f"{request.state.id} {request.url.path}{f'?{str(request.query_params)}' if request.query_params else ''} cache={bool}{f' key={cache_key}' if cache_key else ''}")
 
+# serialize a catalog response once and keep the bytes in the L1 cache, generation is the L1 generation read before
+# fetching the content so that content fetched across an invalidation is not cached
+def catalog_response(l1_cache_key: str, content, generation: int) -> Response:
+    body = json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+    cache.l1.put(l1_cache_key, body, generation)
+    return Response(content=body, media_type="application/json")
+
+def l1_cached_response(l1_cache_key: str, request: Request) -> Optional[Response]:
+    body = cache.l1.get(l1_cache_key)
+    if body is None: return None
+    log_cache_hits(True, request, l1_cache_key)
+    return Response(content=body, media_type="application/json")
+
 # customise OpenAPI schema doc
 def custom_openapi():
     if app.openapi_schema: return app.openapi_schema
@@ -76,13 +107,8 @@ def query_id_validator(query_id: str):
     return True
 
 def cache_key_generator(data_type: str, species: str, fields: str = "", condition: str = ""):
-    # convert the string to lowercase except the values
-    condition = re.sub(r"\b(?<!')(\w+)(?!')\b", lambda match: match.group(1).lower(), condition)
-    # split the condition on white spaces to get a list of all conditions and keywords and sort it to identify if same conditions has been encountered before in a different positions in the query
-    condition_list = condition.split()
-    condition_list.sort()
-    sorted_condition = ''.join(condition_list)
-    cache_key_string = data_type + species + fields + sorted_condition
+    # equivalent queries (whitespace, keyword case, order of the AND / OR operands and of the fields) share one cache key
+    cache_key_string = canonical_query(data_type, species, fields, condition)
     return base64.b64encode(bytes(cache_key_string, 'utf-8'))
 
 @app.get("/",
@@ -115,20 +141,13 @@ def root():
          }
          )
 async def read_available_date_types(request: Request):
+    l1_response = l1_cached_response('data_types', request)
+    if l1_response: return l1_response
+    generation = cache.l1.generation
     try:
-        if(r.exists('data_types')):
-            data_types = json.loads(r.get('data_types').decode('ascii'))
-            log_cache_hits(True, request, 'data_types')
-        else:
-            data_types = []
-            query_response = athena_client.list_table_metadata(
-                CatalogName=AWS_DATA_CATALOG, DatabaseName=AWS_SCHEMA_DATABASE_NAME)["TableMetadataList"]
-            # remove unnecessary data from AWS response
-            for table in query_response:
-                data_types.append(table["Name"])
-            r.set('data_types', json.dumps(data_types))
-            log_cache_hits(False, request)
-        return data_types
+        data_types, fetched = await catalog_index.get_data_types()
+        log_cache_hits(not fetched, request, 'data_types')
+        return catalog_response('data_types', data_types, generation)
     except Exception as err:
         log_error(str(err), request)
         raise HTTPException(status_code=500) from err
@@ -169,33 +188,32 @@ async def read_available_date_types(request: Request):
                 }
             },
         },
+        503: {
+            "content": {
+                "application/json": {
+                    "example": {"detail": "The data type index is being built, please try again!"}
+                }
+            },
+        },
     }
 )
 async def read_available_filters_per_data_type(data_type: str, request: Request):
     data_type = data_type.strip()
     if not data_type: raise HTTPException(status_code=400, detail="Invalid data type!")
 
+    l1_cache_key = f'{data_type}_filters'
+    l1_response = l1_cached_response(l1_cache_key, request)
+    if l1_response: return l1_response
+    generation = cache.l1.generation
     try:
-        species_cache_key = f'{data_type}_species'
-        if r.exists(species_cache_key):
-            species = json.loads(r.get(species_cache_key).decode('ascii'))
-            log_cache_hits(True, request, species_cache_key)
-        else:
-            conn = connect(s3_staging_dir=AWS_S3_OUTPUT_DIR, schema_name=AWS_SCHEMA_DATABASE_NAME)
-            species = pd.read_sql_query(f"SELECT DISTINCT species from {data_type}", conn)["species"].tolist()
-            r.set(species_cache_key, json.dumps(species))
-            log_cache_hits(False, request)
-
-        table_metadata_cache_key = f'{data_type}_table_metadata'
-        if r.exists(table_metadata_cache_key):
-            table_metadata = json.loads(r.get(table_metadata_cache_key).decode('ascii'))
-            log_cache_hits(True, request, table_metadata_cache_key)
-        else:
-            table_metadata = athena_client.get_table_metadata(CatalogName=AWS_DATA_CATALOG, DatabaseName=AWS_SCHEMA_DATABASE_NAME, TableName=data_type)["TableMetadata"]["Columns"]
-            r.set(table_metadata_cache_key, json.dumps(table_metadata))
-            log_cache_hits(False, request)
+        # precomputed species / columns index, see app/catalog_index.py
+        entry, fetched = await catalog_index.get_entry(data_type)
+        log_cache_hits(not fetched, request, catalog_index.index_cache_key(data_type))
 
-        return {'columns': table_metadata, 'species': species}
+        return catalog_response(l1_cache_key, {'columns': entry['columns'], 'species': entry['species']}, generation)
+    except TimeoutError as err:
+        log_error(str(err), request)
+        raise HTTPException(status_code=503, detail="The data type index is being built, please try again!") from err
     except Exception as err:
         log_error(str(err), request)
         if "does not exist" in str(err): raise HTTPException(status_code=404, detail="Data type not found!") from err
@@ -218,19 +236,49 @@ async def read_available_filters_per_data_type(data_type: str, request: Request)
          }
          )
 async def read_available_result_file_formats(request: Request):
+    l1_response = l1_cached_response('result_file_formats', request)
+    if l1_response: return l1_response
+    generation = cache.l1.generation
     try:
-        if(r.exists('result_file_formats')):
+        result_file_formats = await cache.get_json('result_file_formats')
+        if result_file_formats is not None:
             log_cache_hits(True, request, 'result_file_formats')
-            return json.loads(r.get('result_file_formats').decode('ascii'))
         else:
-            r.set('result_file_formats', json.dumps(SUPPORTED_FILE_FORMATS))
-            log_cache_hits(False, request)
-            return SUPPORTED_FILE_FORMATS
+            result_file_formats = SUPPORTED_FILE_FORMATS
+            await cache.put_json('result_file_formats', result_file_formats)
+            log_cache_hits(False, request, 'result_file_formats')
+        return catalog_response('result_file_formats', result_file_formats, generation)
     except Exception as err:
         log_error(str(err), request)
         raise HTTPException(status_code=500) from err
 
 
+@app.get("/cache/stats",
+         responses={
+             200: {
+                 "content": {
+                     "application/json": {
+                         "example": {
+                             "l1": {"size": 3, "max_size": 1024, "ttl": 300, "hits": 120, "misses": 3, "evictions": 0}
+                         }
+                     }
+                 },
+             }
+         }
+         )
+async def read_cache_stats():
+    return {'l1': cache.l1.stats()}
+
+
+# Prometheus scrape endpoint, request latency / cache / AWS metrics are per API worker process, export metrics are
+# shared by all the Celery workers through Redis
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    lines = metrics.render() + metrics.render_local_cache(cache.l1.stats())
+    with suppress(Exception): lines += await metrics.render_export_metrics(cache.client, [file_format.value for file_format in SupportedFileFormats])
+    return PlainTextResponse('\n'.join(lines) + '\n', media_type="text/plain; version=0.0.4")
+
+
 @app.get(
     "/query/{query_id}/status",
     responses={
@@ -239,6 +287,7 @@ async def read_available_result_file_formats(request: Request):
                 "application/json": {
                     "example": {
                         "status": "'QUEUED'|'RUNNING'|'SUCCEEDED'|'FAILED'|'CANCELLED'",
+                        "position": "2 (1-based position in the submission queue, available only while the query waits for a free Athena slot)",
                         "result": "https://example.com/?expiry=1hr (Available only if status='SUCCEEDED')"
                     }
                 }
@@ -247,7 +296,8 @@ async def read_available_result_file_formats(request: Request):
         400: {
             "content": {
                 "application/json": {
-                    "example": {"detail": "Invalid query id!"}
+                    "example": {"detail_example_1": "Invalid query id!",
+                                "detail_example_2": f"Allowed range for wait is 0-{MAX_STATUS_WAIT_TIME}!"}
                 }
             },
         },
@@ -260,16 +310,28 @@ async def read_available_result_file_formats(request: Request):
         },
     }
 )
-async def query_status(query_id: str, request: Request):
+async def query_status(query_id: str, request: Request, wait: int = Query(
+        default=0,
+        description="Long-poll: hold the request for up to this many seconds until the status changes",
+    )
+):
     query_id = query_id.strip()
     if not query_id_validator(query_id): raise HTTPException(status_code=400, detail="Invalid query id!")
+    if wait>MAX_STATUS_WAIT_TIME or wait<0: raise HTTPException(status_code=400, detail=f"Allowed range for wait is 0-{MAX_STATUS_WAIT_TIME}!")
     try:
         # 'State': 'QUEUED'|'RUNNING'|'SUCCEEDED'|'FAILED'|'CANCELLED'
-        query_response = athena_client.get_query_execution( QueryExecutionId = query_id )
-        if query_response['QueryExecution']['Status']['State'] != 'SUCCEEDED':
-            return {'status': query_response['QueryExecution']['Status']['State']}
+        query_id, state = await status_tracker.resolve(query_id)
+        if await status_tracker.wait_for_change(query_id, state, wait) != state:
+            # a ticket might have been submitted meanwhile as well
+            query_id, state = await status_tracker.resolve(query_id)
+        if state == 'QUEUED':
+            # waiting for a free Athena slot (ticket), position in the submission queue
+            queue_position = await query_scheduler.position(query_id)
+            return {'status': state, 'position': queue_position} if queue_position else {'status': state}
+        if state != 'SUCCEEDED':
+            return {'status': state}
         # fetch temporary pre-signed S3 result object URL (expiry = 1hr)
-        result_file_temp_presigned_url = s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': f'{query_id}.csv'}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME)
+        result_file_temp_presigned_url = await aws.s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': f'{query_id}.csv'}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME)
         return {'status': 'SUCCEEDED', 'result': result_file_temp_presigned_url}
     except Exception as err:
         log_error(str(err), request)
@@ -285,6 +347,9 @@ async def query_status(query_id: str, request: Request):
                 "application/json": {
                     "example": {
                         "status": "ACCEPTED",
+                        "queue": "exports_fast",
+                        "position": 3,
+                        "eta_seconds": 42
                     }
                 }
             },
@@ -293,8 +358,16 @@ async def query_status(query_id: str, request: Request):
             "content": {
                 "application/json": {
                     "example": {
-                        "status": "'PROCESSING' | 'DONE' | 'FAILED, you can try again after one minute interval!'",
-                        "result": "https://example.com/?expiry=1hr (Available only if export status='DONE')"
+                        "status": "'UNLOADING' | 'QUEUED' | 'PROCESSING' | 'DONE' | 'FAILED, you can try again after one minute interval!'",
+                        "result": "https://example.com/?expiry=1hr (Available only if export status='DONE')",
+                        "queue": "exports_bulk (Available only if export status='QUEUED')",
+                        "position": "1 (1-based position in the queue, available only if export status='QUEUED')",
+                        "eta_seconds": "120 (Available only if export status='QUEUED')",
+                        "parts": ["https://example.com/?expiry=1hr (Parquet files of the Athena UNLOAD of the query, available only for parquet once the UNLOAD succeeded)"],
+                        "formats (only if several file formats are requested)": {
+                            "parquet": {"status": "DONE", "result": "https://example.com/?expiry=1hr"},
+                            "tsv": {"status": "ACCEPTED"}
+                        }
                     }
                 }
             },
@@ -317,13 +390,17 @@ async def query_status(query_id: str, request: Request):
         }
     }
 )
-async def export_query_result(query_id: str, request: Request, file_format: SupportedFileFormats):
+async def export_query_result(query_id: str, request: Request, file_format: List[SupportedFileFormats] = Query(
+        ...,
+        description="Result file format, repeat the parameter to export several formats from a single read of the result ex.: file_format=parquet&file_format=tsv",
+    )
+):
     # validate query_id and query execution status state
     query_id = query_id.strip()
     if not query_id_validator(query_id): raise HTTPException(status_code=400, detail="Invalid query id!")
     try:
-        query_response = athena_client.get_query_execution( QueryExecutionId = query_id )
-        if query_response['QueryExecution']['Status']['State'] != 'SUCCEEDED':
+        query_id, state = await status_tracker.resolve(query_id)
+        if state != 'SUCCEEDED':
             raise Exception("Cannot export (NOTE: Result can only be exported, if query execution status state = SUCCEEDED).")
     except Exception as err:
         log_error(str(err), request)
@@ -333,35 +410,142 @@ async def export_query_result(query_id: str, request: Request, file_format: Supp
             raise HTTPException(status_code=404, detail="Query ID not found!") from err
         raise HTTPException(status_code=500) from err
 
+    file_formats = list(dict.fromkeys(file_format))
+    try:
+        export_statuses = dict(zip(file_formats, await asyncio.gather(*(export_status(query_id, file_format, request.state.id) for file_format in file_formats))))
+        # convert all the formats which are not exported / in progress yet with one task, from one read of the result
+        pending_file_formats = [file_format for file_format, status in export_statuses.items() if status is None]
+        # parquet / feather straight from an Athena UNLOAD of the query, see app/unload.py
+        unload_file_formats = await unload.unload_file_formats(query_id, pending_file_formats)
+        if unload_file_formats:
+            await unload.start(query_id, unload_file_formats, request.state.id)
+            export_statuses.update({file_format: {"status": "ACCEPTED"} for file_format in unload_file_formats})
+        converted_file_formats = [file_format for file_format in pending_file_formats if file_format not in unload_file_formats]
+        if converted_file_formats:
+            df_input = await aws.s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': f'{query_id}.csv'}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME)
+            queue, job_id = await export_scheduler.enqueue(query_id, df_input, converted_file_formats, request.state.id, column_types=await result_columns.get(query_id))
+            job_position = await export_scheduler.position(queue, job_id)
+            export_statuses.update({file_format: {"status": "ACCEPTED", **job_position} for file_format in converted_file_formats})
+    except Exception as err:
+        log_error(str(err), request)
+        raise HTTPException(status_code=500) from err
+
+    status_code = 202 if pending_file_formats else 200
+    if len(file_formats) == 1: return JSONResponse(content=export_statuses[file_formats[0]], status_code=status_code)
+    return JSONResponse(content={'formats': {file_format.value: status for file_format, status in export_statuses.items()}}, status_code=status_code)
+
+# status of an exported file format, None if it is neither exported nor being exported
+async def export_status(query_id: str, file_format: SupportedFileFormats, request_id: str) -> Optional[dict]:
+    export_status = await stored_export_status(query_id, file_format, request_id)
+    # the Parquet files of the UNLOAD are usable as a dataset before (and after) their compaction into a single file
+    if export_status is not None and file_format == SupportedFileFormats.parquet and export_status['status'] != 'UNLOADING':
+        parts = await unload.manifest_parts(query_id)
+        if parts is not None: export_status['parts'] = parts
+    return export_status
+
+async def stored_export_status(query_id: str, file_format: SupportedFileFormats, request_id: str) -> Optional[dict]:
+    cache_key = export_scheduler.export_cache_key(query_id, file_format)
     try:
         # validate if file exists in S3
-        s3_client.head_object(Bucket='ensembl-athena-results', Key=f'{query_id}.{file_format}')
-        result_file_temp_presigned_url = s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': f'{query_id}.{file_format}'}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME)
+        await aws.s3_client.head_object(Bucket='ensembl-athena-results', Key=cache_key)
+        result_file_temp_presigned_url = await aws.s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': cache_key}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME)
         return {'status': "DONE", 'result': result_file_temp_presigned_url}
     except Exception as err:
-        if "An error occurred (404) when calling the HeadObject operation: Not Found" in str(err):
-            try:
-                cache_key = f"{query_id}.{file_format}"
-                if(r.exists(cache_key) and r.get(cache_key).decode('ascii') == "QUEUED"): return {"status": "QUEUED"}
-                if(r.exists(cache_key) and r.get(cache_key).decode('ascii') == "PROCESSING"): return {"status": "PROCESSING"}
-                if(r.exists(cache_key) and r.get(cache_key).decode('ascii') == "FAILED"):
-                    # delete key after one minute
-                    delete_key_from_cache.delay(cache_key, 60)
-                    return {"status": "FAILED, you can try again after one minute interval!"}
-                # start a background process with csv result file as input
-                df_input = s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': f'{query_id}.csv'}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME)
-                file_format_converter.delay(query_id, df_input, file_format, cache_key, request.state.id)
-                r.set(cache_key, "QUEUED")
-                return JSONResponse(content={"status": "ACCEPTED"}, status_code=202)
-            except Exception as e:
-                log_error(str(e), request)
+        if "An error occurred (404) when calling the HeadObject operation: Not Found" not in str(err): raise
+
+    export_status = await cache.get(cache_key)
+    if(export_status is None): return None
+    if(export_status.startswith("UNLOADING")):
+        # "UNLOADING {unload_query_id}"
+        return await unload.status(query_id, export_status.split()[1], request_id)
+    # plain "QUEUED" for an export enqueued before the export queues existed, it has no position
+    if(export_status == "QUEUED"): return {"status": "QUEUED"}
+    if(export_status.startswith("QUEUED")):
+        # "QUEUED {queue} {job_id}"
+        _, queue, job_id = export_status.split()
+        return {"status": "QUEUED", **await export_scheduler.position(queue, job_id)}
+    if(export_status == "PROCESSING"): return {"status": "PROCESSING"}
+    # the FAILED status expires after EXPORT_FAILED_RETRY_INTERVAL (one minute)
+    if(export_status == "FAILED"): return {"status": "FAILED, you can try again after one minute interval!"}
+    return None
+
+
+@app.get(
+    "/query/{query_id}/download",
+    response_class=StreamingResponse,
+    responses={
+        200: {"description": "The result converted to the requested file format, gzip encoded for the text formats if accepted by the client"},
+        206: {"description": "The requested byte range of the converted result (single range)"},
+        303: {"description": f"The result is bigger than {DIRECT_DOWNLOAD_MAX_BYTES} bytes, redirects to the export endpoint"},
+        400: {
+            "content": {
+                "application/json": {
+                    "example": {"detail_example_1": "Invalid query id!",
+                                "detail_example_2": "Cannot download (NOTE: Result can only be downloaded, if query execution status state = SUCCEEDED)."}
+                }
+            },
+        },
+        404: {
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Query ID not found!"}
+                }
+            },
+        },
+        416: {"description": "The requested byte range is not satisfiable"},
+    }
+)
+async def download_query_result(query_id: str, request: Request, file_format: SupportedFileFormats = Query(
+        SupportedFileFormats.csv,
+        description="Result file format",
+    )
+):
+    query_id = query_id.strip()
+    if not query_id_validator(query_id): raise HTTPException(status_code=400, detail="Invalid query id!")
+    try:
+        query_id, state = await status_tracker.resolve(query_id)
+        if state != 'SUCCEEDED':
+            raise Exception("Cannot download (NOTE: Result can only be downloaded, if query execution status state = SUCCEEDED).")
+        csv_size = (await aws.s3_client.head_object(Bucket='ensembl-athena-results', Key=f'{query_id}.csv'))['ContentLength']
+    except Exception as err:
+        log_error(str(err), request)
+        if "Cannot download" in str(err):
+            raise HTTPException(status_code=400, detail=str(err)) from err
+        elif "was not found" in str(err) or "Not Found" in str(err):
+            raise HTTPException(status_code=404, detail="Query ID not found!") from err
         raise HTTPException(status_code=500) from err
 
+    # big results go through the Celery export (conversion off the API workers, object kept in S3)
+    if csv_size > DIRECT_DOWNLOAD_MAX_BYTES:
+        return RedirectResponse(app.url_path_for('export_query_result', query_id=query_id) + f'?file_format={file_format.value}', status_code=303)
+
+    column_types = await result_columns.get(query_id) if file_format != SupportedFileFormats.csv else None
+    headers = {'Content-Disposition': f'attachment; filename="{query_id}.{file_format.value}"', 'Vary': 'Accept-Encoding', 'Accept-Ranges': 'bytes'}
+    range_header = request.headers.get('range')
+    if range_header:
+        try:
+            content_range = await download.read_content_range(query_id, file_format, range_header, csv_size, column_types)
+        except download.RangeNotSatisfiable as err:
+            return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{err.total}'})
+        except Exception as err:
+            log_error(str(err), request)
+            raise HTTPException(status_code=500) from err
+        if content_range is not None:
+            (start, end), total, content = content_range
+            return Response(content=content, status_code=206, media_type=FILE_FORMAT_MEDIA_TYPES[file_format], headers={**headers, 'Content-Range': f'bytes {start}-{end}/{total}'})
+
+    compress = file_format in COMPRESSIBLE_FILE_FORMATS and 'gzip' in request.headers.get('accept-encoding', '')
+    if compress: headers['Content-Encoding'] = 'gzip'
+    # the size is only known up front for the uncompressed CSV, the other responses use chunked transfer encoding
+    elif file_format == SupportedFileFormats.csv: headers['Content-Length'] = str(csv_size)
+    return StreamingResponse(download.stream(query_id, file_format, compress, column_types), media_type=FILE_FORMAT_MEDIA_TYPES[file_format], headers=headers)
+
 
 @app.get(
     "/query/{query_id}/preview",
     responses={
         200: {
+            "description": f"A page of the result, the values as returned by Athena. TotalRows is absent while the preview of a new result is prepared, only the first {PREVIEW_ATHENA_MAX_ROWS - 1} rows can be paged (without sort / species) until then",
             "content": {
                 "application/json": {
                     "example": {
@@ -380,7 +564,8 @@ async def export_query_result(query_id: str, request: Request, file_format: Supp
                                     }
                                 ]
                             }
-                        ]
+                        ],
+                        "TotalRows": 1
                     }
                 }
             },
@@ -390,7 +575,9 @@ async def export_query_result(query_id: str, request: Request, file_format: Supp
                 "application/json": {
                     "example": {"detail_example_1": "Cannot retrieve result preview (NOTE: Result preview is only available, if query execution status state = SUCCEEDED).",
                                 "detail_example_2": "Invalid query id!",
-                                "detail_example_3": "Allowed range for maxResults is 1-1000!"}
+                                "detail_example_3": "Allowed range for maxResults is 1-1000!",
+                                "detail_example_4": "Invalid offset!",
+                                "detail_example_5": "Unknown column: column_name"}
                 }
             },
         },
@@ -403,18 +590,35 @@ async def export_query_result(query_id: str, request: Request, file_format: Supp
         }
     }
 )
-async def query_result_preview(query_id: str, request: Request, maxResults: int = 26):
+async def query_result_preview(query_id: str, request: Request, maxResults: int = 26, offset: int = 0, columns: Optional[str] = Query(
+        default=None,
+        description="Comma seperated columns to include ex.: gene_id,gene_stable_id",
+    ), sort: Optional[str] = Query(
+        default=None,
+        description="Column to sort the rows on, prefix with '-' for descending order ex.: -gene_id",
+    ), species: Optional[str] = Query(
+        default=None,
+        description="Only return the rows of this species (results of merged batch queries) ex.: homo_sapiens",
+    )
+):
     query_id = query_id.strip()
     if not query_id_validator(query_id): raise HTTPException(status_code=400, detail="Invalid query id!")
     if maxResults>1000 or maxResults<1: raise HTTPException(status_code=400, detail="Allowed range for maxResults is 1-1000!")
+    if offset<0: raise HTTPException(status_code=400, detail="Invalid offset!")
     try:
-        query_response = athena_client.get_query_results(
-            QueryExecutionId=query_id,
-            MaxResults=maxResults
-        )
-        # remove unnecessary data from AWS response
-        del query_response['ResultSet']['ResultSetMetadata']
-        return query_response['ResultSet']
+        query_id, state = await status_tracker.resolve(query_id)
+        if state != 'SUCCEEDED':
+            raise Exception("InvalidRequestException: query has not succeeded")
+        selected_columns = [column.strip() for column in columns.split(',') if column.strip()] if columns else None
+        # the first rows in Athena order come from Athena while the sidecar is built, a locally refined query only has
+        # its result CSV
+        sidecar_path = await preview.sidecar(query_id, wait=False)
+        if sidecar_path is None and not sort and not species and offset + maxResults < PREVIEW_ATHENA_MAX_ROWS and not await cache.client.exists(refinement.parent_cache_key(query_id)):
+            return await preview.athena_page(query_id, offset, maxResults, selected_columns)
+        sidecar_path = await preview.sidecar(query_id)
+        return await run_in_threadpool(preview.read_page, query_id, sidecar_path, offset, maxResults, selected_columns, sort, species.strip() if species else None, await result_columns.get(query_id) if sort else None)
+    except preview.UnknownColumn as err:
+        raise HTTPException(status_code=400, detail=f"Unknown column: {err.args[0]}") from err
     except Exception as err:
         log_error(str(err), request)
         if "InvalidRequestException" in str(err):
@@ -424,6 +628,35 @@ async def query_result_preview(query_id: str, request: Request, maxResults: int
         raise HTTPException(status_code=500) from err
 
 
+def query_links(query_id: str, self_href: str) -> dict:
+    return {
+        'self': {'href': self_href},
+        'status': {'href': app.url_path_for('query_status', query_id=query_id)},
+        'preview': {'href': app.url_path_for('query_result_preview', query_id=query_id)},
+        'export': {'href': app.url_path_for('export_query_result', query_id=query_id), "supported_file_formats": SUPPORTED_FILE_FORMATS},
+        'download': {'href': app.url_path_for('download_query_result', query_id=query_id), "supported_file_formats": SUPPORTED_FILE_FORMATS}
+    }
+
+# species: a single species or a list of species scanned together. Returns the query ID, or the ID of a ticket QUEUED
+# until Athena has a free slot for the query (app/query_scheduler.py)
+async def start_query(data_type: str, species: Union[str, List[str]], fields: str, condition: str, cache_key: bytes) -> str:
+    # a narrower version of a query which already succeeded is answered from its result, see app/refinement.py
+    if isinstance(species, str):
+        query_id = await refinement.start(data_type, species, fields, condition)
+        if query_id is not None: return query_id
+    filters = "AND " + condition if condition else ""
+    species_filter = f"species='{species}'" if isinstance(species, str) else "species IN (" + ", ".join(f"'{name}'" for name in species) + ")"
+    spec = {
+        'query': f"SELECT {fields} FROM {data_type} WHERE {species_filter} {filters};",
+        'cache_key': cache_key.decode('ascii'),
+        # a merged query is also the source of the refinements of each of its species
+        'refinement': [data_type, species, fields, condition],
+    }
+    # filtered single species queries are the interactive ones, full scans and merged species scans wait behind them
+    priority = QUERY_PRIORITY_INTERACTIVE if condition and condition.strip() and isinstance(species, str) else QUERY_PRIORITY_BULK
+    return await query_scheduler.submit(spec, priority)
+
+
 @app.get(
     "/query/{data_type}/{species}",
     response_class=Response,
@@ -454,6 +687,13 @@ async def query_result_preview(query_id: str, request: Request, maxResults: int
                     "example": {"detail": "Invalid data_type/species!"}
                 }
             },
+        },
+        503: {
+            "content": {
+                "application/json": {
+                    "example": {"detail": "An identical query is being submitted, please try again!"}
+                }
+            },
         }
     }
 )
@@ -470,38 +710,149 @@ async def request_query(data_type: str, species: str, request: Request, fields:
     if ((not data_type) or (not species)): raise HTTPException(status_code=400, detail="Invalid data_type/species!")
     try:
         cache_key = cache_key_generator(data_type, species, fields, condition)
-        if(r.exists(cache_key)):
-            query_id = r.get(cache_key).decode('ascii')
-            log_cache_hits(True, request, cache_key)
-        else:
-            filters = "AND " + condition if condition else ""
-            query_id = athena_client.start_query_execution(
-                QueryString = f"SELECT {fields} FROM {data_type} WHERE species='{species}' {filters};",
-                QueryExecutionContext = {"Database": AWS_SCHEMA_DATABASE_NAME},
-                ResultConfiguration = {
-                    "OutputLocation": AWS_S3_OUTPUT_DIR,
-                    "EncryptionConfiguration": {"EncryptionOption": "SSE_S3"},
-                },
-            )["QueryExecutionId"]
-            r.set(cache_key, query_id)
-            # automatically expire/delete redis cache keys after 44 days as the query ID in Athena history is retained for 45 days
-            r.expire(cache_key, 3801600)
-            log_cache_hits(False, request)
+        # concurrent identical submissions (across all workers) wait for and share the first one's query ID
+        query_id, created = await cache.single_flight(cache_key, lambda: start_query(data_type, species, fields, condition, cache_key), QUERY_ID_CACHE_TTL)
+        if created: log_cache_hits(False, request, cache_key)
+        else: log_cache_hits(True, request, cache_key)
 
         # https://tools.ietf.org/id/draft-kelly-json-hal-01.html
         return JSONResponse(content={
             'query_id': query_id,
-            '_links': {
-                'self': {'href': str(request.url.path)},
-                'status': {'href': app.url_path_for('query_status', query_id=query_id)},
-                'preview': {'href': app.url_path_for('query_result_preview', query_id=query_id)},
-                'export': {'href': app.url_path_for('export_query_result', query_id=query_id), "supported_file_formats": SUPPORTED_FILE_FORMATS}
-            }
+            '_links': query_links(query_id, str(request.url.path))
         }, media_type="application/hal+json")
+    except TimeoutError as err:
+        log_error(str(err), request)
+        raise HTTPException(status_code=503, detail="An identical query is being submitted, please try again!") from err
     except Exception as err:
         log_error(str(err), request)
         raise HTTPException(status_code=500) from err
 
 
+class BatchQuerySpec(BaseModel):
+    data_type: str
+    species: List[str]
+    fields: str = "*"
+    condition: str = ""
+    # scan all species of the spec with one `species IN (...)` query or submit one query per species, decided by
+    # merge_species when not given
+    merge: Optional[bool] = None
+
+class BatchQueryRequest(BaseModel):
+    queries: List[BatchQuerySpec]
+
+
+# whether the species of a batch spec are scanned by one species IN (...) query instead of one query per species
+async def merge_species(data_type: str, species: List[str], fields: str, condition: str) -> bool:
+    if len(species) == 1: return False
+    # single species queries already submitted are reused as they are
+    if await cache.client.exists(*[cache_key_generator(data_type, name, fields, condition) for name in species]) == len(species): return False
+    try:
+        entry, _ = await catalog_index.get_entry(data_type)
+    except Exception:
+        # unknown data type, reported by the submission
+        return True
+    # every query scans a table not partitioned by species in full, one scan for all species
+    if not entry.get('species_partitioned'): return True
+    # partition pruning reads the same data either way: unfiltered scans (big results, exported per species) and a few
+    # species keep one query per species, many filtered species share one Athena slot
+    return bool(condition and condition.strip()) and len(species) > BATCH_FANOUT_MAX_SPECIES
+
+@app.post(
+    "/query/batch",
+    response_class=Response,
+    responses={
+        200: {
+            "content": {
+                "application/hal+json": {
+                    "example": {
+                        "queries": [
+                            {
+                                "data_type": "gene",
+                                "species": ["homo_sapiens", "mus_musculus"],
+                                "query_id": "abc-1234567890-xyz",
+                                "merged": True,
+                                "_links": {
+                                    "status": {"href": "/query/abc-1234567890-xyz/status"},
+                                    "preview": {"href": "/query/abc-1234567890-xyz/preview"},
+                                    "export": {"href": "/query/abc-1234567890-xyz/export"}
+                                },
+                                "species_results": {
+                                    "homo_sapiens": {
+                                        "preview": {"href": "/query/abc-1234567890-xyz/preview?species=homo_sapiens"},
+                                        "query": {"href": "/query/gene/homo_sapiens?fields=%2A&condition="}
+                                    }
+                                }
+                            },
+                            {
+                                "data_type": "gene",
+                                "species": ["danio_rerio"],
+                                "error": "Query submission failed!"
+                            }
+                        ]
+                    }
+                }
+            },
+        },
+        400: {
+            "content": {
+                "application/json": {
+                    "example": {"detail_example_1": f"Allowed number of queries per batch is 1-{BATCH_MAX_QUERIES}!",
+                                "detail_example_2": f"Allowed number of species per query is 1-{BATCH_MAX_SPECIES}!",
+                                "detail_example_3": "Invalid data_type/species!"}
+                }
+            },
+        }
+    }
+)
+async def request_query_batch(batch: BatchQueryRequest, request: Request):
+    if not 1 <= len(batch.queries) <= BATCH_MAX_QUERIES: raise HTTPException(status_code=400, detail=f"Allowed number of queries per batch is 1-{BATCH_MAX_QUERIES}!")
+    submissions = []
+    for spec in batch.queries:
+        data_type = spec.data_type.strip()
+        species = sorted({name.strip() for name in spec.species if name.strip()})
+        if not 1 <= len(species) <= BATCH_MAX_SPECIES: raise HTTPException(status_code=400, detail=f"Allowed number of species per query is 1-{BATCH_MAX_SPECIES}!")
+        if not data_type: raise HTTPException(status_code=400, detail="Invalid data_type/species!")
+        merge = spec.merge if spec.merge is not None else await merge_species(data_type, species, spec.fields, spec.condition)
+        if len(species) > 1 and merge:
+            # the species column is needed to tell the species apart in the merged result
+            fields = spec.fields if canonical_fields(spec.fields) == '*' or 'species' in canonical_fields(spec.fields).split(',') else f"{spec.fields},species"
+            submissions.append((data_type, species, fields, spec.condition, spec.fields))
+        else:
+            submissions.extend((data_type, name, spec.fields, spec.condition, spec.fields) for name in species)
+
+    semaphore = asyncio.Semaphore(BATCH_SUBMIT_CONCURRENCY)
+    async def submit(data_type: str, species: Union[str, List[str]], fields: str, condition: str, requested_fields: str) -> dict:
+        merged = not isinstance(species, str)
+        result = {'data_type': data_type, 'species': species if merged else [species]}
+        try:
+            async with semaphore:
+                cache_key = cache_key_generator(data_type, ','.join(species) if merged else species, fields, condition)
+                query_id, created = await cache.single_flight(cache_key, lambda: start_query(data_type, species, fields, condition, cache_key), QUERY_ID_CACHE_TTL)
+            if created: log_cache_hits(False, request, cache_key)
+            else: log_cache_hits(True, request, cache_key)
+        except Exception as err:
+            log_error(str(err), request)
+            result['error'] = "Query submission failed!"
+            return result
+        result.update({'query_id': query_id, 'merged': merged, '_links': query_links(query_id, str(request.url.path))})
+        if merged:
+            # the rows of a species: previewed from the merged result, or a query of its own (status / preview / export
+            # / download) which is filtered from the merged result once it SUCCEEDED (see app/refinement.py, for a
+            # merged result up to REFINEMENT_MAX_BYTES, otherwise it runs on Athena)
+            preview_href = app.url_path_for('query_result_preview', query_id=query_id)
+            parameters = urlencode({'fields': requested_fields, 'condition': condition})
+            result['species_results'] = {name: {
+                'preview': {'href': f"{preview_href}?{urlencode({'species': name})}"},
+                'query': {'href': f"{app.url_path_for('request_query', data_type=data_type, species=name)}?{parameters}"},
+            } for name in species}
+        return result
+
+    results = await asyncio.gather(*(submit(*submission) for submission in submissions))
+    return JSONResponse(content={
+        'queries': results,
+        '_links': {'self': {'href': str(request.url.path)}}
+    }, media_type="application/hal+json")
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,122 @@
+from bisect import bisect_left
+from time import perf_counter
+import math
+
+# in-process metrics rendered in the Prometheus text exposition format on /metrics. Export metrics are recorded by the
+# Celery workers into Redis hashes (observe_export) and read back at scrape time, so they cover every worker
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+EXPORT_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+EXPORT_SIZE_BUCKETS = tuple(1024 ** 2 * size for size in (1, 10, 100, 500, 1024, 5 * 1024, 10 * 1024, 50 * 1024))
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'SlowDown', 'RequestLimitExceeded'}
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in zip(names, values)]
+    if extra: labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def format_bucket(bucket: float) -> str:
+    return '+Inf' if math.isinf(bucket) else f'{bucket:.12g}'
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{format_labels(self.labels, label_values)} {value:.12g}' for label_values, value in self.values.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets) + (math.inf,)
+        # label values -> [count per bucket (not cumulative)..., sum]
+        self.values = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        counts = self.values.setdefault(label_values, [0] * len(self.buckets) + [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, counts in self.values.items():
+            lines.extend(render_histogram(self.name, self.labels, label_values, self.buckets, counts[:-1], counts[-1]))
+        return lines
+
+def render_histogram(name: str, labels: tuple, label_values: tuple, buckets: tuple, counts: list, total: float) -> list:
+    lines, cumulative = [], 0
+    for bucket, count in zip(buckets, counts):
+        cumulative += count
+        le = 'le="' + format_bucket(bucket) + '"'
+        lines.append(f'{name}_bucket{format_labels(labels, label_values, le)} {cumulative}')
+    lines.append(f'{name}_sum{format_labels(labels, label_values)} {total:.12g}')
+    lines.append(f'{name}_count{format_labels(labels, label_values)} {cumulative}')
+    return lines
+
+
+request_latency = Histogram('http_request_duration_seconds', 'HTTP request latency per route', ('route', 'method', 'status_code'))
+cache_lookups = Counter('cache_lookups_total', 'Cache lookups per key family and result', ('family', 'result'))
+aws_call_latency = Histogram('aws_call_duration_seconds', 'AWS API call latency per operation', ('service', 'operation'))
+aws_throttled_calls = Counter('aws_throttled_calls_total', 'AWS API calls rejected by throttling per operation', ('service', 'operation'))
+
+def cache_key_family(cache_key) -> str:
+    # query cache keys are base64 encoded canonical queries
+    if isinstance(cache_key, bytes): return 'query_id'
+    if ':' in cache_key: return cache_key.split(':')[0]
+    if cache_key.endswith('_filters'): return 'filters'
+    return cache_key
+
+# botocore event handlers, registered on the shared aiobotocore clients (see aws.open_clients)
+def aws_before_call(model, context: dict, **kwargs) -> None:
+    context['metrics_start_time'] = perf_counter()
+
+def aws_after_call(model, parsed: dict, context: dict, **kwargs) -> None:
+    service = model.service_model.service_name
+    if 'metrics_start_time' in context: aws_call_latency.observe(perf_counter() - context['metrics_start_time'], service, model.name)
+    if parsed.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES: aws_throttled_calls.inc(service, model.name)
+
+def export_metrics_key(metric: str, file_format: str) -> str:
+    return f'metrics:{metric}:{file_format}'
+
+# called by the Celery workers with the synchronous Redis client, one hash per metric and file format holding the
+# (non cumulative) bucket counts and the sum
+def observe_export(r, file_format: str, duration: float, size: int) -> None:
+    pipe = r.pipeline(transaction=False)
+    for metric, buckets, value in (('export_duration_seconds', EXPORT_DURATION_BUCKETS, duration), ('export_size_bytes', EXPORT_SIZE_BUCKETS, size)):
+        key = export_metrics_key(metric, file_format)
+        pipe.hincrby(key, format_bucket((tuple(buckets) + (math.inf,))[bisect_left(buckets, value)]), 1)
+        pipe.hincrbyfloat(key, 'sum', value)
+    pipe.execute()
+
+async def render_export_metrics(client, file_formats: list) -> list:
+    lines = []
+    async with client.pipeline(transaction=False) as pipe:
+        for metric in ('export_duration_seconds', 'export_size_bytes'):
+            for file_format in file_formats: pipe.hgetall(export_metrics_key(metric, file_format))
+        values = await pipe.execute()
+    for i, (metric, buckets, help) in enumerate((('export_duration_seconds', EXPORT_DURATION_BUCKETS, 'Celery export duration per file format'), ('export_size_bytes', EXPORT_SIZE_BUCKETS, 'Exported file size per file format'))):
+        lines.extend([f'# HELP {metric} {help}', f'# TYPE {metric} histogram'])
+        buckets = tuple(buckets) + (math.inf,)
+        for file_format, hash in zip(file_formats, values[i * len(file_formats):(i + 1) * len(file_formats)]):
+            if not hash: continue
+            hash = {field.decode('ascii'): float(value) for field, value in hash.items()}
+            counts = [int(hash.get(format_bucket(bucket), 0)) for bucket in buckets]
+            lines.extend(render_histogram(metric, ('file_format',), (file_format,), buckets, counts, hash.get('sum', 0.0)))
+    return lines
+
+def render_local_cache(stats: dict) -> list:
+    lines = []
+    for name in ('hits', 'misses', 'evictions'):
+        lines.extend([f'# HELP l1_cache_{name}_total L1 catalog cache {name}', f'# TYPE l1_cache_{name}_total counter', f'l1_cache_{name}_total {stats[name]}'])
+    lines.extend(['# HELP l1_cache_entries L1 catalog cache entries', '# TYPE l1_cache_entries gauge', f'l1_cache_entries {stats["size"]}'])
+    return lines
+
+def render() -> list:
+    return [line for metric in (request_latency, cache_lookups, aws_call_latency, aws_throttled_calls) for line in metric.render()]
@@ -0,0 +1,95 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import Optional
+import io
+
+from app.constants import *
+from app.lazy_modules import lazy_module
+
+boto3 = lazy_module('boto3')
+botocore_config = lazy_module('botocore.config')
+
+# parallel S3 multipart upload used by the Celery export tasks as the output sink of a converted file: the writes are
+# cut into parts of part_size which are uploaded by up to concurrency threads while the converter keeps writing, the
+# writer blocks once concurrency parts are in flight so the memory stays bounded. A file smaller than a part is
+# uploaded with a single put_object on close
+
+_client = None
+
+def s3_client():
+    global _client
+    if _client is None: _client = boto3.client('s3', config=botocore_config.Config(max_pool_connections=EXPORT_UPLOAD_CONCURRENCY * 4))
+    return _client
+
+def split_s3_url(url: str) -> tuple:
+    bucket, _, key = url[len("s3://"):].partition('/')
+    return bucket, key
+
+
+class MultipartUpload(io.RawIOBase):
+    def __init__(self, url: str, content_type: str = "application/octet-stream", part_size: int = EXPORT_UPLOAD_PART_SIZE, concurrency: int = EXPORT_UPLOAD_CONCURRENCY):
+        self.path = url
+        self.bucket, self.key = split_s3_url(url)
+        self.content_type = content_type
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.client = s3_client()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.in_flight = BoundedSemaphore(concurrency)
+        self.upload_id: Optional[str] = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def submit(self, body: bytes) -> None:
+        # fail fast instead of converting the rest of the result for an upload which cannot complete
+        for part in self.parts:
+            if part.done() and part.exception(): raise part.exception()
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type, ServerSideEncryption='AES256')['UploadId']
+        self.in_flight.acquire()
+        part: Future = self.executor.submit(self.upload_part, len(self.parts) + 1, body)
+        part.add_done_callback(lambda _: self.in_flight.release())
+        self.parts.append(part)
+
+    def upload_part(self, part_number: int, body: bytes) -> dict:
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self) -> None:
+        if self.closed: return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type, ServerSideEncryption='AES256')
+            else:
+                if self.buffer: self.submit(bytes(self.buffer))
+                parts = [part.result() for part in self.parts]
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            self.discard()
+            raise
+        finally:
+            self.buffer = bytearray()
+            self.executor.shutdown()
+        super().close()
+
+    # abort the upload, nothing is published under the key
+    def discard(self) -> None:
+        if self.closed: return
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.upload_id is not None: self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
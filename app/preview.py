@@ -0,0 +1,161 @@
+from __future__ import annotations
+from contextlib import suppress
+from starlette.concurrency import run_in_threadpool
+from time import time
+from typing import Optional
+from uuid import uuid4
+import asyncio, fsspec, logging, os
+
+from app import aws
+from app.constants import *
+from app.converters import ArrowIPCWriter, arrow_type, stream_to_writer
+from app.lazy_modules import lazy_module
+from app.local_cache import LocalCache
+
+pa = lazy_module('pyarrow')
+pc = lazy_module('pyarrow.compute')
+ipc = lazy_module('pyarrow.ipc')
+
+logger = logging.getLogger(__name__)
+
+# result previews are served from an uncompressed Arrow IPC copy of the query result CSV on the local disk of the API
+# node, memory-mapped so that any page costs the same as the first one. The copy keeps the values as text, as Athena
+# returns them. It is built in the background from the first preview on, the first PREVIEW_ATHENA_MAX_ROWS rows are
+# served by Athena get_query_results meanwhile. One worker of the node builds it (lock file next to the sidecar), the
+# others wait for it
+# background builds of this process by query ID
+_builds = {}
+# row indices of the recently sorted (query_id, sort, species) and species filtered (query_id, species) previews
+_sort_indices = LocalCache(max_size=PREVIEW_SORT_CACHE_MAX_SIZE)
+_species_indices = LocalCache(max_size=PREVIEW_SORT_CACHE_MAX_SIZE)
+
+def sidecar_path(query_id: str) -> str:
+    return os.path.join(PREVIEW_SIDECAR_DIR, f'{query_id}.arrow')
+
+class UnknownColumn(Exception):
+    pass
+
+# take the build lock of a sidecar, False while another worker holds it
+def take_lock(lock_path: str) -> bool:
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        # left behind by a worker which died while building
+        with suppress(FileNotFoundError):
+            if time() - os.path.getmtime(lock_path) > PREVIEW_SIDECAR_LOCK_TTL: os.remove(lock_path)
+        return False
+
+async def build(query_id: str, path: str) -> None:
+    lock_path = f'{path}.lock'
+    try:
+        os.makedirs(PREVIEW_SIDECAR_DIR, exist_ok=True)
+        while not take_lock(lock_path):
+            if os.path.exists(path): return
+            await asyncio.sleep(PREVIEW_SIDECAR_LOCK_POLL_INTERVAL)
+        try:
+            # built by another worker since the first check
+            if not os.path.exists(path): await run_in_threadpool(materialize, query_id, path)
+        finally:
+            os.remove(lock_path)
+    except Exception as err:
+        logger.error(f"preview sidecar build failed query_id={query_id} err=\"{err}\"")
+        raise
+    finally:
+        _builds.pop(query_id, None)
+
+# path of the sidecar of the query, starts building it if needed. Without wait None is returned while it is built
+async def sidecar(query_id: str, wait: bool = True) -> Optional[str]:
+    path = sidecar_path(query_id)
+    if os.path.exists(path): return path
+    task = _builds.get(query_id)
+    if task is None:
+        task = _builds[query_id] = asyncio.create_task(build(query_id, path))
+        # the failure is logged by build, a build nobody waited for does not warn about its exception
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    if not wait: return None
+    # a request going away does not cancel the build
+    await asyncio.shield(task)
+    return path
+
+# the first rows of the result from Athena itself, without TotalRows. columns: projection (raises UnknownColumn)
+async def athena_page(query_id: str, offset: int, limit: int, columns: Optional[list] = None) -> dict:
+    response = await aws.athena_client.get_query_results(QueryExecutionId=query_id, MaxResults=offset + limit + 1)
+    rows = response['ResultSet']['Rows']
+    header = [datum.get('VarCharValue') for datum in rows[0]['Data']]
+    for column in columns or []:
+        if column not in header: raise UnknownColumn(column)
+    indices = [header.index(column) for column in columns] if columns else range(len(header))
+    return {'Rows': [{'Data': [row['Data'][index] for index in indices]} for row in rows[:1] + rows[1 + offset:]]}
+
+def materialize(query_id: str, path: str) -> None:
+    # write to a temporary file first, other workers on the node never see a partial sidecar
+    tmp_path = f'{path}.{uuid4()}.tmp'
+    try:
+        with fsspec.open(AWS_S3_OUTPUT_DIR + f'{query_id}.csv', "rb") as source, open(tmp_path, "wb") as sink:
+            # no column types: every column is read as text
+            stream_to_writer(source, ArrowIPCWriter, sink)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    evict_sidecars(keep=path)
+
+# remove the least recently used sidecars once the total exceeds PREVIEW_SIDECAR_MAX_BYTES
+def evict_sidecars(keep: str) -> None:
+    sidecars = []
+    for entry in os.scandir(PREVIEW_SIDECAR_DIR):
+        if entry.name.endswith('.arrow'):
+            stat = entry.stat()
+            sidecars.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in sidecars)
+    for _, size, path in sorted(sidecars):
+        if total_size <= PREVIEW_SIDECAR_MAX_BYTES: break
+        if path == keep: continue
+        with suppress(FileNotFoundError):
+            os.remove(path)
+        total_size -= size
+
+def as_strings(column) -> list:
+    try:
+        return column.cast(pa.string()).to_pylist()
+    except pa.ArrowNotImplementedError:
+        return [None if value is None else str(value) for value in column.to_pylist()]
+
+# read one page of the sidecar in the same "Rows" layout as Athena get_query_results, header row first.
+# columns: projection (raises UnknownColumn), sort: column name, prefixed with "-" for descending order, compared as
+# its Athena type (column_types, see app/result_columns.py), species: only the rows of one species, for the merged
+# multi-species batch queries
+def read_page(query_id: str, path: str, offset: int, limit: int, columns: Optional[list] = None, sort: Optional[str] = None, species: Optional[str] = None, column_types: Optional[dict] = None) -> dict:
+    os.utime(path)
+    with pa.memory_map(path) as source:
+        table = ipc.open_file(source).read_all()
+        for column in (columns or []) + ([sort.lstrip('-')] if sort else []) + (['species'] if species else []):
+            if column not in table.column_names: raise UnknownColumn(column)
+        # row indices of the page in the table, None for all rows in order. Kept per query so that a deep page costs
+        # the same as the first one
+        row_indices, total_rows = None, table.num_rows
+        if species:
+            row_indices = _species_indices.get((query_id, species))
+            if row_indices is None:
+                row_indices = pc.indices_nonzero(pc.equal(table['species'], species))
+                _species_indices.put((query_id, species), row_indices)
+            total_rows = len(row_indices)
+        if sort:
+            # the sort column does not have to be part of the projection
+            sort_column = sort.lstrip('-')
+            indices = _sort_indices.get((query_id, sort, species))
+            if indices is None:
+                key = table[sort_column] if row_indices is None else table[sort_column].take(row_indices)
+                # a value which does not parse as the Athena type of the column: text order
+                with suppress(pa.ArrowInvalid):
+                    key = key.cast(arrow_type((column_types or {}).get(sort_column)))
+                indices = pc.sort_indices(pa.table({sort_column: key}), sort_keys=[(sort_column, 'descending' if sort.startswith('-') else 'ascending')])
+                if row_indices is not None: indices = row_indices.take(indices)
+                _sort_indices.put((query_id, sort, species), indices)
+            row_indices = indices
+        if columns: table = table.select(columns)
+        page = table.slice(offset, limit) if row_indices is None else table.take(row_indices.slice(offset, limit))
+        values = [as_strings(column) for column in page.columns]
+        rows = [{'Data': [{'VarCharValue': name} for name in page.column_names]}]
+        rows.extend({'Data': [{'VarCharValue': value} if value is not None else {} for value in row]} for row in zip(*values))
+        return {'Rows': rows, 'TotalRows': total_rows}
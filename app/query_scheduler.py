@@ -0,0 +1,168 @@
+from botocore.exceptions import ClientError
+from time import time
+from typing import Optional
+from uuid import uuid4
+import asyncio, json, logging, random
+
+from app import aws, cache, metrics, refinement, status_tracker
+from app.constants import *
+
+logger = logging.getLogger(__name__)
+
+# admission control of the Athena query submissions across all API workers: the queries in flight are the queries of the
+# status tracker which are not terminal yet (TRACKED_QUERIES_KEY) plus the submissions in progress (short leases in
+# ATHENA_SUBMISSION_LEASES_KEY). Below ATHENA_MAX_CONCURRENT_QUERIES and with nothing waiting a query is submitted right
+# away, otherwise it gets a ticket (an ID in the query ID format, QUEUED for /query/{id}/status) which waits in the
+# priority queue ATHENA_SUBMISSION_QUEUE_KEY (score = priority class, then submission time) until a dispatcher of any
+# API worker takes it as slots free up. Once submitted the ticket stands for the Athena query, see status_tracker.resolve
+_tasks = []
+
+# requeue the tickets of the expired leases (their dispatcher died before submitting), then take a lease for each of up
+# to ARGV[3] free slots: a direct submission (ARGV[4]) only if nothing is waiting, otherwise the tickets at the head of
+# the queue. Returns the leased tickets / submission
+ADMIT_SCRIPT = """
+local now, lease_ttl, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+for _, member in ipairs(redis.call('zrangebyscore', KEYS[2], '-inf', now)) do
+    redis.call('zrem', KEYS[2], member)
+    local score = redis.call('hget', KEYS[4], member)
+    if score then redis.call('zadd', KEYS[1], score, member) end
+end
+local free = limit - redis.call('scard', KEYS[3]) - redis.call('zcard', KEYS[2])
+if free <= 0 then return {} end
+if ARGV[4] then
+    if redis.call('zcard', KEYS[1]) > 0 then return {} end
+    redis.call('zadd', KEYS[2], now + lease_ttl, ARGV[4])
+    return {ARGV[4]}
+end
+local tickets = redis.call('zrange', KEYS[1], 0, free - 1)
+for _, ticket in ipairs(tickets) do
+    redis.call('zrem', KEYS[1], ticket)
+    redis.call('zadd', KEYS[2], now + lease_ttl, ticket)
+end
+return tickets
+"""
+
+def ticket_cache_key(ticket: str) -> str:
+    return f'athena_ticket:{ticket}'
+
+async def start() -> None:
+    _tasks.append(asyncio.create_task(dispatch_loop()))
+
+async def stop() -> None:
+    for task in _tasks: task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+async def admit(submission: Optional[str] = None) -> list:
+    keys = (ATHENA_SUBMISSION_QUEUE_KEY, ATHENA_SUBMISSION_LEASES_KEY, TRACKED_QUERIES_KEY, ATHENA_SUBMISSION_SCORES_KEY)
+    arguments = (time(), ATHENA_SUBMISSION_LEASE_TTL, ATHENA_MAX_CONCURRENT_QUERIES) + ((submission,) if submission else ())
+    return [member.decode('ascii') for member in await cache.client.eval(ADMIT_SCRIPT, len(keys), *keys, *arguments)]
+
+def is_throttled(err: Exception) -> bool:
+    return isinstance(err, ClientError) and err.response.get('Error', {}).get('Code') in metrics.THROTTLING_ERROR_CODES
+
+# start_query_execution retried with exponential backoff (full jitter) while Athena throttles, raises the last
+# throttling error once the retries are exhausted
+async def start_query_execution(query: str, retries: int = ATHENA_SUBMIT_RETRIES) -> str:
+    for attempt in range(retries + 1):
+        try:
+            return (await aws.athena_client.start_query_execution(
+                QueryString=query,
+                QueryExecutionContext={"Database": AWS_SCHEMA_DATABASE_NAME},
+                ResultConfiguration={
+                    "OutputLocation": AWS_S3_OUTPUT_DIR,
+                    "EncryptionConfiguration": {"EncryptionOption": "SSE_S3"},
+                },
+            ))["QueryExecutionId"]
+        except ClientError as err:
+            if not is_throttled(err) or attempt == retries: raise
+            await asyncio.sleep(random.uniform(0, min(ATHENA_SUBMIT_BACKOFF_MAX, ATHENA_SUBMIT_BACKOFF * 2 ** attempt)))
+
+# the query is tracked (status_tracker.record) and its lease released atomically, so that it is counted exactly once
+async def started(query_id: str, lease: str, spec: dict) -> None:
+    async with cache.client.pipeline(transaction=True) as pipe:
+        pipe.set(status_tracker.status_cache_key(query_id), 'QUEUED', ex=QUERY_STATUS_CACHE_TTL).sadd(TRACKED_QUERIES_KEY, query_id)
+        pipe.zrem(ATHENA_SUBMISSION_LEASES_KEY, lease)
+        await pipe.execute()
+    if spec.get('refinement'): await refinement.register(query_id, *spec['refinement'])
+
+# query ID of the submitted query, or the ID of a ticket if it has to wait for a slot. spec: {'query': SQL, 'cache_key':
+# the query cache key to point at the query once submitted (optional), 'refinement': [data_type, species, fields,
+# condition] to register the query as the source of refinements}
+async def submit(spec: dict, priority: int) -> str:
+    lease = f"direct:{uuid4()}"
+    if await admit(lease):
+        try:
+            query_id = await start_query_execution(spec['query'])
+        except Exception as err:
+            await cache.client.zrem(ATHENA_SUBMISSION_LEASES_KEY, lease)
+            if not is_throttled(err): raise
+            # still throttled after the retries, wait in the queue instead of failing the request
+            logger.warning(f"athena submission throttled, queueing err=\"{err}\"")
+        else:
+            await started(query_id, lease, spec)
+            return query_id
+    ticket = str(uuid4())
+    score = priority * ATHENA_PRIORITY_CLASS_SPAN + time()
+    async with cache.client.pipeline(transaction=False) as pipe:
+        pipe.set(ticket_cache_key(ticket), json.dumps(spec), ex=QUERY_ID_CACHE_TTL)
+        pipe.set(status_tracker.status_cache_key(ticket), 'QUEUED', ex=QUERY_ID_CACHE_TTL)
+        pipe.hset(ATHENA_SUBMISSION_SCORES_KEY, ticket, score)
+        pipe.zadd(ATHENA_SUBMISSION_QUEUE_KEY, {ticket: score})
+        await pipe.execute()
+    logger.info(f"athena submission queued ticket={ticket} priority={priority}")
+    return ticket
+
+# 1-based position of a ticket in the submission queue, None if it is not waiting (or not a ticket)
+async def position(ticket: str) -> Optional[int]:
+    rank = await cache.client.zrank(ATHENA_SUBMISSION_QUEUE_KEY, ticket)
+    return rank + 1 if rank is not None else None
+
+async def dispatch(ticket: str) -> bool:
+    spec = await cache.get_json(ticket_cache_key(ticket))
+    if spec is None:
+        await cache.client.hdel(ATHENA_SUBMISSION_SCORES_KEY, ticket)
+        await cache.client.zrem(ATHENA_SUBMISSION_LEASES_KEY, ticket)
+        return True
+    try:
+        query_id = await start_query_execution(spec['query'])
+    except Exception as err:
+        if is_throttled(err):
+            # back to its place in the queue
+            score = await cache.client.hget(ATHENA_SUBMISSION_SCORES_KEY, ticket)
+            await cache.client.zadd(ATHENA_SUBMISSION_QUEUE_KEY, {ticket: float(score)})
+            await cache.client.zrem(ATHENA_SUBMISSION_LEASES_KEY, ticket)
+            return False
+        logger.error(f"athena submission failed ticket={ticket} err=\"{err}\"")
+        async with cache.client.pipeline(transaction=False) as pipe:
+            pipe.set(status_tracker.status_cache_key(ticket), 'FAILED', ex=QUERY_ID_CACHE_TTL)
+            # the next identical submission gets a new chance
+            if spec.get('cache_key'): pipe.delete(spec['cache_key'])
+            pipe.delete(ticket_cache_key(ticket)).hdel(ATHENA_SUBMISSION_SCORES_KEY, ticket).zrem(ATHENA_SUBMISSION_LEASES_KEY, ticket)
+            pipe.publish(QUERY_STATUS_CHANNEL, ticket)
+            await pipe.execute()
+        return True
+    await started(query_id, ticket, spec)
+    async with cache.client.pipeline(transaction=False) as pipe:
+        pipe.set(status_tracker.status_cache_key(ticket), TICKET_SUBMITTED_PREFIX + query_id, ex=QUERY_ID_CACHE_TTL)
+        # new identical submissions get the query ID itself
+        if spec.get('cache_key'): pipe.set(spec['cache_key'], query_id, ex=QUERY_ID_CACHE_TTL)
+        pipe.delete(ticket_cache_key(ticket)).hdel(ATHENA_SUBMISSION_SCORES_KEY, ticket)
+        pipe.publish(QUERY_STATUS_CHANNEL, ticket)
+        await pipe.execute()
+    logger.info(f"athena submission dispatched ticket={ticket} query_id={query_id}")
+    return True
+
+# every API worker takes the tickets which fit in the free slots, backs off while Athena throttles
+async def dispatch_loop() -> None:
+    backoff = 0
+    while True:
+        try:
+            tickets = await admit()
+            throttled = not all(await asyncio.gather(*(dispatch(ticket) for ticket in tickets)))
+            backoff = min(ATHENA_SUBMIT_BACKOFF_MAX, max(ATHENA_SUBMIT_BACKOFF, backoff * 2)) if throttled else 0
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(f"athena submission dispatcher err=\"{err}\"")
+        await asyncio.sleep(QUERY_SCHEDULER_INTERVAL + random.uniform(0, backoff))
@@ -3,4 +3,5 @@ import os
 
 redis_host = os.getenv("REDIS_HOST", "localhost")
 redis_port = os.getenv("REDIS_PORT", 6379)
-r = Redis(host=redis_host, port=redis_port, db=0)
\ No newline at end of file
+redis_db = os.getenv("REDIS_DB", 0)
+r = Redis(host=redis_host, port=redis_port, db=redis_db)
\ No newline at end of file
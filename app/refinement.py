@@ -0,0 +1,279 @@
+from __future__ import annotations
+from contextlib import suppress
+from starlette.concurrency import run_in_threadpool
+from time import perf_counter, time
+from typing import List, Optional, Union
+from uuid import uuid4
+import asyncio, fsspec, json, logging, re
+
+from app import aws, cache, catalog_index, metrics, result_columns, status_tracker
+from app.canonical import ConditionParseError, ConditionParser, canonical_fields, flatten, render, tokenize
+from app.constants import *
+from app.lazy_modules import lazy_module
+
+pa = lazy_module('pyarrow')
+pa_csv = lazy_module('pyarrow.csv')
+pc = lazy_module('pyarrow.compute')
+
+logger = logging.getLogger(__name__)
+
+# local refinement of a query narrowing a SUCCEEDED query of the same data type and species: its fields are a subset of
+# the fields of the cached query and its condition implies the cached condition (every AND operand of the cached
+# condition is implied by an AND operand of the new one). The filter / projection then runs over the cached result CSV
+# with Arrow compute kernels instead of an Athena scan, and the result is published as {query_id}.csv under a new
+# (synthetic) query ID recorded as SUCCEEDED, so that status / preview / download / export work as for an Athena query.
+# Anything not understood (functions, types without a local equivalent, ...) goes to Athena as before
+
+FIELD_REGEX = re.compile(r'^[a-z_][a-z0-9_]*$')
+# pyarrow.compute functions by name, resolved on use so that importing this module does not import pyarrow
+COMPARISONS = {'=': 'equal', '<>': 'not_equal', '<': 'less', '<=': 'less_equal', '>': 'greater', '>=': 'greater_equal'}
+
+class UnsupportedRefinement(Exception):
+    pass
+
+def candidates_cache_key(data_type: str, species: str) -> str:
+    return f'refinement_candidates:{data_type}:{species}'
+
+def parent_cache_key(query_id: str) -> str:
+    return f'refinement:{query_id}'
+
+# the query the result of a refined query was filtered from, None for an Athena query
+async def parent(query_id: str) -> Optional[str]:
+    return await cache.get(parent_cache_key(query_id))
+
+# remember a submitted query as the possible source of later refinements. A merged query of several species (species
+# IN (...), see /query/batch) is a candidate of each of its species, its rows are then filtered by species as well
+async def register(query_id: str, data_type: str, species: Union[str, List[str]], fields: str, condition: str) -> None:
+    merged = not isinstance(species, str)
+    async with cache.client.pipeline(transaction=False) as pipe:
+        for name in species if merged else [species]:
+            key = candidates_cache_key(data_type, name)
+            pipe.zadd(key, {json.dumps([query_id, fields, condition] + ([True] if merged else [])): time()})
+            pipe.zremrangebyrank(key, 0, -REFINEMENT_CANDIDATES - 1)
+            pipe.expire(key, QUERY_ID_CACHE_TTL)
+        await pipe.execute()
+
+def parse_condition(condition: str) -> Optional[tuple]:
+    if not condition or not condition.strip(): return None
+    return ConditionParser(tokenize(condition)).parse()
+
+# the condition restricted to the rows of one species of a merged result
+def species_condition(species: str, condition: Optional[tuple]) -> tuple:
+    species_filter = ('COMPARE', '=', ('column', 'species'), ('literal', "'" + species.replace("'", "''") + "'"))
+    return species_filter if condition is None else ('AND', [species_filter] + conjuncts(condition))
+
+def conjuncts(node: Optional[tuple]) -> list:
+    return flatten(node, 'AND') if node is not None else []
+
+# requested fields in order, raises UnsupportedRefinement for anything else than plain column names
+def parse_fields(fields: str) -> Optional[List[str]]:
+    if canonical_fields(fields) == '*': return None
+    names = [field.strip().strip('"').lower() for field in fields.split(',') if field.strip()]
+    if len(set(names)) != len(names) or not all(FIELD_REGEX.match(name) for name in names): raise UnsupportedRefinement(f"fields={fields}")
+    return names
+
+def is_number(operand: tuple) -> bool:
+    return operand[0] == 'literal' and not operand[1].startswith("'") and operand[1] not in ('NULL', 'TRUE', 'FALSE')
+
+# (low, low inclusive, high, high inclusive) of a numeric predicate on a column, None if it is not one
+def numeric_range(node: tuple) -> Optional[tuple]:
+    if node[0] == 'COMPARE' and node[2][0] == 'column' and is_number(node[3]):
+        value = float(node[3][1])
+        return {'=': (value, True, value, True), '<': (None, False, value, False), '<=': (None, False, value, True),
+                '>': (value, False, None, False), '>=': (value, True, None, False)}.get(node[1])
+    if node[0] == 'BETWEEN' and is_number(node[2]) and is_number(node[3]):
+        return (float(node[2][1]), True, float(node[3][1]), True)
+    return None
+
+def within(inner: tuple, outer: tuple) -> bool:
+    low, low_inclusive, high, high_inclusive = inner
+    outer_low, outer_low_inclusive, outer_high, outer_high_inclusive = outer
+    if outer_low is not None and (low is None or low < outer_low or (low == outer_low and low_inclusive and not outer_low_inclusive)): return False
+    if outer_high is not None and (high is None or high > outer_high or (high == outer_high and high_inclusive and not outer_high_inclusive)): return False
+    return True
+
+def values(node: tuple) -> Optional[set]:
+    if node[0] == 'IN': return {value[1] for value in node[2]}
+    if node[0] == 'COMPARE' and node[1] == '=' and node[3][0] == 'literal': return {node[3][1]}
+    return None
+
+# whether the predicate `narrower` implies `wider`, ex.: gene_id > 10 implies gene_id > 5, biotype = 'x' implies
+# biotype IN ('x', 'y'). Conservative, False when in doubt
+def implies(narrower: tuple, wider: tuple) -> bool:
+    if render(narrower) == render(wider): return True
+    if narrower[0] in ('AND', 'OR', 'NOT') or wider[0] in ('AND', 'OR', 'NOT'): return False
+    if predicate_operands(narrower)[0] != predicate_operands(wider)[0]: return False
+    narrower_range, wider_range = numeric_range(narrower), numeric_range(wider)
+    if narrower_range is not None and wider_range is not None: return within(narrower_range, wider_range)
+    narrower_values, wider_values = values(narrower), values(wider)
+    return wider[0] == 'IN' and narrower_values is not None and narrower_values <= wider_values
+
+# operands of a predicate, the column first
+def predicate_operands(node: tuple) -> list:
+    if node[0] == 'COMPARE': return [node[2], node[3]]
+    if node[0] in ('IN', 'NOT IN'): return [node[1]] + node[2]
+    return list(node[1:])
+
+def subsumes(parent_fields: Optional[List[str]], parent_condition: Optional[tuple], fields: Optional[List[str]], condition: Optional[tuple]) -> bool:
+    if parent_fields is not None and (fields is None or not set(fields) <= set(parent_fields)): return False
+    return all(any(implies(narrower, wider) for narrower in conjuncts(condition)) for wider in conjuncts(parent_condition))
+
+# kind of the values of an Athena column type as far as the local filter is concerned, None if not supported
+def value_kind(athena_type: str) -> Optional[str]:
+    athena_type = athena_type.lower()
+    if athena_type == 'string' or athena_type.startswith('varchar') or athena_type.startswith('char'): return 'string'
+    if athena_type in ('bigint', 'int', 'integer', 'smallint', 'tinyint'): return 'integer'
+    if athena_type in ('double', 'float', 'real'): return 'float'
+    if athena_type == 'boolean': return 'boolean'
+    return None
+
+ARROW_TYPES = {'string': 'string', 'integer': 'int64', 'float': 'float64', 'boolean': 'bool_'}
+
+def arrow_type(kind: str) -> pa.DataType:
+    return getattr(pa, ARROW_TYPES[kind])()
+
+def literal(operand: tuple, kind: str):
+    text = operand[1]
+    if text.startswith("'") and kind == 'string': return text[1:-1].replace("''", "'")
+    if text in ('TRUE', 'FALSE') and kind == 'boolean': return text == 'TRUE'
+    if is_number(operand) and kind in ('integer', 'float'): return int(text) if re.match(r'^-?\d+$', text) else float(text)
+    raise UnsupportedRefinement(f"literal {text} for a {kind} column")
+
+# check that the condition only uses what the local filter evaluates like Athena, column_kinds: {column: kind}
+def check(node: tuple, column_kinds: dict) -> None:
+    kind = node[0]
+    if kind in ('AND', 'OR'):
+        for operand in node[1]: check(operand, column_kinds)
+        return
+    if kind == 'NOT': return check(node[1], column_kinds)
+    operands = predicate_operands(node)
+    if operands[0][0] != 'column' or any(operand[0] == 'function' for operand in operands): raise UnsupportedRefinement(render(node))
+    for operand in operands:
+        if operand[0] == 'column' and column_kinds.get(operand[1]) is None: raise UnsupportedRefinement(f"column {operand[1]}")
+    column_kind = column_kinds[operands[0][1]]
+    # Athena LIKE has no escape character unless given with ESCAPE, the Arrow one escapes with a backslash
+    if kind in ('LIKE', 'NOT LIKE') and (column_kind != 'string' or '\\' in operands[1][1]): raise UnsupportedRefinement(render(node))
+    for operand in operands[1:]:
+        if operand[0] == 'column':
+            # numbers compare with numbers, other kinds only with the same kind
+            if column_kinds[operand[1]] != column_kind and {column_kinds[operand[1]], column_kind} != {'integer', 'float'}: raise UnsupportedRefinement(render(node))
+        elif kind in ('IN', 'NOT IN') and column_kind == 'integer' and not isinstance(literal(operand, column_kind), int):
+            raise UnsupportedRefinement(render(node))
+        else:
+            literal(operand, column_kind)
+
+def column_values(batch: pa.RecordBatch, name: str, column_kinds: dict) -> pa.Array:
+    column = batch.column(batch.schema.get_field_index(name))
+    return column if column_kinds[name] == 'string' else column.cast(arrow_type(column_kinds[name]))
+
+def operand_values(batch: pa.RecordBatch, operand: tuple, kind: str, column_kinds: dict):
+    if operand[0] == 'column': return column_values(batch, operand[1], column_kinds)
+    return pa.scalar(literal(operand, kind))
+
+# SQL three-valued evaluation of a condition over a batch, a null in the mask drops the row as in a WHERE clause
+def mask(node: tuple, batch: pa.RecordBatch, column_kinds: dict) -> pa.Array:
+    kind = node[0]
+    if kind == 'AND':
+        result = mask(node[1][0], batch, column_kinds)
+        for operand in node[1][1:]: result = pc.and_kleene(result, mask(operand, batch, column_kinds))
+        return result
+    if kind == 'OR':
+        result = mask(node[1][0], batch, column_kinds)
+        for operand in node[1][1:]: result = pc.or_kleene(result, mask(operand, batch, column_kinds))
+        return result
+    if kind == 'NOT': return pc.invert(mask(node[1], batch, column_kinds))
+    column_kind = column_kinds[node[1][1] if kind != 'COMPARE' else node[2][1]]
+    if kind == 'COMPARE':
+        return getattr(pc, COMPARISONS[node[1]])(column_values(batch, node[2][1], column_kinds), operand_values(batch, node[3], column_kind, column_kinds))
+    column = column_values(batch, node[1][1], column_kinds)
+    if kind == 'IS NULL': return pc.is_null(column)
+    if kind == 'IS NOT NULL': return pc.is_valid(column)
+    if kind in ('IN', 'NOT IN'):
+        result = pc.is_in(column, value_set=pa.array([literal(value, column_kind) for value in node[2]], arrow_type(column_kind)))
+        # x IN (...) is null for a null x
+        result = pc.if_else(pc.is_valid(column), result, pa.scalar(None, pa.bool_()))
+    elif kind in ('BETWEEN', 'NOT BETWEEN'):
+        result = pc.and_kleene(pc.greater_equal(column, operand_values(batch, node[2], column_kind, column_kinds)), pc.less_equal(column, operand_values(batch, node[3], column_kind, column_kinds)))
+    else:
+        result = pc.match_like(column, literal(node[2], column_kind))
+    return pc.invert(result) if kind.startswith('NOT') else result
+
+# filter / project the parent result CSV into the result CSV of query_id. Every column is read as text (null for an
+# empty unquoted value, as Athena writes NULL) and written back as is, only the columns of the condition are converted
+# for the evaluation
+def refine(parent_query_id: str, query_id: str, fields: Optional[List[str]], condition: Optional[tuple], column_kinds: dict) -> int:
+    rows = 0
+    convert_options = pa_csv.ConvertOptions(column_types={name: pa.string() for name in column_kinds}, strings_can_be_null=True, quoted_strings_can_be_null=False)
+    try:
+        with fsspec.open(f"{AWS_S3_OUTPUT_DIR}{parent_query_id}.csv", "rb") as source, fsspec.open(f"{AWS_S3_OUTPUT_DIR}{query_id}.csv", "wb") as sink:
+            reader = pa_csv.open_csv(source, read_options=pa_csv.ReadOptions(block_size=EXPORT_READ_BLOCK_SIZE), convert_options=convert_options)
+            names = fields or reader.schema.names
+            writer = pa_csv.CSVWriter(sink, pa.schema([reader.schema.field(name) for name in names]))
+            for batch in reader:
+                if condition is not None: batch = batch.filter(mask(condition, batch, column_kinds))
+                writer.write_batch(pa.RecordBatch.from_arrays([batch.column(batch.schema.get_field_index(name)) for name in names], names=names))
+                rows += batch.num_rows
+            writer.close()
+    except BaseException:
+        # the partial result is written on close of the sink, nothing refers to its query ID
+        fs, path = fsspec.core.url_to_fs(f"{AWS_S3_OUTPUT_DIR}{query_id}.csv")
+        with suppress(FileNotFoundError):
+            fs.rm(path)
+        raise
+    return rows
+
+async def find_parent(data_type: str, species: str, fields: Optional[List[str]], condition: Optional[tuple]) -> Optional[tuple]:
+    candidates = []
+    for member in await cache.client.zrevrange(candidates_cache_key(data_type, species), 0, -1):
+        parent_query_id, parent_fields, parent_condition, *merged = json.loads(member)
+        try:
+            if subsumes(parse_fields(parent_fields), parse_condition(parent_condition), fields, condition):
+                candidates.append((parent_query_id, parse_fields(parent_fields), bool(merged)))
+        except (ConditionParseError, UnsupportedRefinement):
+            continue
+    if not candidates: return None
+    # only queries known to have SUCCEEDED, no Athena call for the others
+    states = await cache.client.mget([status_tracker.status_cache_key(candidate[0]) for candidate in candidates])
+    candidates = [candidate for candidate, state in zip(candidates, states) if state == b'SUCCEEDED']
+    sizes = await asyncio.gather(*(aws.s3_client.head_object(Bucket='ensembl-athena-results', Key=f'{candidate[0]}.csv') for candidate in candidates), return_exceptions=True)
+    candidates = [(size['ContentLength'], candidate) for candidate, size in zip(candidates, sizes) if isinstance(size, dict) and size['ContentLength'] <= REFINEMENT_MAX_BYTES]
+    # the smallest result, the least to filter
+    return min(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+# query ID of the local refinement of the query, None if it has to run on Athena
+async def start(data_type: str, species: str, fields: str, condition: str) -> Optional[str]:
+    if not QUERY_REFINEMENT: return None
+    start_time = perf_counter()
+    try:
+        requested_fields, parsed_condition = parse_fields(fields), parse_condition(condition)
+        found = await find_parent(data_type, species, requested_fields, parsed_condition)
+        if found is None:
+            metrics.cache_lookups.inc('refinement', 'miss')
+            return None
+        parent_query_id, parent_fields, merged = found
+        entry, _ = await catalog_index.get_entry(data_type)
+        column_kinds = {column['Name'].lower(): value_kind(column['Type']) for column in entry['columns']}
+        available_columns = parent_fields or list(column_kinds)
+        for name in requested_fields or []:
+            if name not in available_columns: raise UnsupportedRefinement(f"column {name}")
+        filter_condition = species_condition(species, parsed_condition) if merged else parsed_condition
+        if filter_condition is not None: check(filter_condition, {name: column_kinds.get(name) for name in available_columns})
+        query_id = str(uuid4())
+        rows = await run_in_threadpool(refine, parent_query_id, query_id, requested_fields, filter_condition, column_kinds)
+    except (ConditionParseError, UnsupportedRefinement) as err:
+        metrics.cache_lookups.inc('refinement', 'miss')
+        logger.info(f"refinement not applicable data_type={data_type} species={species} reason=\"{err}\"")
+        return None
+    except Exception as err:
+        metrics.cache_lookups.inc('refinement', 'miss')
+        logger.error(f"refinement failed data_type={data_type} species={species} err=\"{err}\", falling back to Athena")
+        return None
+    await cache.put(parent_cache_key(query_id), parent_query_id, QUERY_ID_CACHE_TTL)
+    # the columns of the refined result keep the types of the parent result columns
+    parent_column_types = await result_columns.get(parent_query_id)
+    if parent_column_types: await result_columns.put(query_id, {name: parent_column_types[name] for name in requested_fields or parent_column_types if name in parent_column_types})
+    await status_tracker.record(query_id, 'SUCCEEDED')
+    await register(query_id, data_type, species, fields, condition)
+    metrics.cache_lookups.inc('refinement', 'hit')
+    logger.info(f"refined query_id={query_id} parent_query_id={parent_query_id} rows={rows} Time={'{0:.2f}'.format((perf_counter() - start_time) * 1000)} ms")
+    return query_id
@@ -0,0 +1,31 @@
+from typing import Optional
+import logging
+
+from app import aws, cache
+from app.constants import *
+
+logger = logging.getLogger(__name__)
+
+# Athena column types of a query result, {column name: Athena type} in the column order of the result CSV. Read from
+# the result set metadata of the query once and kept in Redis, the result CSV is parsed with these types (see
+# open_csv_stream in app/converters.py) instead of types guessed from its first block. The refined queries of
+# app/refinement.py are unknown to Athena, they record the types of their columns themselves
+
+def cache_key(query_id: str) -> str:
+    return f'result_columns:{query_id}'
+
+async def put(query_id: str, column_types: dict) -> None:
+    await cache.put_json(cache_key(query_id), column_types, QUERY_ID_CACHE_TTL)
+
+# None if the types are not available, the result is then read as text
+async def get(query_id: str) -> Optional[dict]:
+    column_types = await cache.get_json(cache_key(query_id))
+    if column_types is not None: return column_types
+    try:
+        response = await aws.athena_client.get_query_results(QueryExecutionId=query_id, MaxResults=1)
+        column_types = {column['Name']: column['Type'] for column in response['ResultSet']['ResultSetMetadata']['ColumnInfo']}
+    except Exception as err:
+        logger.warning(f"result column types not available query_id={query_id} err=\"{err}\"")
+        return None
+    await put(query_id, column_types)
+    return column_types
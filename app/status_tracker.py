@@ -0,0 +1,122 @@
+from contextlib import suppress
+from typing import Tuple
+from uuid import uuid4
+import asyncio, logging
+
+from app import aws, cache
+from app.constants import *
+
+logger = logging.getLogger(__name__)
+
+# query execution states of the queries started by the API, kept in Redis under {query_id}_status. Non terminal queries
+# are refreshed in bulk (batch_get_query_execution) on a fixed cadence by whichever API worker holds the tracker lock,
+# terminal states are memoized as they never change, and every state change is published for the long-poll waiters
+_worker_id = str(uuid4())
+_waiters = {}
+# long-poll waiters per query ID on this worker
+_waiter_counts = {}
+_tasks = []
+
+def status_cache_key(query_id: str) -> str:
+    return f'{query_id}_status'
+
+async def start() -> None:
+    _tasks.append(asyncio.create_task(refresh_loop()))
+    _tasks.append(asyncio.create_task(listen_for_changes()))
+
+async def stop() -> None:
+    for task in _tasks: task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+async def record(query_id: str, state: str) -> None:
+    async with cache.client.pipeline(transaction=False) as pipe:
+        if state in TERMINAL_QUERY_STATES:
+            pipe.set(status_cache_key(query_id), state, ex=QUERY_ID_CACHE_TTL).srem(TRACKED_QUERIES_KEY, query_id)
+        else:
+            pipe.set(status_cache_key(query_id), state, ex=QUERY_STATUS_CACHE_TTL).sadd(TRACKED_QUERIES_KEY, query_id)
+        await pipe.execute()
+
+# the query ID and state of a query, or of a submission ticket of app/query_scheduler.py: a ticket is QUEUED until it is
+# submitted, then stands for the Athena query it was submitted as
+async def resolve(query_id: str) -> Tuple[str, str]:
+    state = await cache.get(status_cache_key(query_id))
+    if state is not None and state.startswith(TICKET_SUBMITTED_PREFIX):
+        query_id = state[len(TICKET_SUBMITTED_PREFIX):]
+        state = await cache.get(status_cache_key(query_id))
+    if state is None:
+        # not tracked yet (ex.: query started before a Redis flush), fetch it once and let the tracker take over
+        state = (await aws.athena_client.get_query_execution(QueryExecutionId=query_id))['QueryExecution']['Status']['State']
+        await record(query_id, state)
+    return query_id, state
+
+async def get_state(query_id: str) -> str:
+    return (await resolve(query_id))[1]
+
+# long-poll, returns as soon as the state differs from the given one or once the timeout (in seconds) elapses
+async def wait_for_change(query_id: str, state: str, timeout: float) -> str:
+    if state in TERMINAL_QUERY_STATES or timeout <= 0: return state
+    event = _waiters.setdefault(query_id, asyncio.Event())
+    _waiter_counts[query_id] = _waiter_counts.get(query_id, 0) + 1
+    try:
+        # the state might have changed before the waiter was registered
+        current_state = await get_state(query_id)
+        if current_state != state: return current_state
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout)
+        return await get_state(query_id)
+    finally:
+        # the last waiter of the query drops its event, which is left behind when no change was published (timeout)
+        _waiter_counts[query_id] -= 1
+        if not _waiter_counts[query_id]:
+            del _waiter_counts[query_id]
+            _waiters.pop(query_id, None)
+
+async def refresh_loop() -> None:
+    while True:
+        try:
+            # only one API worker across all containers refreshes per interval
+            if await cache.client.set(STATUS_TRACKER_LOCK_KEY, _worker_id, nx=True, px=STATUS_REFRESH_INTERVAL * 1000):
+                await refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(f"status tracker refresh err=\"{err}\"")
+        await asyncio.sleep(STATUS_REFRESH_INTERVAL)
+
+async def refresh() -> None:
+    query_ids = [query_id.decode('ascii') for query_id in await cache.client.smembers(TRACKED_QUERIES_KEY)]
+    for i in range(0, len(query_ids), ATHENA_BATCH_SIZE):
+        batch = query_ids[i:i + ATHENA_BATCH_SIZE]
+        query_response = await aws.athena_client.batch_get_query_execution(QueryExecutionIds=batch)
+        previous_states = dict(zip(batch, await cache.client.mget([status_cache_key(query_id) for query_id in batch])))
+        async with cache.client.pipeline(transaction=False) as pipe:
+            for query_execution in query_response['QueryExecutions']:
+                query_id, state = query_execution['QueryExecutionId'], query_execution['Status']['State']
+                if state in TERMINAL_QUERY_STATES:
+                    pipe.set(status_cache_key(query_id), state, ex=QUERY_ID_CACHE_TTL).srem(TRACKED_QUERIES_KEY, query_id)
+                else:
+                    pipe.set(status_cache_key(query_id), state, ex=QUERY_STATUS_CACHE_TTL)
+                if previous_states.get(query_id) != state.encode('ascii'):
+                    pipe.publish(QUERY_STATUS_CHANNEL, query_id)
+            # unknown / expired query IDs, the status endpoint falls back to get_query_execution for them
+            for unprocessed in query_response.get('UnprocessedQueryExecutionIds', []):
+                logger.error(f"status tracker dropped query_id={unprocessed['QueryExecutionId']} err=\"{unprocessed.get('ErrorMessage')}\"")
+                pipe.srem(TRACKED_QUERIES_KEY, unprocessed['QueryExecutionId'])
+            await pipe.execute()
+
+# wake up the long-poll waiters of this worker on every published state change
+async def listen_for_changes() -> None:
+    while True:
+        try:
+            async with cache.client.pubsub() as pubsub:
+                await pubsub.subscribe(QUERY_STATUS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message': continue
+                    event = _waiters.pop(message['data'].decode('ascii'), None)
+                    if event: event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error(f"status tracker listener err=\"{err}\"")
+            await asyncio.sleep(1)
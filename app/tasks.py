@@ -1,37 +1,135 @@
 from celery import Celery
+from celery.signals import worker_init, worker_ready
 from celery.utils.log import get_task_logger
-from time import sleep
-import pandas as pd
+from threading import Thread
+from time import time
+from typing import Callable, List, Optional, Tuple
+from urllib.request import urlopen
+import asyncio, fsspec
 
+from app import export_scheduler, lazy_modules
 from app.constants import *
+from app.metrics import observe_export
+from app.multipart import MultipartUpload
+from app.converters import parquet_convert_many, stream_convert_many
 from app.redis_setup import *
 
 logger = get_task_logger(__name__)
 
-app = Celery('tasks', backend=f'redis://{redis_host}:{redis_port}/0', broker=f'redis://{redis_host}:{redis_port}/0')
+app = Celery('tasks', backend=f'redis://{redis_host}:{redis_port}/{redis_db}', broker=f'redis://{redis_host}:{redis_port}/{redis_db}')
+# exports are routed to EXPORT_FAST_QUEUE / EXPORT_BULK_QUEUE by app.export_scheduler, each queue gets its own worker
+# pool (celery -A app.tasks worker -Q <queue> --concurrency <n>). A worker only reserves the task it is running, so a
+# queued job is never stuck behind a long running one in the prefetch buffer of a busy worker
+app.conf.task_routes = {'app.tasks.file_format_converter': {'queue': EXPORT_BULK_QUEUE}, 'app.tasks.unload_compactor': {'queue': EXPORT_BULK_QUEUE}}
+app.conf.worker_prefetch_multiplier = 1
+app.conf.task_acks_late = True
 
-@app.task
-def file_format_converter(queryID: str, df_input: str, file_format: SupportedFileFormats, cache_key: str, id: str):
+# the pool processes are forked from the main worker process, the dependencies deferred by app/lazy_modules.py are
+# imported there once so that every pool process starts warm and shares them copy-on-write
+@worker_init.connect
+def preload_modules(**kwargs) -> None:
+    lazy_modules.preload()
+
+# prefetch the catalog (data types, species and columns per data type) into Redis so that no API request sees a cold
+# miss after a Redis flush, skipped if an API worker refreshed it recently (see app/catalog_index.py). Runs in a
+# background thread: the worker consumes its queues meanwhile instead of waiting for the SELECT DISTINCT scans
+def warm_up_catalog() -> None:
+    from app import catalog_index
     try:
-        logger.info(f"Celery task id:{id} status:PROCESSING func:file_format_converter params:{{file_format:{file_format}}}")
-        r.set(cache_key, "PROCESSING")
-
-        df = pd.read_csv(df_input, low_memory=False)
-        s3_key = AWS_S3_OUTPUT_DIR + f"{queryID}.{file_format}"
-        if (file_format == "tsv"): df.to_csv(s3_key, sep="\t", index=False)
-        elif (file_format == "xlsx"): df.to_excel(s3_key, index=False)
-        elif (file_format == "json"): df.to_json(s3_key, index=False, orient="split")
-        elif (file_format == "xml"): df.to_xml(s3_key, index=False)
-        elif (file_format == "feather"): df.to_feather(s3_key)
-        elif (file_format == "parquet"): df.to_parquet(s3_key, index=False)
-
-        logger.info(f"Celery task id:{id} status:DONE func:file_format_converter params:{{file_format:{file_format}}}")
-        r.set(cache_key, "DONE")
+        asyncio.run(catalog_index.warm_up())
     except Exception as err:
-        logger.info(f"Celery task id:{id} status:FAILED func:file_format_converter params:{{file_format:{file_format}}} error_detail:{str(err)}")
-        r.set(cache_key, "FAILED")
+        logger.error(f"catalog cache warm-up failed error_detail:{str(err)}")
+
+@worker_ready.connect
+def warm_catalog_cache(**kwargs) -> None:
+    if not CELERY_CATALOG_WARM_UP: return
+    Thread(target=warm_up_catalog, name="catalog-warm-up", daemon=True).start()
+
+# smoothing factor of the measured export throughput per queue, used for the ETA of the queued exports
+THROUGHPUT_EWMA_ALPHA = 0.3
 
+# convert the CSV result of a query to one or more file formats from a single download and parse of the CSV, the
+# status of each format is tracked under its own {query_id}.{file_format} cache key
 @app.task
-def delete_key_from_cache(cache_key, wait_time = 0):
-    sleep(wait_time)  # in seconds
-    r.delete(cache_key)
+def file_format_converter(queryID: str, df_input: str, file_formats: List[SupportedFileFormats], id: str, queue: Optional[str] = None, job_id: Optional[str] = None, cost: float = 0, column_types: Optional[dict] = None):
+    def convert(sinks: dict) -> Tuple[int, int, dict]:
+        with urlopen(df_input) as source:
+            rows, errors = stream_convert_many(source, sinks, column_types=column_types)
+            return rows, int(source.headers.get("Content-Length", 0)), errors
+
+    export('file_format_converter', queryID, file_formats, id, queue, job_id, cost, convert)
+
+# compact the Parquet files written by an Athena UNLOAD of the query (see app/unload.py) into a single file per format,
+# parts are paths relative to AWS_S3_OUTPUT_DIR
+@app.task
+def unload_compactor(queryID: str, parts: List[str], file_formats: List[SupportedFileFormats], id: str, queue: Optional[str] = None, job_id: Optional[str] = None, cost: float = 0):
+    def convert(sinks: dict) -> Tuple[int, int, dict]:
+        fs, output_dir = fsspec.core.url_to_fs(AWS_S3_OUTPUT_DIR)
+        paths = [f"{output_dir.rstrip('/')}/{part}" for part in parts]
+        sources = [fs.open(path, "rb") for path in paths]
+        try:
+            rows, errors = parquet_convert_many(sources, sinks)
+        finally:
+            for source in sources: source.close()
+        return rows, sum(fs.size(path) for path in paths), errors
+
+    export('unload_compactor', queryID, file_formats, id, queue, job_id, cost, convert)
+
+# run an export job, convert receives the output sink of every format and returns (rows, input bytes, errors per format)
+def export(func: str, queryID: str, file_formats: list, id: str, queue: Optional[str], job_id: Optional[str], cost: float, convert: Callable[[dict], Tuple[int, int, dict]]) -> None:
+    file_formats = [SupportedFileFormats(file_format) for file_format in file_formats]
+    cache_keys = {file_format: export_scheduler.export_cache_key(queryID, file_format) for file_format in file_formats}
+    logger.info(f"Celery task id:{id} status:PROCESSING func:{func} params:{{file_formats:{[file_format.value for file_format in file_formats]}, queue:{queue}}}")
+    pipe = r.pipeline(transaction=False)
+    pipe.mset({cache_key: "PROCESSING" for cache_key in cache_keys.values()})
+    if job_id: pipe.zrem(export_scheduler.queue_key(queue), job_id).hdel(export_scheduler.costs_key(queue), job_id)
+    pipe.execute()
+
+    start_time = time()
+    sinks, sizes, rows, input_bytes = {}, {}, 0, 0
+    try:
+        fs, output_dir = fsspec.core.url_to_fs(AWS_S3_OUTPUT_DIR)
+        # parallel multipart S3 uploads, record batch streaming keeps the peak memory bounded by the size of a batch
+        # added one by one, the sinks opened before a failing one are discarded below
+        for file_format, cache_key in cache_keys.items():
+            sinks[file_format] = open_output(fs, f"{output_dir.rstrip('/')}/{cache_key}", file_format)
+        rows, input_bytes, errors = convert(sinks)
+    except Exception as err:
+        errors = {file_format: err for file_format in file_formats}
+    for file_format, sink in sinks.items():
+        try:
+            # never publish a partial file, the export endpoint treats an existing S3 object as DONE
+            if file_format not in errors:
+                sizes[file_format] = sink.tell()
+                sink.close()
+            elif isinstance(sink, MultipartUpload): sink.discard()
+            else:
+                sink.close()
+                fs.rm(sink.path)
+        except Exception as err:
+            errors[file_format] = err
+    elapsed = max(time() - start_time, 1e-9)
+    if job_id and not errors: record_throughput(queue, cost / elapsed)
+
+    for file_format, cache_key in cache_keys.items():
+        if file_format in errors:
+            logger.info(f"Celery task id:{id} status:FAILED func:{func} params:{{file_format:{file_format.value}}} error_detail:{str(errors[file_format])}")
+            # expires on its own, the export can be requested again after the retry interval
+            r.set(cache_key, "FAILED", ex=EXPORT_FAILED_RETRY_INTERVAL)
+        else:
+            logger.info(f"Celery task id:{id} status:DONE func:{func} params:{{file_format:{file_format.value}}} rows:{rows} rows_per_s:{'{0:.0f}'.format(rows / elapsed)} mb_per_s:{'{0:.2f}'.format(input_bytes / elapsed / 1e6)}")
+            r.set(cache_key, "DONE")
+            try:
+                observe_export(r, file_format.value, elapsed, sizes.get(file_format, 0))
+            except Exception as err:
+                logger.warning(f"Celery task id:{id} failed to record the export metrics error_detail:{str(err)}")
+
+def open_output(fs, path: str, file_format: SupportedFileFormats):
+    if AWS_S3_OUTPUT_DIR.startswith("s3://"): return MultipartUpload(f"s3://{path}", FILE_FORMAT_MEDIA_TYPES[file_format])
+    # local output directory of the offline benchmarks
+    return fs.open(path, "wb")
+
+def record_throughput(queue: str, throughput: float) -> None:
+    previous = r.get(export_scheduler.throughput_key(queue))
+    if previous is not None: throughput = THROUGHPUT_EWMA_ALPHA * throughput + (1 - THROUGHPUT_EWMA_ALPHA) * float(previous)
+    r.set(export_scheduler.throughput_key(queue), throughput)
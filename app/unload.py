@@ -0,0 +1,89 @@
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
+from uuid import uuid4
+import fsspec, json, logging
+
+from app import aws, cache, export_scheduler, query_scheduler, refinement, status_tracker
+from app.constants import *
+
+logger = logging.getLogger(__name__)
+
+# parquet / feather exports from an Athena UNLOAD of the query instead of re-parsing its CSV result: the SQL of the
+# query is re-issued as UNLOAD (...) TO '<prefix>' WITH (format = 'PARQUET'), the status of the exported formats is
+# "UNLOADING {unload_query_id}" until the UNLOAD succeeds, then the Parquet files listed in the Athena manifest are
+# compacted by unload_compactor (export status QUEUED -> PROCESSING -> DONE). The files of the UNLOAD are also
+# served as they are (manifest_parts) for the clients able to read a multi-file dataset. If the UNLOAD fails the
+# formats fall back to the CSV conversion. A query is unloaded once (unload_running:{query_id}), the formats requested
+# later are attached to its UNLOAD
+
+def failed_cache_key(query_id: str) -> str:
+    return f'unload_failed:{query_id}'
+
+def manifest_cache_key(query_id: str) -> str:
+    return f'unload_manifest:{query_id}'
+
+def running_cache_key(query_id: str) -> str:
+    return f'unload_running:{query_id}'
+
+def unload_statement(query: str, location: str) -> str:
+    return f"UNLOAD ({query.strip().rstrip(';')}) TO '{location}' WITH (format = 'PARQUET', compression = 'SNAPPY')"
+
+# the formats to export with an UNLOAD, the others are converted from the CSV result
+async def unload_file_formats(query_id: str, file_formats: List[SupportedFileFormats]) -> List[SupportedFileFormats]:
+    # a locally refined query has no Athena query to unload, its result CSV is converted
+    if not EXPORT_VIA_UNLOAD or await cache.client.exists(failed_cache_key(query_id), refinement.parent_cache_key(query_id)): return []
+    return [file_format for file_format in file_formats if file_format in UNLOAD_FILE_FORMATS]
+
+# start the UNLOAD of the query, or attach the formats to the UNLOAD already started for it
+async def start(query_id: str, file_formats: List[SupportedFileFormats], request_id: str) -> None:
+    async def create() -> str:
+        query = (await aws.athena_client.get_query_execution(QueryExecutionId=query_id))['QueryExecution']['Query']
+        # UNLOAD needs an empty location, a new one per attempt
+        location = f"{AWS_S3_OUTPUT_DIR}{UNLOAD_PREFIX}/{query_id}/{uuid4()}/"
+        # admitted like the other queries: submitted right away if Athena has a free slot, otherwise a ticket waits in
+        # the submission queue and the dispatcher points unload_running:{query_id} at the UNLOAD once submitted
+        spec = {'query': unload_statement(query, location), 'cache_key': running_cache_key(query_id)}
+        return await query_scheduler.submit(spec, QUERY_PRIORITY_BULK)
+
+    unload_query_id, _ = await cache.single_flight(running_cache_key(query_id), create, QUERY_ID_CACHE_TTL)
+    await cache.put_many({export_scheduler.export_cache_key(query_id, file_format): f"UNLOADING {unload_query_id}" for file_format in file_formats})
+    # the UNLOAD already succeeded and its formats were moved on (see status), the new formats are compacted right away
+    parts = await cache.get_json(manifest_cache_key(query_id))
+    if parts is not None: await export_scheduler.enqueue(query_id, parts, file_formats, request_id, 'unload_compactor', UNLOAD_COMPACTION_COST_FACTORS)
+
+# paths of the Parquet files of the UNLOAD relative to AWS_S3_OUTPUT_DIR, from the manifest Athena writes next to the
+# query results
+def read_manifest(unload_query_id: str) -> List[str]:
+    with fsspec.open(f"{AWS_S3_OUTPUT_DIR}{unload_query_id}-manifest.csv", "r") as manifest:
+        return [line.strip()[len(AWS_S3_OUTPUT_DIR):] for line in manifest if line.strip()]
+
+# query ID of the UNLOAD a format waits on, its status is "UNLOADING {ID}" with the ID of the UNLOAD or of its ticket
+async def unloading_query_id(query_id: str, file_format: SupportedFileFormats) -> Optional[str]:
+    export_status = await cache.get(export_scheduler.export_cache_key(query_id, file_format))
+    if export_status is None or not export_status.startswith("UNLOADING "): return None
+    return (await status_tracker.resolve(export_status.split()[1]))[0]
+
+# status of a format being unloaded, None once it fell back to the CSV conversion (to be enqueued by the caller).
+# unload_id: the UNLOAD query ID or the ID of its ticket while it waits in the submission queue
+async def status(query_id: str, unload_id: str, request_id: str) -> Optional[dict]:
+    unload_query_id, state = await status_tracker.resolve(unload_id)
+    if state not in TERMINAL_QUERY_STATES: return {"status": "UNLOADING"}
+    # the first caller (across all workers) moves every format of the UNLOAD on, the others report it as in progress
+    if not await cache.client.set(f'unload_lock:{unload_query_id}', 1, nx=True, ex=UNLOAD_LOCK_TTL): return {"status": "UNLOADING"}
+    file_formats = [file_format for file_format in UNLOAD_FILE_FORMATS if await unloading_query_id(query_id, file_format) == unload_query_id]
+    parts = await run_in_threadpool(read_manifest, unload_query_id) if state == 'SUCCEEDED' else []
+    if not parts:
+        # failed, cancelled or an empty result (no files to take the schema from)
+        logger.error(f"unload query_id={query_id} unload_query_id={unload_query_id} state={state} parts=0, falling back to the CSV conversion")
+        await cache.put(failed_cache_key(query_id), state, QUERY_ID_CACHE_TTL)
+        await cache.client.delete(*[export_scheduler.export_cache_key(query_id, file_format) for file_format in file_formats], running_cache_key(query_id))
+        return None
+    await cache.put(manifest_cache_key(query_id), json.dumps(parts), QUERY_ID_CACHE_TTL)
+    queue, job_id = await export_scheduler.enqueue(query_id, parts, file_formats, request_id, 'unload_compactor', UNLOAD_COMPACTION_COST_FACTORS)
+    return {"status": "ACCEPTED", **await export_scheduler.position(queue, job_id)}
+
+# pre-signed URLs of the Parquet files of the UNLOAD, None if the query was not unloaded
+async def manifest_parts(query_id: str) -> Optional[List[str]]:
+    parts = await cache.get_json(manifest_cache_key(query_id))
+    if parts is None: return None
+    return [await aws.s3_client.generate_presigned_url('get_object', Params={'Bucket': 'ensembl-athena-results', 'Key': part}, ExpiresIn=PRESIGNED_URL_EXPIRATION_TIME) for part in parts]
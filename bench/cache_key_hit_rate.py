@@ -0,0 +1,55 @@
+# query cache hit rate of the canonical cache keys (app/canonical.py) vs the previous token sorting cache keys, over a
+# replayed query log. The log is the API request log (log.txt) or a JSON lines file of
+# {"data_type": ..., "species": ..., "fields": ..., "condition": ...} objects, ex.:
+# python bench/cache_key_hit_rate.py log.txt
+from urllib.parse import parse_qs
+import argparse, json, os, re, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.canonical import canonical_query
+
+REQUEST_LOG_REGEX = re.compile(r" /query/([^/?\s]+)/([^/?\s]+)(?:\?(\S*))? Time=")
+
+# cache key generator used before the canonical keys, kept here for comparison
+def legacy_cache_key(data_type: str, species: str, fields: str = "", condition: str = "") -> str:
+    condition = re.sub(r"\b(?<!')(\w+)(?!')\b", lambda match: match.group(1).lower(), condition)
+    return data_type + species + fields + ''.join(sorted(condition.split()))
+
+def read_queries(path: str):
+    with open(path) as log:
+        for line in log:
+            line = line.strip()
+            if line.startswith('{'):
+                query = json.loads(line)
+                yield query['data_type'], query['species'], query.get('fields', '*'), query.get('condition', '')
+                continue
+            match = REQUEST_LOG_REGEX.search(line)
+            # /query/{query_id}/status|preview|export share the path shape of /query/{data_type}/{species}
+            if not match or match.group(2) in ('status', 'preview', 'export'): continue
+            params = parse_qs(match.group(3) or '')
+            yield match.group(1), match.group(2), params.get('fields', ['*'])[0], params.get('condition', [''])[0]
+
+def replay(queries: list, key_function) -> dict:
+    seen = set()
+    hits = 0
+    for query in queries:
+        key = key_function(*query)
+        if key in seen: hits += 1
+        seen.add(key)
+    return {'queries': len(queries), 'hits': hits, 'hit_rate': round(hits / len(queries), 4) if queries else 0.0, 'distinct_keys': len(seen)}
+
+def false_hits(queries: list) -> int:
+    # hits on a legacy key that was produced by a semantically different query
+    owners, count = {}, 0
+    for query in queries:
+        canonical = canonical_query(*query)
+        if owners.setdefault(legacy_cache_key(*query), canonical) != canonical: count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query cache key hit rate over a replayed query log")
+    parser.add_argument("log", help="API request log (log.txt) or JSON lines query log")
+    queries = list(read_queries(parser.parse_args().log))
+    legacy = replay(queries, legacy_cache_key)
+    legacy['false_hits'] = false_hits(queries)
+    print(json.dumps({'legacy': legacy, 'canonical': replay(queries, canonical_query)}, indent=2))
@@ -0,0 +1,47 @@
+# compare two JSON reports of bench/e2e.py and flag the regressions, exits with status 1 if any metric regressed by
+# more than the threshold, ex.: python -m bench.compare baseline.json run.json --threshold 10
+import argparse, json, sys
+
+# metric name suffix -> True if higher is better, checked in order
+METRIC_DIRECTIONS = {
+    "_rps": True, "rows_per_s": True, "mb_per_s": True, "hit_ratio": True,
+    "_ms": False, "seconds": False, "_s": False, "peak_rss_mb": False,
+}
+
+def flatten(report: dict, prefix: str = "") -> dict:
+    metrics = {}
+    for key, value in report.items():
+        if key == "meta": continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict): metrics.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool): metrics[name] = value
+    return metrics
+
+def direction(metric: str):
+    for suffix, higher_is_better in METRIC_DIRECTIONS.items():
+        if metric.endswith(suffix): return higher_is_better
+    return None
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    baseline_metrics, current_metrics = flatten(baseline), flatten(current)
+    rows = []
+    for metric in sorted(baseline_metrics.keys() & current_metrics.keys()):
+        higher_is_better = direction(metric)
+        if higher_is_better is None: continue
+        old, new = baseline_metrics[metric], current_metrics[metric]
+        change = (new - old) / old * 100 if old else 0.0
+        regressed = (change < -threshold) if higher_is_better else (change > threshold)
+        rows.append((metric, old, new, change, regressed))
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10, help="allowed change in percent before a metric counts as a regression")
+    args = parser.parse_args()
+    with open(args.baseline) as baseline, open(args.current) as current:
+        rows = compare(json.load(baseline), json.load(current), args.threshold)
+    for metric, old, new, change, regressed in rows:
+        print(f"{'REGRESSION ' if regressed else '           '}{metric}: {old} -> {new} ({change:+.1f}%)")
+    sys.exit(1 if any(row[4] for row in rows) else 0)
@@ -0,0 +1,215 @@
+# offline end-to-end benchmark of the API (app/main.py) and the export converter (app/tasks.py, app/converters.py)
+# against local stand-ins: the fake Athena / S3 clients of bench/fake_aws.py over synthetic result CSVs and a local Redis
+# (a dedicated database, flushed at the start of the run). Results are written as JSON, compare two runs with
+# bench/compare.py. Ex.:
+# python -m bench.e2e --result-sizes 1MB,100MB --aws-latency-ms 50 --with-worker --output run.json
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, time
+import aiohttp, argparse, asyncio, json, multiprocessing, os, random, resource, subprocess, sys, tempfile
+
+from bench.fake_aws import RESULT_COLUMN_TYPES, generate_result_csv, parse_size
+from bench.status_polling import percentile
+
+BENCH_FILE_FORMATS = ["tsv", "json", "feather", "parquet", "xml", "xlsx", "csv.gz", "tsv.zst", "zstd.parquet"]
+
+def latency_summary(latencies: list, errors: int, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+async def load(session: aiohttp.ClientSession, base_url: str, paths: list, concurrency: int) -> dict:
+    latencies, errors, queue = [], [0], list(paths)
+
+    async def worker():
+        while queue:
+            path = queue.pop()
+            start_time = perf_counter()
+            async with session.get(base_url + path) as response:
+                await response.read()
+                if response.status >= 400: errors[0] += 1
+            latencies.append((perf_counter() - start_time) * 1000)
+
+    start_time = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latency_summary(latencies, errors[0], perf_counter() - start_time)
+
+async def wait_until(session: aiohttp.ClientSession, url: str, done, timeout: float = 600, interval: float = 0.1) -> dict:
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            async with session.get(url) as response:
+                content = await response.json(content_type=None)
+                if done(response.status, content): return content
+        except aiohttp.ClientConnectionError:
+            pass
+        await asyncio.sleep(interval)
+    raise TimeoutError(f"timed out waiting for {url}")
+
+# started_at: perf_counter() when the API process was started
+async def run_endpoints(args, base_url: str, started_at: float) -> dict:
+    results = {}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+        await wait_until(session, base_url + "/", lambda status, _: status == 200, timeout=60, interval=0.01)
+        results["time_to_first_request_ms"] = round((perf_counter() - started_at) * 1000, 2)
+
+        for path in ("/data_types", "/filters/gene", "/result_file_formats"):
+            results[path] = await load(session, base_url, [path] * args.requests, args.concurrency)
+
+        # query submissions, args.distinct_queries different conditions so that most of the submissions are cache hits
+        submissions = [f"/query/gene/homo_sapiens?condition=gene_id>{random.randrange(args.distinct_queries)}" for _ in range(args.requests)]
+        results["/query/{data_type}/{species}"] = await load(session, base_url, submissions, args.concurrency)
+
+        async with session.get(base_url + "/query/gene/homo_sapiens?condition=gene_id>0") as response:
+            query_id = (await response.json(content_type=None))["query_id"]
+        status_path = f"/query/{query_id}/status"
+        results["/query/{query_id}/status"] = await load(session, base_url, [status_path] * args.requests, args.concurrency)
+        await wait_until(session, base_url + status_path + "?wait=5", lambda _, content: content.get("status") == "SUCCEEDED")
+
+        # the first preview materializes the result sidecar
+        start_time = perf_counter()
+        await wait_until(session, base_url + f"/query/{query_id}/preview", lambda status, _: status == 200)
+        results["preview_first_request_ms"] = round((perf_counter() - start_time) * 1000, 2)
+        async with session.get(base_url + f"/query/{query_id}/preview?maxResults=1") as response:
+            total_rows = (await response.json(content_type=None)).get("TotalRows", 1)
+        previews = [f"/query/{query_id}/preview?offset={random.randrange(max(total_rows, 1))}&maxResults=100" for _ in range(args.requests)]
+        results["/query/{query_id}/preview"] = await load(session, base_url, previews, args.concurrency)
+        # a narrower version of the succeeded query, filtered locally from its result instead of a new (fake) Athena query
+        start_time = perf_counter()
+        async with session.get(base_url + "/query/gene/homo_sapiens?condition=gene_id>0 AND biotype='miRNA'&fields=gene_id,biotype") as response:
+            refined_query_id = (await response.json(content_type=None))["query_id"]
+        await wait_until(session, base_url + f"/query/{refined_query_id}/status?wait=5", lambda _, content: content.get("status") == "SUCCEEDED")
+        results["refined_query_time_to_succeeded_ms"] = round((perf_counter() - start_time) * 1000, 2)
+        # direct download, converted on the fly in the API (results up to DIRECT_DOWNLOAD_MAX_BYTES)
+        results["/query/{query_id}/download"] = await load(session, base_url, [f"/query/{query_id}/download?file_format=tsv"] * max(args.requests // 10, 1), args.concurrency)
+
+        if args.with_worker:
+            exports = {}
+            for file_format in args.formats:
+                export_url = base_url + f"/query/{query_id}/export?file_format={file_format}"
+                start_time = perf_counter()
+                content = await wait_until(session, export_url, lambda _, content: content.get("status") in ("DONE", "FAILED, you can try again after one minute interval!"))
+                exports[file_format] = {"status": content["status"], "time_to_done_s": round(perf_counter() - start_time, 3)}
+            results["exports"] = exports
+
+        async with session.get(base_url + "/cache/stats") as response:
+            results["cache_stats"] = await response.json(content_type=None)
+    return results
+
+# runs in a fresh process per measurement so that ru_maxrss is the peak of this conversion only
+def convert_once(csv_path: str, file_format: str, output_path: str) -> dict:
+    from app.converters import stream_convert_many
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = perf_counter()
+    with open(csv_path, "rb") as source, open(output_path, "wb") as sink:
+        rows, errors = stream_convert_many(source, {file_format: sink}, column_types=RESULT_COLUMN_TYPES)
+    elapsed = max(perf_counter() - start_time, 1e-9)
+    if errors: return {"error": str(errors[file_format])}
+    return {
+        "seconds": round(elapsed, 3),
+        "rows": rows,
+        "rows_per_s": round(rows / elapsed),
+        "mb_per_s": round(os.path.getsize(csv_path) / elapsed / 1e6, 2),
+        "output_mb": round(os.path.getsize(output_path) / 1e6, 2),
+        "baseline_rss_mb": round(baseline_rss / 1024, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def run_converter(csv_paths: dict, file_formats: list, output_dir: str) -> dict:
+    results = {}
+    for size, csv_path in csv_paths.items():
+        results[size] = {}
+        for file_format in file_formats:
+            output_path = os.path.join(output_dir, f"converter_bench.{file_format}")
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[size][file_format] = executor.submit(convert_once, csv_path, file_format, output_path).result()
+            os.remove(output_path)
+    return results
+
+# import time of a module in a fresh interpreter (median of the runs), the cold start cost of a new API / Celery worker
+def import_time_ms(module: str, env: dict, root_dir: str, runs: int = 5) -> float:
+    code = f"from time import perf_counter; start_time = perf_counter(); import {module}; print((perf_counter() - start_time) * 1000)"
+    times = [float(subprocess.run([sys.executable, "-c", code], env=env, cwd=root_dir, capture_output=True, text=True, check=True).stdout) for _ in range(runs)]
+    return round(percentile(times, 50), 2)
+
+def redis_hit_ratio(info: dict, baseline: dict) -> dict:
+    hits = info["keyspace_hits"] - baseline["keyspace_hits"]
+    misses = info["keyspace_misses"] - baseline["keyspace_misses"]
+    return {"hits": hits, "misses": misses, "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0.0}
+
+def main(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ensembl_lakehouse_bench_")
+    data_dir, output_dir = os.path.join(workdir, "data"), os.path.join(workdir, "results")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    csv_paths = {}
+    for size in args.result_sizes.split(","):
+        csv_paths[size] = os.path.join(data_dir, f"result_{size}.csv")
+        if not os.path.exists(csv_paths[size]) or os.path.getsize(csv_paths[size]) < parse_size(size):
+            generate_result_csv(csv_paths[size], parse_size(size))
+    # results of an exact row count, converter only (ex.: the xlsx sheet splitting past 1,048,576 rows)
+    row_csv_paths = {}
+    for rows in filter(None, (args.result_rows or "").split(",")):
+        row_csv_paths[f"{rows}_rows"] = os.path.join(data_dir, f"result_{rows}_rows.csv")
+        if not os.path.exists(row_csv_paths[f"{rows}_rows"]):
+            generate_result_csv(row_csv_paths[f"{rows}_rows"], 0, max_rows=int(rows))
+
+    report = {"meta": {"timestamp": time(), "args": vars(args)}}
+    if not args.skip_converter:
+        report["converter"] = run_converter({**csv_paths, **row_csv_paths}, args.formats, output_dir)
+    root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    if not args.skip_startup:
+        env = dict(os.environ, LOG_FILE=os.path.join(workdir, "log.txt"))
+        report["startup"] = {f"{module}_import_ms": import_time_ms(module, env, root_dir) for module in ("app.main", "app.tasks")}
+    if args.skip_endpoints: return report
+
+    from redis import Redis
+    redis = Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", 6379)), db=args.redis_db)
+    redis.flushdb()
+    env = dict(os.environ, AWS_S3_OUTPUT_DIR=f"file://{output_dir}/", REDIS_DB=str(args.redis_db), PREVIEW_SIDECAR_DIR=os.path.join(workdir, "previews"),
+               BENCH_RESULT_CSV=csv_paths[args.result_sizes.split(",")[0]], BENCH_AWS_LATENCY_MS=str(args.aws_latency_ms),
+               BENCH_QUERY_DURATION=str(args.query_duration), BENCH_PORT=str(args.port), CELERY_CATALOG_WARM_UP="0")
+    started_at = perf_counter()
+    processes = [subprocess.Popen([sys.executable, "-m", "bench.server"], env=env, cwd=root_dir)]
+    if args.with_worker:
+        processes.append(subprocess.Popen([sys.executable, "-m", "celery", "-A", "app.tasks", "worker", "-Q", "exports_fast,exports_bulk", "--concurrency", "2", "--loglevel", "WARNING"], env=env, cwd=root_dir))
+    try:
+        baseline = redis.info("stats")
+        report["endpoints"] = asyncio.run(run_endpoints(args, f"http://127.0.0.1:{args.port}", started_at))
+        report.setdefault("startup", {})["time_to_first_request_ms"] = report["endpoints"].pop("time_to_first_request_ms")
+        report["cache"] = {"redis": redis_hit_ratio(redis.info("stats"), baseline), "l1": report["endpoints"].pop("cache_stats")["l1"]}
+        l1 = report["cache"]["l1"]
+        l1["hit_ratio"] = round(l1["hits"] / (l1["hits"] + l1["misses"]), 4) if l1["hits"] + l1["misses"] else 0.0
+    finally:
+        for process in processes: process.terminate()
+        for process in processes: process.wait()
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with local AWS and Redis stand-ins")
+    parser.add_argument("--result-sizes", default="1MB,100MB", help="comma separated synthetic result CSV sizes (KB/MB/GB), ex.: 1MB,1GB,5GB")
+    parser.add_argument("--result-rows", help="comma separated row counts of additional synthetic results for the converter benchmark, ex.: 1000000,10000000")
+    parser.add_argument("--formats", type=lambda formats: formats.split(","), default=BENCH_FILE_FORMATS, help="comma separated export formats")
+    parser.add_argument("--aws-latency-ms", type=float, default=20, help="latency added to every fake AWS call")
+    parser.add_argument("--query-duration", type=float, default=1, help="seconds a fake Athena query takes to succeed")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--distinct-queries", type=int, default=10, help="distinct query submissions among the submission requests")
+    parser.add_argument("--with-worker", action="store_true", help="also start a Celery worker and time the exports end-to-end")
+    parser.add_argument("--skip-converter", action="store_true")
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--skip-startup", action="store_true", help="skip the import time measurements")
+    parser.add_argument("--redis-db", type=int, default=15, help="Redis database used (and flushed) by the run")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workdir", help="directory for the synthetic data, reused across runs (default: new temporary directory)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+    output = json.dumps(main(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as file: file.write(output)
+    print(output)
@@ -0,0 +1,164 @@
+# local stand-ins for the Athena and S3 aiobotocore clients used by app/aws.py, with a configurable latency per call.
+# Query results are synthetic Athena style CSV files in a local directory (AWS_S3_OUTPUT_DIR=file:///...), every
+# started query is served by a copy (hard link) of the synthetic result file the server was configured with. An UNLOAD
+# writes that result as Parquet files to its (local) location, with the manifest Athena writes next to the results
+from botocore.exceptions import ClientError
+from time import monotonic
+from uuid import uuid4
+from pyarrow import csv as pa_csv
+import pyarrow.parquet as pq
+import asyncio, csv, itertools, os, random, re, shutil
+
+COLUMNS = ["gene_id", "gene_stable_id", "species", "biotype", "seq_region_start", "seq_region_end", "description"]
+SPECIES = ["homo_sapiens", "mus_musculus", "danio_rerio", "rattus_norvegicus", "gallus_gallus"]
+BIOTYPES = ["protein_coding", "lncRNA", "miRNA", "pseudogene", "snRNA"]
+TABLES = {
+    "gene": [{"Name": name, "Type": "bigint" if name in ("gene_id", "seq_region_start", "seq_region_end") else "string"} for name in COLUMNS],
+    "variation": [{"Name": "variation_id", "Type": "bigint"}, {"Name": "name", "Type": "string"}, {"Name": "species", "Type": "string"}],
+}
+# Athena column types of the synthetic result CSVs
+RESULT_COLUMN_TYPES = {column["Name"]: "varchar" if column["Type"] == "string" else column["Type"] for column in TABLES["gene"]}
+
+def parse_size(size: str) -> int:
+    units = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+    size = size.strip().upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit): return int(float(size[:-len(unit)]) * multiplier)
+    return int(size)
+
+# write an Athena style CSV (header row, every value quoted) of about `size` bytes or of exactly `max_rows` rows, rows are
+# generated a block at a time
+def generate_result_csv(path: str, size: int, seed: int = 0, max_rows: int = None) -> int:
+    rng = random.Random(seed)
+    rows = 0
+    with open(path, "w") as csv:
+        written = csv.write(",".join(f'"{column}"' for column in COLUMNS) + "\n")
+        while (rows < max_rows) if max_rows is not None else (written < size):
+            block = []
+            for _ in range(min(10000, max_rows - rows) if max_rows is not None else 10000):
+                start = rng.randint(1, 200_000_000)
+                block.append(f'"{rows}","ENSG{rows:011d}","{rng.choice(SPECIES)}","{rng.choice(BIOTYPES)}","{start}","{start + rng.randint(100, 100_000)}","synthetic gene {rng.random():.6f}"\n')
+                rows += 1
+            written += csv.write("".join(block))
+    return rows
+
+def client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakeAWSClient:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+
+    async def call(self, operation: str) -> None:
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency: await asyncio.sleep(self.latency)
+
+
+class FakeAthenaClient(FakeAWSClient):
+    # queries go QUEUED -> RUNNING -> SUCCEEDED over query_duration seconds, a submission beyond max_concurrency
+    # queries in flight is throttled as Athena does past the account's concurrent query limit
+    def __init__(self, output_dir: str, result_csv: str, latency: float = 0.0, query_duration: float = 1.0, max_concurrency: int = None):
+        super().__init__(latency)
+        self.output_dir = output_dir
+        self.result_csv = result_csv
+        self.query_duration = query_duration
+        self.max_concurrency = max_concurrency
+        self.queries = {}
+
+    def state(self, query_id: str) -> str:
+        if query_id not in self.queries: raise client_error("InvalidRequestException", f"QUERY_NOT_FOUND: Query {query_id} was not found", "GetQueryExecution")
+        elapsed = monotonic() - self.queries[query_id][0]
+        if elapsed >= self.query_duration: return "SUCCEEDED"
+        return "RUNNING" if elapsed >= self.query_duration / 2 else "QUEUED"
+
+    def execution(self, query_id: str) -> dict:
+        return {"QueryExecutionId": query_id, "Query": self.queries[query_id][1] if query_id in self.queries else "", "Status": {"State": self.state(query_id)}}
+
+    async def start_query_execution(self, QueryString: str, **kwargs) -> dict:
+        await self.call("StartQueryExecution")
+        if self.max_concurrency is not None and sum(monotonic() - start_time < self.query_duration for start_time, _ in self.queries.values()) >= self.max_concurrency:
+            self.calls["Throttled"] = self.calls.get("Throttled", 0) + 1
+            raise client_error("TooManyRequestsException", "You have exceeded the limit for the number of queries you can run concurrently", "StartQueryExecution")
+        query_id = str(uuid4())
+        unload = re.match(r"\s*UNLOAD\s*\(.*\)\s*TO\s*'([^']+)'", QueryString, re.IGNORECASE | re.DOTALL)
+        if unload: self.unload(query_id, unload.group(1))
+        else:
+            result_path = os.path.join(self.output_dir, f"{query_id}.csv")
+            try:
+                os.link(self.result_csv, result_path)
+            except OSError:
+                shutil.copyfile(self.result_csv, result_path)
+        self.queries[query_id] = (monotonic(), QueryString)
+        return {"QueryExecutionId": query_id}
+
+    # the result as Parquet files of part_rows rows, as Athena writes one file per writer
+    def unload(self, query_id: str, location: str, part_rows: int = 100_000) -> None:
+        directory = location[len("file://"):]
+        os.makedirs(directory, exist_ok=True)
+        table = pa_csv.read_csv(self.result_csv)
+        parts = []
+        for i, offset in enumerate(range(0, max(table.num_rows, 1), part_rows)):
+            parts.append(f"{location.rstrip('/')}/{query_id}_{i:05d}.parquet")
+            pq.write_table(table.slice(offset, part_rows), os.path.join(directory, f"{query_id}_{i:05d}.parquet"))
+        with open(os.path.join(self.output_dir, f"{query_id}-manifest.csv"), "w") as manifest:
+            manifest.write("\n".join(parts) + "\n")
+
+    async def get_query_execution(self, QueryExecutionId: str) -> dict:
+        await self.call("GetQueryExecution")
+        return {"QueryExecution": self.execution(QueryExecutionId)}
+
+    async def batch_get_query_execution(self, QueryExecutionIds: list) -> dict:
+        await self.call("BatchGetQueryExecution")
+        known = [query_id for query_id in QueryExecutionIds if query_id in self.queries]
+        return {
+            "QueryExecutions": [self.execution(query_id) for query_id in known],
+            "UnprocessedQueryExecutionIds": [{"QueryExecutionId": query_id, "ErrorCode": "INVALID_INPUT", "ErrorMessage": "Query was not found"} for query_id in QueryExecutionIds if query_id not in self.queries],
+        }
+
+    async def list_table_metadata(self, **kwargs) -> dict:
+        await self.call("ListTableMetadata")
+        return {"TableMetadataList": [{"Name": name, "Columns": columns} for name, columns in TABLES.items()]}
+
+    async def get_table_metadata(self, TableName: str, **kwargs) -> dict:
+        await self.call("GetTableMetadata")
+        if TableName not in TABLES: raise client_error("MetadataException", f"Table {TableName} does not exist", "GetTableMetadata")
+        return {"TableMetadata": {"Name": TableName, "Columns": TABLES[TableName]}}
+
+    async def get_query_results(self, QueryExecutionId: str, MaxResults: int = 1000, **kwargs) -> dict:
+        await self.call("GetQueryResults")
+        self.state(QueryExecutionId)
+        if "DISTINCT" in self.queries[QueryExecutionId][1]:
+            # SELECT DISTINCT species catalog queries
+            rows = [{"Data": [{"VarCharValue": "species"}]}] + [{"Data": [{"VarCharValue": species}]} for species in SPECIES]
+        else:
+            with open(self.result_csv, newline="") as result:
+                rows = [{"Data": [{"VarCharValue": value} if value else {} for value in row]} for row in itertools.islice(csv.reader(result), MaxResults)]
+        column_info = [{"Name": name, "Type": athena_type} for name, athena_type in RESULT_COLUMN_TYPES.items()]
+        return {"ResultSet": {"Rows": rows, "ResultSetMetadata": {"ColumnInfo": column_info}}}
+
+    def get_paginator(self, operation: str):
+        client = self
+
+        class Paginator:
+            async def paginate(self, **kwargs):
+                yield await getattr(client, operation)(**kwargs)
+
+        return Paginator()
+
+
+class FakeS3Client(FakeAWSClient):
+    def __init__(self, output_dir: str, latency: float = 0.0):
+        super().__init__(latency)
+        self.output_dir = output_dir
+
+    async def head_object(self, Bucket: str, Key: str) -> dict:
+        await self.call("HeadObject")
+        path = os.path.join(self.output_dir, Key)
+        if not os.path.exists(path): raise client_error("404", "Not Found", "HeadObject")
+        return {"ContentLength": os.path.getsize(path)}
+
+    # local file URL instead of a pre-signed S3 URL, urlopen reads both
+    async def generate_presigned_url(self, operation: str, Params: dict, ExpiresIn: int = 3600) -> str:
+        return "file://" + os.path.join(self.output_dir, Params["Key"])
@@ -0,0 +1,26 @@
+# runs the API (app/main.py) against the local AWS stand-ins of bench/fake_aws.py, started by bench/e2e.py.
+# Config (env): AWS_S3_OUTPUT_DIR=file:///<dir>/, BENCH_RESULT_CSV, BENCH_AWS_LATENCY_MS, BENCH_QUERY_DURATION, BENCH_PORT,
+# BENCH_ATHENA_CONCURRENCY (throttle the submissions beyond this many queries in flight)
+import os, sys, uvicorn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench.fake_aws import FakeAthenaClient, FakeS3Client
+from app import aws
+from app.constants import AWS_S3_OUTPUT_DIR
+import app.main
+
+async def open_fake_clients() -> None:
+    output_dir = AWS_S3_OUTPUT_DIR[len("file://"):]
+    latency = float(os.getenv("BENCH_AWS_LATENCY_MS", 0)) / 1000
+    max_concurrency = int(os.environ["BENCH_ATHENA_CONCURRENCY"]) if os.getenv("BENCH_ATHENA_CONCURRENCY") else None
+    aws.athena_client = FakeAthenaClient(output_dir, os.environ["BENCH_RESULT_CSV"], latency, float(os.getenv("BENCH_QUERY_DURATION", 1)), max_concurrency)
+    aws.s3_client = FakeS3Client(output_dir, latency)
+
+async def close_fake_clients() -> None:
+    pass
+
+if __name__ == "__main__":
+    if not AWS_S3_OUTPUT_DIR.startswith("file://"): sys.exit("AWS_S3_OUTPUT_DIR must be a local file:// directory")
+    aws.open_clients = open_fake_clients
+    aws.close_clients = close_fake_clients
+    uvicorn.run(app.main.app, host="127.0.0.1", port=int(os.getenv("BENCH_PORT", 8765)), log_level="warning")
@@ -0,0 +1,41 @@
+# concurrent /query/{query_id}/status polling load test
+# run it against the API before and after a change and compare the reported latency percentiles, ex.:
+# python bench/status_polling.py --url http://localhost:8000 --query-id <athena_query_id> --clients 50 --requests 20
+from time import perf_counter
+import aiohttp, argparse, asyncio, json
+
+def percentile(latencies: list, p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+
+async def poll(session: aiohttp.ClientSession, url: str, requests: int, latencies: list, errors: list) -> None:
+    for _ in range(requests):
+        start_time = perf_counter()
+        async with session.get(url) as response:
+            await response.read()
+            if response.status != 200: errors.append(response.status)
+        latencies.append((perf_counter() - start_time) * 1000)
+
+async def main(args) -> dict:
+    url = f"{args.url.rstrip('/')}/query/{args.query_id}/status"
+    latencies, errors = [], []
+    start_time = perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.clients)) as session:
+        await asyncio.gather(*(poll(session, url, args.requests, latencies, errors) for _ in range(args.clients)))
+    elapsed = perf_counter() - start_time
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent query status polling load test")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--query-id", required=True)
+    parser.add_argument("--clients", type=int, default=50, help="concurrent polling clients")
+    parser.add_argument("--requests", type=int, default=20, help="status requests per client")
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
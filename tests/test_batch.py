@@ -0,0 +1,35 @@
+import asyncio
+
+import fakeredis.aioredis
+
+from app import cache, catalog_index, main
+from app.constants import BATCH_FANOUT_MAX_SPECIES
+
+SPECIES = [f'species_{i}' for i in range(BATCH_FANOUT_MAX_SPECIES + 1)]
+
+def merge(monkeypatch, species, condition='', partitioned=True, cached=()):
+    async def get_entry(data_type):
+        return {'columns': [], 'species': species, 'species_partitioned': partitioned}, False
+    monkeypatch.setattr(catalog_index, 'get_entry', get_entry)
+    async def run():
+        monkeypatch.setattr(cache, 'client', fakeredis.aioredis.FakeRedis())
+        for name in cached: await cache.client.set(main.cache_key_generator('gene', name, '*', condition), 'query_id')
+        return await main.merge_species('gene', species, '*', condition)
+    return asyncio.run(run())
+
+def test_a_table_not_partitioned_by_species_is_scanned_once(monkeypatch):
+    assert merge(monkeypatch, SPECIES[:2], partitioned=False)
+
+def test_a_partitioned_table_fans_out_unfiltered_scans_and_few_species(monkeypatch):
+    assert not merge(monkeypatch, SPECIES)
+    assert not merge(monkeypatch, SPECIES[:BATCH_FANOUT_MAX_SPECIES], condition='gene_id > 5')
+
+def test_many_filtered_species_of_a_partitioned_table_share_one_query(monkeypatch):
+    assert merge(monkeypatch, SPECIES, condition='gene_id > 5')
+
+def test_species_queries_already_submitted_are_reused(monkeypatch):
+    assert not merge(monkeypatch, SPECIES[:2], partitioned=False, cached=SPECIES[:2])
+    assert merge(monkeypatch, SPECIES[:2], partitioned=False, cached=SPECIES[:1])
+
+def test_a_single_species_is_never_merged(monkeypatch):
+    assert not merge(monkeypatch, SPECIES[:1], partitioned=False)
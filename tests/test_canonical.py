@@ -0,0 +1,67 @@
+import pytest
+
+from app import main
+from app.canonical import ConditionParseError, ConditionParser, canonical_condition, canonical_fields, canonical_query, tokenize
+
+@pytest.mark.parametrize('condition, equivalent', [
+    ("biotype = 'lncRNA' AND gene_id > 5", "gene_id>5 and biotype='lncRNA'"),
+    ("biotype = 'lncRNA'", "  BIOTYPE   =  'lncRNA'  "),
+    ("biotype = 'lncRNA'", "\"Biotype\" = 'lncRNA'"),
+    ("gene_id > 5", "5 < gene_id"),
+    ("gene_id <> 5", "gene_id != 5"),
+    ("a = 1 AND (b = 2 AND c = 3)", "(c = 3 AND a = 1) AND b = 2"),
+    ("a = 1 OR b = 2", "b = 2 OR a = 1 OR a = 1"),
+    ("biotype IN ('miRNA', 'lncRNA')", "biotype in ('lncRNA','miRNA','lncRNA')"),
+    ("a = 1 AND (b = 2 OR c = 3)", "(c = 3 OR b = 2) AND a = 1"),
+    ("gene_id NOT BETWEEN 1 AND 5", "gene_id not between 1 and 5"),
+    ("description IS NOT NULL", "description is not null"),
+])
+def test_equivalent_conditions(condition, equivalent):
+    assert canonical_condition(condition) == canonical_condition(equivalent)
+
+@pytest.mark.parametrize('condition, different', [
+    # string literals are case sensitive
+    ("biotype = 'lncRNA'", "biotype = 'LNCRNA'"),
+    ("gene_id > 5", "gene_id >= 5"),
+    ("a = 1 AND (b = 2 OR c = 3)", "(a = 1 AND b = 2) OR c = 3"),
+    ("a = 1 AND b = 2", "a = 1 OR b = 2"),
+    ("gene_id BETWEEN 1 AND 5", "gene_id NOT BETWEEN 1 AND 5"),
+])
+def test_different_conditions(condition, different):
+    assert canonical_condition(condition) != canonical_condition(different)
+
+def test_equivalent_queries_share_the_cache_key():
+    assert canonical_fields(' Gene_ID , biotype,gene_id') == 'biotype,gene_id'
+    assert canonical_fields('') == canonical_fields(None) == '*'
+    assert canonical_query('gene', 'homo_sapiens', 'biotype, gene_id', "gene_id > 5 AND biotype = 'lncRNA'") \
+        == canonical_query('gene', 'homo_sapiens', 'gene_id,biotype', "biotype = 'lncRNA' and 5 < gene_id")
+    assert main.cache_key_generator('gene', 'homo_sapiens', 'biotype, gene_id', "gene_id > 5 AND biotype = 'lncRNA'") \
+        == main.cache_key_generator('gene', 'homo_sapiens', 'gene_id,biotype', "biotype = 'lncRNA' and 5 < gene_id")
+    assert main.cache_key_generator('gene', 'homo_sapiens', '', 'gene_id > 5') != main.cache_key_generator('gene', 'mus_musculus', '', 'gene_id > 5')
+
+@pytest.mark.parametrize('condition', [
+    "gene_id >",
+    "gene_id = 5 AND",
+    "(gene_id = 5",
+    "gene_id = 5)",
+    "gene_id IN (1, 2",
+    "gene_id BETWEEN 1",
+    "gene_id IS 5",
+    "gene_id 5",
+    "AND gene_id = 5",
+])
+def test_malformed_conditions_are_rejected_by_the_parser(condition):
+    with pytest.raises(ConditionParseError):
+        ConditionParser(tokenize(condition)).parse()
+
+@pytest.mark.parametrize('condition', ["biotype = 'lncRNA", "gene_id = 5 ; DROP TABLE gene", "gene_id # 5"])
+def test_untokenizable_conditions_are_rejected(condition):
+    with pytest.raises(ConditionParseError):
+        tokenize(condition)
+
+# a condition the parser does not understand keeps its token order, only its whitespace and case are normalized
+def test_malformed_conditions_fall_back_to_normalized_text():
+    assert canonical_condition("gene_id =  5 AND") == canonical_condition("GENE_ID = 5 and")
+    assert canonical_condition("gene_id = 5 AND") != canonical_condition("AND gene_id = 5")
+    assert canonical_condition("biotype = 'lncRNA") == "biotype = 'lncRNA"
+    assert canonical_condition("   ") == canonical_condition("") == ''
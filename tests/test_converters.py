@@ -0,0 +1,45 @@
+import io, time, zipfile
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from app.converters import XLSXWriter, XMLWriter, open_csv_stream, stream_to_writer
+
+RESULT_CSV = (b'"gene_id","seq_region_name","biotype","score","canonical"\n'
+    b'"ENSG00000000001","1","protein_coding",1.0,true\n'
+    b'"ENSG00000000002","X","",,false\n'
+    b'"ENSG00000000003","007","lncRNA\x01",0.00001,\n'
+    b'"ENSG00000000004",,,1e16,true\n')
+COLUMN_TYPES = {'gene_id': 'varchar', 'seq_region_name': 'varchar', 'biotype': 'varchar', 'score': 'double', 'canonical': 'boolean'}
+
+def convert(writer_class) -> bytes:
+    sink = io.BytesIO()
+    stream_to_writer(io.BytesIO(RESULT_CSV), writer_class, sink, column_types=COLUMN_TYPES)
+    return sink.getvalue()
+
+def test_xlsx_is_deterministic(monkeypatch):
+    clock = iter(range(1700000000, 1800000000, 3600))
+    monkeypatch.setattr(time, 'time', lambda: float(next(clock)))
+    first, second = convert(XLSXWriter), convert(XLSXWriter)
+    assert first == second
+    with zipfile.ZipFile(io.BytesIO(first)) as archive:
+        assert {info.date_time for info in archive.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+        assert archive.testzip() is None
+
+def test_xlsx_strips_illegal_characters():
+    with zipfile.ZipFile(io.BytesIO(convert(XLSXWriter))) as archive:
+        sheet = archive.read('xl/worksheets/sheet1.xml').decode()
+    assert '\x01' not in sheet and '>lncRNA<' in sheet
+
+def test_xml_matches_pandas():
+    pytest.importorskip('lxml')
+    df = open_csv_stream(io.BytesIO(RESULT_CSV), column_types=COLUMN_TYPES).read_all().to_pandas()
+    df['biotype'] = df['biotype'].str.replace('\x01', '')
+    assert convert(XMLWriter).decode() == df.to_xml(index=False)
+
+def test_xml_empty_result():
+    sink = io.BytesIO()
+    writer = XMLWriter(sink, pa.schema([('gene_id', pa.string())]))
+    writer.close()
+    assert sink.getvalue().decode() == pd.DataFrame({'gene_id': []}).to_xml(index=False)
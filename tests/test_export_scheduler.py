@@ -0,0 +1,64 @@
+import asyncio
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from app import cache, export_scheduler, tasks
+from app.constants import SupportedFileFormats
+
+# the async client of the API and the sync client of the Celery worker on one fake Redis server
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(tasks, 'r', fakeredis.FakeRedis(server=server))
+    return server
+
+def test_export_cache_key_uses_the_format_value():
+    assert export_scheduler.export_cache_key('q', SupportedFileFormats.tsv) == 'q.tsv'
+    assert export_scheduler.export_cache_key('q', SupportedFileFormats.parquet_zstd) == f'q.{SupportedFileFormats.parquet_zstd.value}'
+    assert export_scheduler.export_cache_key('q', 'xlsx') == 'q.xlsx'
+
+# the API enqueues and polls the export status, the worker writes the file and its status: both use the same keys
+def test_api_and_worker_agree_on_the_export_keys(server, tmp_path, monkeypatch):
+    published = []
+    async def estimate_cost(*args, **kwargs): return 1.0
+    monkeypatch.setattr(export_scheduler, 'estimate_cost', estimate_cost)
+    monkeypatch.setattr(tasks.file_format_converter, 'apply_async', lambda args, kwargs=None, queue=None: published.append(args))
+    monkeypatch.setattr(tasks, 'AWS_S3_OUTPUT_DIR', f'file://{tmp_path}/')
+    file_formats = [SupportedFileFormats.tsv, SupportedFileFormats.json]
+
+    def convert(sinks):
+        for sink in sinks.values(): sink.write(b'data')
+        return 1, 4, {}
+
+    async def run():
+        monkeypatch.setattr(cache, 'client', fakeredis.aioredis.FakeRedis(server=server))
+        queue, job_id = await export_scheduler.enqueue('q', 'url', file_formats, 'request')
+        for file_format in file_formats:
+            assert await cache.get(export_scheduler.export_cache_key('q', file_format)) == f'QUEUED {queue} {job_id}'
+
+        query_id, _, formats, request_id, queue, job_id, cost = published[0]
+        tasks.export('file_format_converter', query_id, formats, request_id, queue, job_id, cost, convert)
+
+        for file_format in file_formats:
+            assert await cache.get(export_scheduler.export_cache_key('q', file_format)) == 'DONE'
+            assert (tmp_path / export_scheduler.export_cache_key('q', file_format)).read_bytes() == b'data'
+        assert await cache.client.zcard(export_scheduler.queue_key(queue)) == 0
+    asyncio.run(run())
+
+# a sink failing to open fails the export, the sinks opened before it are discarded instead of left behind
+def test_sinks_opened_before_a_failing_one_are_discarded(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, 'AWS_S3_OUTPUT_DIR', f'file://{tmp_path}/')
+    open_output = tasks.open_output
+    def fail_on_json(fs, path, file_format):
+        if file_format == SupportedFileFormats.json: raise OSError('open failed')
+        return open_output(fs, path, file_format)
+    monkeypatch.setattr(tasks, 'open_output', fail_on_json)
+    file_formats = [SupportedFileFormats.tsv, SupportedFileFormats.json]
+
+    tasks.export('file_format_converter', 'q', file_formats, 'request', None, None, 1.0, lambda sinks: (0, 0, {}))
+
+    assert list(tmp_path.iterdir()) == []
+    for file_format in file_formats:
+        assert tasks.r.get(export_scheduler.export_cache_key('q', file_format)) == b'FAILED'
@@ -0,0 +1,60 @@
+import asyncio, io
+
+import pytest
+
+from app import preview
+from app.converters import ArrowIPCWriter, stream_to_writer
+
+RESULT_CSV = (b'"gene_id","species"\n' + b''.join(f'"{i}","{"homo_sapiens" if i % 3 else "mus_musculus"}"\n'.encode() for i in range(1, 31)))
+
+@pytest.fixture
+def sidecar_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(preview, 'PREVIEW_SIDECAR_DIR', str(tmp_path))
+    monkeypatch.setattr(preview, 'PREVIEW_SIDECAR_LOCK_POLL_INTERVAL', 0.01)
+    return tmp_path
+
+def write_sidecar(path: str) -> None:
+    with open(path, 'wb') as sink: stream_to_writer(io.BytesIO(RESULT_CSV), ArrowIPCWriter, sink)
+
+# another worker of the node holds the build lock: this one waits for its sidecar instead of building its own
+def test_one_worker_per_node_builds_a_sidecar(sidecar_dir, monkeypatch):
+    built = []
+    monkeypatch.setattr(preview, 'materialize', lambda query_id, path: built.append(query_id))
+    path = preview.sidecar_path('q')
+    open(f'{path}.lock', 'w').close()
+    async def run():
+        task = asyncio.create_task(preview.build('q', path))
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        write_sidecar(path)
+        await asyncio.wait_for(task, 1)
+    asyncio.run(run())
+    assert built == []
+
+def test_a_released_lock_is_taken_over(sidecar_dir, monkeypatch):
+    monkeypatch.setattr(preview, 'materialize', lambda query_id, path: write_sidecar(path))
+    path = preview.sidecar_path('q')
+    asyncio.run(preview.build('q', path))
+    assert (sidecar_dir / 'q.arrow').exists() and not (sidecar_dir / 'q.arrow.lock').exists()
+
+def test_a_stale_lock_is_removed(sidecar_dir, monkeypatch):
+    monkeypatch.setattr(preview, 'PREVIEW_SIDECAR_LOCK_TTL', -1)
+    lock_path = f"{preview.sidecar_path('q')}.lock"
+    open(lock_path, 'w').close()
+    assert not preview.take_lock(lock_path)
+    assert preview.take_lock(lock_path)
+
+def values(page: dict) -> list:
+    return [[datum.get('VarCharValue') for datum in row['Data']] for row in page['Rows'][1:]]
+
+def test_species_pages(sidecar_dir):
+    path = preview.sidecar_path('q')
+    write_sidecar(path)
+    expected = [[str(i), 'homo_sapiens'] for i in range(1, 31) if i % 3]
+    page = preview.read_page('q', path, 5, 4, species='homo_sapiens')
+    assert page['TotalRows'] == len(expected) and values(page) == expected[5:9]
+    # served from the cached indices
+    assert values(preview.read_page('q', path, 16, 10, species='homo_sapiens')) == expected[16:]
+    page = preview.read_page('q', path, 0, 3, sort='-gene_id', species='homo_sapiens', column_types={'gene_id': 'bigint'})
+    assert values(page) == [['29', 'homo_sapiens'], ['28', 'homo_sapiens'], ['26', 'homo_sapiens']]
+    assert values(preview.read_page('q', path, 0, 2, columns=['gene_id'], sort='gene_id', species='mus_musculus', column_types={'gene_id': 'bigint'})) == [['3'], ['6']]
@@ -0,0 +1,97 @@
+import asyncio
+import itertools
+
+import fakeredis.aioredis
+
+from app import cache, query_scheduler, status_tracker
+from app.constants import (ATHENA_SUBMISSION_LEASE_TTL, ATHENA_SUBMISSION_LEASES_KEY, QUERY_PRIORITY_BULK, QUERY_PRIORITY_INTERACTIVE,
+                           TICKET_SUBMITTED_PREFIX, TRACKED_QUERIES_KEY)
+
+def run(monkeypatch, scenario, limit: int = 2):
+    started = []
+    query_ids = (f'query-{i}' for i in itertools.count())
+    async def start_query_execution(query):
+        started.append(query)
+        return next(query_ids)
+    monkeypatch.setattr(query_scheduler, 'start_query_execution', start_query_execution)
+    monkeypatch.setattr(query_scheduler, 'ATHENA_MAX_CONCURRENT_QUERIES', limit)
+    async def main():
+        monkeypatch.setattr(cache, 'client', fakeredis.aioredis.FakeRedis())
+        return await scenario(started)
+    return asyncio.run(main())
+
+async def tracked() -> set:
+    return {query_id.decode('ascii') for query_id in await cache.client.smembers(TRACKED_QUERIES_KEY)}
+
+# below the limit queries are submitted right away and tracked, above it they get a ticket which waits in the queue
+def test_admission_limit(monkeypatch):
+    async def scenario(started):
+        query_ids = [await query_scheduler.submit({'query': f'q{i}', 'cache_key': f'key{i}'}, QUERY_PRIORITY_INTERACTIVE) for i in range(3)]
+        assert started == ['q0', 'q1']
+        assert query_ids[:2] == ['query-0', 'query-1']
+        assert await tracked() == {'query-0', 'query-1'}
+        assert not await cache.client.zcard(ATHENA_SUBMISSION_LEASES_KEY)
+        ticket = query_ids[2]
+        assert await status_tracker.get_state(ticket) == 'QUEUED'
+        assert await query_scheduler.position(ticket) == 1
+        # no free slot, nothing is dispatched
+        assert await query_scheduler.admit() == []
+        # a tracked query ends, its slot goes to the ticket
+        await status_tracker.record('query-0', 'SUCCEEDED')
+        assert await query_scheduler.admit() == [ticket]
+        assert await query_scheduler.position(ticket) is None
+    run(monkeypatch, scenario)
+
+# interactive tickets go before the bulk ones, each class in submission order, and a direct submission does not jump
+# ahead of waiting tickets
+def test_priority_order(monkeypatch):
+    async def scenario(started):
+        await query_scheduler.submit({'query': 'running'}, QUERY_PRIORITY_BULK)
+        bulk = [await query_scheduler.submit({'query': f'bulk{i}'}, QUERY_PRIORITY_BULK) for i in range(2)]
+        interactive = [await query_scheduler.submit({'query': f'interactive{i}'}, QUERY_PRIORITY_INTERACTIVE) for i in range(2)]
+        order = interactive + bulk
+        assert [await query_scheduler.position(ticket) for ticket in order] == [1, 2, 3, 4]
+        await status_tracker.record('query-0', 'FAILED')
+        assert await query_scheduler.admit('direct:submission') == []
+        dispatched = []
+        for _ in order:
+            tickets = await query_scheduler.admit()
+            dispatched.extend(tickets)
+            for ticket in tickets: await query_scheduler.dispatch(ticket)
+            # the dispatched query ends, freeing its slot for the next ticket
+            for query_id in await tracked(): await status_tracker.record(query_id, 'SUCCEEDED')
+        assert dispatched == order
+        assert started == ['running', 'interactive0', 'interactive1', 'bulk0', 'bulk1']
+    run(monkeypatch, scenario, limit=1)
+
+# once dispatched a ticket stands for the Athena query, and new identical submissions get the query ID itself
+def test_dispatched_ticket_resolves_to_the_query(monkeypatch):
+    async def scenario(started):
+        await query_scheduler.submit({'query': 'running'}, QUERY_PRIORITY_INTERACTIVE)
+        ticket = await query_scheduler.submit({'query': 'waiting', 'cache_key': 'key'}, QUERY_PRIORITY_INTERACTIVE)
+        assert await status_tracker.resolve(ticket) == (ticket, 'QUEUED')
+        await status_tracker.record('query-0', 'SUCCEEDED')
+        assert await query_scheduler.admit() == [ticket]
+        assert await query_scheduler.dispatch(ticket)
+        assert await cache.get(status_tracker.status_cache_key(ticket)) == TICKET_SUBMITTED_PREFIX + 'query-1'
+        assert await status_tracker.resolve(ticket) == ('query-1', 'QUEUED')
+        assert await cache.get('key') == 'query-1'
+        assert await tracked() == {'query-1'}
+        assert not await cache.client.zcard(ATHENA_SUBMISSION_LEASES_KEY)
+        assert not await cache.client.exists(query_scheduler.ticket_cache_key(ticket))
+        await status_tracker.record('query-1', 'SUCCEEDED')
+        assert await status_tracker.resolve(ticket) == ('query-1', 'SUCCEEDED')
+    run(monkeypatch, scenario, limit=1)
+
+# the lease of a dispatcher which died before submitting expires, its ticket goes back to its place in the queue
+def test_expired_lease_is_requeued(monkeypatch):
+    async def scenario(started):
+        await query_scheduler.submit({'query': 'running'}, QUERY_PRIORITY_INTERACTIVE)
+        ticket = await query_scheduler.submit({'query': 'waiting'}, QUERY_PRIORITY_INTERACTIVE)
+        await status_tracker.record('query-0', 'SUCCEEDED')
+        assert await query_scheduler.admit() == [ticket]
+        now = query_scheduler.time()
+        monkeypatch.setattr(query_scheduler, 'time', lambda: now + ATHENA_SUBMISSION_LEASE_TTL + 1)
+        assert await query_scheduler.admit() == [ticket]
+        assert await cache.client.zcard(ATHENA_SUBMISSION_LEASES_KEY) == 1
+    run(monkeypatch, scenario, limit=1)
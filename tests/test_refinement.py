@@ -0,0 +1,104 @@
+import csv
+
+import pyarrow as pa
+import pytest
+
+from app import refinement
+from app.refinement import UnsupportedRefinement, check, implies, mask, parse_condition, parse_fields, refine, subsumes
+
+COLUMN_KINDS = {'gene_id': 'integer', 'biotype': 'string', 'score': 'float', 'canonical': 'boolean'}
+
+def predicate(condition: str) -> tuple:
+    return parse_condition(condition)
+
+@pytest.mark.parametrize('narrower, wider, expected', [
+    ("gene_id > 10", "gene_id > 5", True),
+    ("gene_id > 5", "gene_id >= 5", True),
+    ("gene_id >= 5", "gene_id > 5", False),
+    ("gene_id >= 6", "gene_id > 5", True),
+    ("gene_id < 5", "gene_id <= 5", True),
+    ("gene_id <= 5", "gene_id < 5", False),
+    ("gene_id = 5", "gene_id <= 5", True),
+    ("gene_id = 5", "gene_id < 5", False),
+    ("gene_id BETWEEN 6 AND 8", "gene_id BETWEEN 5 AND 8", True),
+    ("gene_id BETWEEN 5 AND 8", "gene_id > 5", False),
+    ("gene_id BETWEEN 6 AND 8", "gene_id < 8", False),
+    ("gene_id < 8", "gene_id > 5", False),
+    ("score > 1.5", "gene_id > 1", False),
+])
+def test_range_containment(narrower, wider, expected):
+    assert implies(predicate(narrower), predicate(wider)) is expected
+
+@pytest.mark.parametrize('narrower, wider, expected', [
+    ("biotype = 'lncRNA'", "biotype IN ('lncRNA', 'miRNA')", True),
+    ("biotype IN ('miRNA')", "biotype IN ('lncRNA', 'miRNA')", True),
+    ("biotype IN ('miRNA', 'snRNA')", "biotype IN ('lncRNA', 'miRNA')", False),
+    ("biotype IN ('lncRNA', 'miRNA')", "biotype = 'lncRNA'", False),
+    ("description = 'lncRNA'", "biotype IN ('lncRNA', 'miRNA')", False),
+])
+def test_in_subset(narrower, wider, expected):
+    assert implies(predicate(narrower), predicate(wider)) is expected
+
+def test_subsumes_needs_every_parent_conjunct_and_a_field_subset():
+    parent = predicate("gene_id > 5 AND biotype IN ('lncRNA', 'miRNA')")
+    assert subsumes(parse_fields("gene_id,biotype"), parent, parse_fields("biotype"), predicate("biotype = 'miRNA' AND gene_id > 10 AND score < 1"))
+    assert not subsumes(parse_fields("gene_id,biotype"), parent, parse_fields("biotype"), predicate("gene_id > 10"))
+    assert not subsumes(parse_fields("gene_id,biotype"), parent, parse_fields("gene_id,score"), predicate("biotype = 'miRNA' AND gene_id > 10"))
+    assert not subsumes(parse_fields("gene_id"), None, None, None)
+
+BATCH = pa.record_batch([pa.array(['1', '2', None, '4']), pa.array(['lncRNA', None, 'miRNA', 'a_b'])], names=['gene_id', 'biotype'])
+
+@pytest.mark.parametrize('condition, expected', [
+    ("gene_id IN (1, 2)", [True, True, None, False]),
+    ("gene_id NOT IN (1, 2)", [False, False, None, True]),
+    ("NOT gene_id IN (1, 2)", [False, False, None, True]),
+    ("NOT (gene_id = 1)", [False, True, None, True]),
+    ("gene_id = 1 OR biotype = 'miRNA'", [True, None, True, False]),
+    ("gene_id > 1 AND biotype IS NULL", [False, True, False, False]),
+    ("NOT (gene_id > 1 AND biotype IS NULL)", [True, False, True, True]),
+    ("biotype NOT IN ('lncRNA')", [False, None, True, True]),
+])
+def test_three_valued_logic(condition, expected):
+    node = predicate(condition)
+    check(node, COLUMN_KINDS)
+    assert mask(node, BATCH, COLUMN_KINDS).to_pylist() == expected
+
+@pytest.mark.parametrize('condition', [
+    "gene_id = 'abc'",
+    "biotype = 1",
+    "canonical = 1",
+    "biotype = gene_id",
+    "gene_id IN (1, 2.5)",
+    "lower(biotype) = 'lncrna'",
+    "gene_id > abs(score)",
+    "biotype LIKE 'a\\_%'",
+    "gene_id LIKE '1%'",
+    "description = 'x'",
+])
+def test_check_rejects(condition):
+    with pytest.raises(UnsupportedRefinement):
+        check(predicate(condition), COLUMN_KINDS)
+
+def test_check_accepts_numbers_of_either_kind():
+    check(predicate("gene_id = score AND score > 1 AND biotype LIKE 'lnc%'"), COLUMN_KINDS)
+
+def test_refine_counts_and_writes_the_matching_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(refinement, 'AWS_S3_OUTPUT_DIR', f"file://{tmp_path}/")
+    (tmp_path / "parent.csv").write_text('"gene_id","biotype","score","canonical"\n'
+        '"1","lncRNA","0.5","true"\n'
+        '"2","miRNA",,"false"\n'
+        ',"lncRNA","1.5","true"\n'
+        '"4","","2.5",\n'
+        '"5","lncRNA","007","true"\n')
+    rows = refine("parent", "child", ["gene_id", "score"], predicate("biotype IN ('lncRNA') AND (score > 1 OR gene_id = 1)"), COLUMN_KINDS)
+    with open(tmp_path / "child.csv", newline='') as result:
+        assert list(csv.reader(result)) == [['gene_id', 'score'], ['1', '0.5'], ['', '1.5'], ['5', '007']]
+    assert rows == 3
+
+def test_species_condition_keeps_the_rows_of_one_species_of_a_merged_result():
+    batch = pa.record_batch([pa.array(['1', '7', '9']), pa.array(['homo_sapiens', "o'brien", 'homo_sapiens'])], names=['gene_id', 'species'])
+    column_kinds = {'gene_id': 'integer', 'species': 'string'}
+    node = refinement.species_condition('homo_sapiens', predicate("gene_id > 5"))
+    check(node, column_kinds)
+    assert mask(node, batch, column_kinds).to_pylist() == [False, False, True]
+    assert mask(refinement.species_condition("o'brien", None), batch, column_kinds).to_pylist() == [False, True, False]
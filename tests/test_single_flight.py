@@ -0,0 +1,83 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from app import cache
+from app.constants import SINGLE_FLIGHT_PLACEHOLDER_PREFIX
+
+def run(monkeypatch, scenario):
+    async def main():
+        monkeypatch.setattr(cache, 'client', fakeredis.aioredis.FakeRedis())
+        return await scenario()
+    return asyncio.run(main())
+
+def counting_create(calls: list, value: str = 'value', delay: float = 0.2):
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return value
+    return create
+
+def test_concurrent_callers_run_create_once(monkeypatch):
+    calls = []
+    async def scenario():
+        return await asyncio.gather(*(cache.single_flight('key', counting_create(calls), wait_time=2) for _ in range(5)))
+    results = run(monkeypatch, scenario)
+    assert len(calls) == 1
+    assert sorted(results) == [('value', False)] * 4 + [('value', True)]
+
+# the placeholder of a worker which died expires, the next caller takes over and runs create
+def test_expired_placeholder_is_taken_over(monkeypatch):
+    calls = []
+    async def scenario():
+        await cache.client.set('key', SINGLE_FLIGHT_PLACEHOLDER_PREFIX + 'dead', px=300)
+        result = await cache.single_flight('key', counting_create(calls, delay=0), wait_time=2)
+        return result, await cache.get('key')
+    assert run(monkeypatch, scenario) == (('value', True), 'value')
+    assert len(calls) == 1
+
+# a create running longer than the placeholder TTL keeps its placeholder, the waiters do not run create again
+def test_placeholder_is_kept_alive_while_create_runs(monkeypatch):
+    monkeypatch.setattr(cache, 'SINGLE_FLIGHT_LOCK_TTL', 1)
+    calls = []
+    async def scenario():
+        first = asyncio.create_task(cache.single_flight('key', counting_create(calls, delay=2), wait_time=5))
+        await asyncio.sleep(1.5)
+        assert (await cache.get('key')).startswith(SINGLE_FLIGHT_PLACEHOLDER_PREFIX)
+        second = await cache.single_flight('key', counting_create(calls, 'other'), wait_time=5)
+        return await first, second
+    assert run(monkeypatch, scenario) == (('value', True), ('value', False))
+    assert len(calls) == 1
+
+# a failed create removes its own placeholder so that the next caller retries right away
+def test_failed_create_removes_its_placeholder(monkeypatch):
+    async def fail():
+        raise ValueError('failed')
+    async def scenario():
+        with pytest.raises(ValueError):
+            await cache.single_flight('key', fail)
+        assert await cache.get('key') is None
+        return await cache.single_flight('key', counting_create([], delay=0), wait_time=0)
+    assert run(monkeypatch, scenario) == ('value', True)
+
+# compare-and-delete: the placeholder of another owner (taken over after an expiry) is left in place
+def test_failed_create_keeps_the_placeholder_of_another_owner(monkeypatch):
+    other = SINGLE_FLIGHT_PLACEHOLDER_PREFIX + 'other'
+    async def fail():
+        await cache.client.set('key', other)
+        raise ValueError('failed')
+    async def scenario():
+        with pytest.raises(ValueError):
+            await cache.single_flight('key', fail)
+        return await cache.get('key')
+    assert run(monkeypatch, scenario) == other
+
+def test_wait_times_out_while_the_placeholder_is_held(monkeypatch):
+    calls = []
+    async def scenario():
+        await cache.client.set('key', SINGLE_FLIGHT_PLACEHOLDER_PREFIX + 'running', ex=30)
+        with pytest.raises(TimeoutError):
+            await cache.single_flight('key', counting_create(calls), wait_time=0.3)
+    run(monkeypatch, scenario)
+    assert not calls